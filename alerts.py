@@ -0,0 +1,51 @@
+"""Alerts raised by the scoring rules on suspicious changesets.
+
+Every rule that fires on a changeset is recorded once, with the score of
+the rule, so the alerts of a changeset add up to its total score."""
+import config
+
+schema = """
+    CREATE TABLE IF NOT EXISTS alerts (
+        changeset_id bigint NOT NULL,
+        rule text NOT NULL,
+        score integer NOT NULL,
+        sequence integer,
+        detected_at timestamp with time zone NOT NULL DEFAULT now(),
+        PRIMARY KEY (changeset_id, rule));
+    CREATE INDEX IF NOT EXISTS alerts_detected_at_idx
+        ON alerts (detected_at)"""
+
+
+def write(cursor, rows):
+    """Record (changeset_id, rule, score, sequence) rows, keeping the
+    first detection of every rule on a changeset. Returns the number of
+    rows that were new."""
+    inserted = 0
+    for start in range(0, len(rows), config.ROLLUP_BATCH_SIZE):
+        cursor.execute(
+            """INSERT INTO alerts (changeset_id, rule, score, sequence)
+               VALUES {values}
+               ON CONFLICT (changeset_id, rule) DO NOTHING""".format(
+                values=", ".join(
+                    cursor.mogrify("(%s, %s, %s, %s)", row) for row
+                    in rows[start:start + config.ROLLUP_BATCH_SIZE])))
+        inserted += cursor.rowcount
+    return inserted
+
+
+def top_changesets(cursor, since, until, limit=None):
+    """get (changeset_id, uid, username, score, rules, detected_at) for
+    the changesets with alerts detected in [since, until), highest total
+    score first"""
+    query = """
+        SELECT a.changeset_id, c.uid, c.username, sum(a.score)::integer,
+            array_agg(a.rule ORDER BY a.rule), min(a.detected_at)
+        FROM alerts a LEFT JOIN {table} c ON c.id = a.changeset_id
+        WHERE a.detected_at >= %s AND a.detected_at < %s
+        GROUP BY a.changeset_id, c.uid, c.username
+        ORDER BY sum(a.score) DESC, min(a.detected_at) DESC""".format(
+        table=config.TABLENAME)
+    if limit:
+        query += " LIMIT {limit:d}".format(limit=limit)
+    cursor.execute(query, (since, until))
+    return cursor.fetchall()
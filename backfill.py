@@ -0,0 +1,130 @@
+"""Concurrent backfill of minutely changeset diffs.
+
+Worker threads download and parse a range of diffs over the shared
+keep-alive session, while the calling thread applies the results to the
+database strictly in sequence order. Workers are never allowed to run
+more than a window of diffs ahead of the applier, which bounds memory."""
+import threading
+import time
+import xml.etree.ElementTree as ET
+import zlib
+from Queue import Queue, Empty
+import requests
+import config
+import metrics
+import replication
+from osm import Planet, get_session
+
+QUEUE_DEPTH = metrics.gauge(
+    "backfill_queue_depth",
+    "Diffs fetched by the backfill workers and waiting to be applied.")
+
+
+def fetch_changesets(session, sequence, retries=config.BACKFILL_RETRIES):
+    """Download and parse one minutely diff into insert-ready tuples,
+    along with the last_run of its state file, retrying failures with
+    exponential backoff."""
+    attempt = 0
+    while True:
+        try:
+            last_run = Planet.get_state_for_sequence(sequence)['last_run']
+            return last_run, [
+                changeset.as_tuple() for changeset
+                in Planet.iter_changesets_for_minutely(sequence, session)]
+        except (requests.RequestException, IOError, ET.ParseError,
+                zlib.error):
+            if attempt >= retries:
+                raise
+            time.sleep(0.5 * 2 ** attempt)
+            attempt += 1
+
+
+class Backfill(object):
+    """Fetch sequences first through last with a bounded number of
+    worker threads and hand them out in order."""
+
+    def __init__(self, first, last, concurrency=config.BACKFILL_CONCURRENCY,
+                 session=None):
+        self.session = session or get_session()
+        self.sequences = Queue()
+        for sequence in range(first, last + 1):
+            self.sequences.put(sequence)
+        self.first = first
+        self.last = last
+        self.concurrency = concurrency
+        self.window = threading.Semaphore(concurrency * 4)
+        self.results = {}
+        self.done = threading.Condition()
+        self.stopped = False
+        self.workers = []
+
+    def start(self):
+        for _ in range(self.concurrency):
+            worker = threading.Thread(target=self._work)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def stop(self):
+        self.stopped = True
+        for _ in self.workers:
+            self.window.release()
+
+    def _work(self):
+        while not self.stopped:
+            self.window.acquire()
+            try:
+                if self.stopped:
+                    raise Empty()
+                sequence = self.sequences.get_nowait()
+            except Empty:
+                self.window.release()
+                return
+            try:
+                result = fetch_changesets(self.session, sequence)
+            except Exception as e:
+                result = e
+            with self.done:
+                self.results[sequence] = result
+                QUEUE_DEPTH.set(len(self.results))
+                self.done.notify_all()
+
+    def __iter__(self):
+        """yield (sequence, (last_run, changesets)) in sequence order,
+        raising the error of the first sequence that could not be
+        fetched"""
+        for sequence in range(self.first, self.last + 1):
+            with self.done:
+                while sequence not in self.results:
+                    self.done.wait(1)
+                result = self.results.pop(sequence)
+                QUEUE_DEPTH.set(len(self.results))
+            self.window.release()
+            if isinstance(result, Exception):
+                raise result
+            yield sequence, result
+
+
+def backfill(connection, first, last, concurrency=config.BACKFILL_CONCURRENCY):
+    """Fetch the diffs first through last concurrently and apply them
+    in order, each in its own transaction. Returns the number of diffs
+    applied."""
+    fetcher = Backfill(first, last, concurrency)
+    fetcher.start()
+    applied = 0
+    started = time.time()
+    try:
+        for sequence, (last_run, changesets) in fetcher:
+            replication.apply_changesets(
+                connection, sequence, changesets, last_run)
+            applied += 1
+            if applied % 100 == 0 or sequence == last:
+                elapsed = time.time() - started
+                print "backfilled {sequence} of {last}, {rate:.1f} diffs/s"\
+                    .format(
+                        sequence=sequence,
+                        last=last,
+                        rate=applied / elapsed if elapsed else 0)
+    finally:
+        fetcher.stop()
+    return applied
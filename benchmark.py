@@ -0,0 +1,517 @@
+"""Reproducible benchmarks for the changeset hot paths.
+
+The inputs are synthetic: testdata.sample1 scaled up to any number of
+changesets, minutely .osm.gz files made from them and osmChange
+documents of any size, all generated from a fixed seed, so runs on
+different versions time the same work. Run as python benchmark.py, with
+--db to also time bulk loads and bbox queries against the database in
+config.py (everything written there is rolled back), and --json to save
+the results for a later --compare."""
+import argparse
+import gzip
+import json
+import platform
+import random
+import sys
+import time
+import timeit
+from cStringIO import StringIO
+from datetime import datetime, timedelta
+import xml.etree.ElementTree as ET
+from xml.sax.saxutils import quoteattr
+import config
+import testdata
+from timeutil import UTC, parse_timestamp
+
+results = []
+
+
+def osm_timestamps():
+    """the created_at and closed_at values of testdata.sample1
+    formatted the way OSM writes them"""
+    timestamps = []
+    for changeset in testdata.sample1:
+        for value in changeset[3:5]:
+            timestamps.append(value.strftime('%Y-%m-%dT%H:%M:%SZ'))
+    return timestamps
+
+
+def changeset_xml(changesets=testdata.sample1):
+    """render insert-ready tuples as a changeset metadata document"""
+    lines = ['<osm version="0.6">']
+    for values in changesets:
+        attrs = [
+            'id="{0}"'.format(values[0]),
+            'created_at="{0}"'.format(
+                values[3].strftime('%Y-%m-%dT%H:%M:%SZ')),
+            'closed_at="{0}"'.format(
+                values[4].strftime('%Y-%m-%dT%H:%M:%SZ')),
+            'open="false"',
+            u'user={0}'.format(quoteattr(values[2])),
+            'uid="{0}"'.format(values[1]),
+            'num_changes="{0}"'.format(values[5])]
+        if values[6] or values[7] or values[8] or values[9]:
+            attrs.append(
+                'min_lon="{0!r}" max_lon="{1!r}" '
+                'min_lat="{2!r}" max_lat="{3!r}"'.format(*values[6:10]))
+        lines.append(u'<changeset {0}>'.format(u' '.join(attrs)))
+        for key, val in values[10].iteritems():
+            lines.append(u'<tag k={0} v={1}/>'.format(
+                quoteattr(key), quoteattr(val)))
+        lines.append(u'</changeset>')
+    lines.append(u'</osm>')
+    return u'\n'.join(lines).encode('utf-8')
+
+
+def osmchange_xml(elements=10000):
+    """render a synthetic osmChange document with about as many nodes,
+    ways and relations spread over create, modify and delete"""
+    lines = ['<osmChange version="0.6" generator="benchmark">']
+    blocks = elements // 100
+    for block in range(blocks):
+        action = ("create", "modify", "delete")[block % 3]
+        lines.append('<{0}>'.format(action))
+        for index in range(100):
+            element_id = block * 100 + index + 1
+            if index % 10 == 9:
+                lines.append(
+                    '<way id="{0}" version="2" changeset="1">'
+                    '<nd ref="1"/><nd ref="2"/><nd ref="3"/>'
+                    '<tag k="highway" v="residential"/></way>'.format(
+                        element_id))
+            elif index == 50:
+                lines.append(
+                    '<relation id="{0}" version="2" changeset="1">'
+                    '<member type="way" ref="1" role="outer"/>'
+                    '<tag k="type" v="multipolygon"/></relation>'.format(
+                        element_id))
+            else:
+                lines.append(
+                    '<node id="{0}" version="1" changeset="1" lat="52.1" '
+                    'lon="13.4"><tag k="amenity" v="bench"/></node>'.format(
+                        element_id))
+        lines.append('</{0}>'.format(action))
+    lines.append('</osmChange>')
+    return '\n'.join(lines)
+
+
+def changeset_elements(changesets=testdata.sample1):
+    return ET.fromstring(changeset_xml(changesets)).findall('changeset')
+
+
+def synthetic_changesets(count, seed=0, first_id=1, days=30, start=None):
+    """Scale testdata.sample1 up to count insert-ready tuples. The
+    samples are cycled with fresh ids, spread evenly over days days from
+    start, by default the start of 2020, and their boxes moved by a
+    random offset, so the mix of editors, tags and box sizes stays that
+    of the sample."""
+    rng = random.Random(seed)
+    if start is None:
+        start = datetime(2020, 1, 1, tzinfo=UTC)
+    step = timedelta(days=days) / max(count, 1)
+    changesets = []
+    for index in range(count):
+        values = testdata.sample1[index % len(testdata.sample1)]
+        created_at = start + step * index
+        bounds = values[6:10]
+        if any(bounds):
+            dlon = rng.uniform(-20, 20)
+            dlat = rng.uniform(-10, 10)
+            bounds = (
+                max(-180.0, min(180.0, bounds[0] + dlon)),
+                max(-180.0, min(180.0, bounds[1] + dlon)),
+                max(-90.0, min(90.0, bounds[2] + dlat)),
+                max(-90.0, min(90.0, bounds[3] + dlat)))
+        changesets.append(
+            (first_id + index,) + values[1:3] +
+            (created_at, created_at + (values[4] - values[3])) +
+            values[5:6] + tuple(bounds) + values[10:])
+    return changesets
+
+
+def minutely_gz(changesets):
+    """render changesets as a gzipped minutely changeset file"""
+    buf = StringIO()
+    compressed = gzip.GzipFile(fileobj=buf, mode='wb', mtime=0)
+    compressed.write(changeset_xml(changesets))
+    compressed.close()
+    return buf.getvalue()
+
+
+def random_bboxes(count, size, seed=0):
+    """get count (min_lon, min_lat, max_lon, max_lat) boxes of size
+    degrees at random places"""
+    rng = random.Random(seed)
+    bboxes = []
+    for _ in range(count):
+        lon = rng.uniform(-180, 180 - size)
+        lat = rng.uniform(-90, 90 - size)
+        bboxes.append((lon, lat, lon + size, lat + size))
+    return bboxes
+
+
+def report(name, seconds, count, **extra):
+    """print a timing and keep it for the JSON results"""
+    result = dict(
+        name=name,
+        seconds=seconds,
+        count=count,
+        usec_per_op=seconds / count * 1e6,
+        ops_per_s=count / seconds)
+    result.update(extra)
+    results.append(result)
+    print "{name:<40} {usec:>10.2f} usec/op {rate:>12.0f} ops/s".format(
+        name=name,
+        usec=result["usec_per_op"],
+        rate=result["ops_per_s"])
+
+
+def bench_timestamps(repeat=20):
+    from dateutil.parser import parse
+    timestamps = osm_timestamps()
+    assert [parse(t) for t in timestamps] == \
+        [parse_timestamp(t) for t in timestamps]
+    count = len(timestamps) * repeat
+    for name, func in [
+            ("dateutil.parser.parse", parse),
+            ("timeutil.parse_timestamp", parse_timestamp)]:
+        seconds = min(timeit.repeat(
+            lambda: [func(t) for t in timestamps],
+            number=repeat,
+            repeat=3))
+        report(name, seconds, count)
+
+
+class LegacyChangeset(object):
+    """the dict based Changeset as it was before it got __slots__"""
+
+    def __init__(self, **kwargs):
+        self.id = kwargs.get("id", 0)
+        self.uid = kwargs.get("uid", "")
+        self.user = kwargs.get("user", 0)
+        self.created_at = kwargs.get("created_at", None)
+        self.closed_at = kwargs.get("closed_at", None)
+        self.num_changes = kwargs.get("num_changes", None)
+        self.min_lat = kwargs.get("min_lat", 0.0)
+        self.min_lon = kwargs.get("min_lon", 0.0)
+        self.max_lat = kwargs.get("max_lat", 0.0)
+        self.max_lon = kwargs.get("max_lon", 0.0)
+        self.tags = kwargs.get("tags", {})
+
+
+def deep_size(obj, seen=None):
+    """approximate the memory held by an object graph"""
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_size(key, seen) + deep_size(val, seen)
+                    for key, val in obj.iteritems())
+    elif isinstance(obj, (list, tuple)):
+        size += sum(deep_size(item, seen) for item in obj)
+    if hasattr(obj, '__dict__'):
+        size += deep_size(obj.__dict__, seen)
+    for slot in getattr(type(obj), '__slots__', ()):
+        size += deep_size(getattr(obj, slot, None), seen)
+    return size
+
+
+def bench_convert(changesets, repeat=3):
+    from helpers import as_tuple, get_changeset_values_as_dict
+    elements = changeset_elements(changesets)
+    dicts = [get_changeset_values_as_dict(elem) for elem in elements]
+    for name, func, items in [
+            ("get_changeset_values_as_dict", get_changeset_values_as_dict,
+             elements),
+            ("as_tuple", as_tuple, dicts)]:
+        seconds = min(timeit.repeat(
+            lambda: [func(item) for item in items],
+            number=1,
+            repeat=repeat))
+        report(name, seconds, len(items))
+
+
+def bench_changesets(changesets, repeat=3):
+    from helpers import get_changeset_values_as_dict
+    from osm import Changeset
+    elements = changeset_elements(changesets)
+    count = len(elements)
+    builders = [
+        ("LegacyChangeset(**values_as_dict)", lambda elem: LegacyChangeset(
+            **get_changeset_values_as_dict(elem))),
+        ("Changeset(**values_as_dict)", lambda elem: Changeset(
+            **get_changeset_values_as_dict(elem))),
+        ("Changeset.from_element", Changeset.from_element)]
+    for name, build in builders:
+        seconds = min(timeit.repeat(
+            lambda: [build(elem) for elem in elements],
+            number=1,
+            repeat=repeat))
+        held = [build(elem) for elem in elements]
+        size = float(deep_size(held)) / count
+        report(name, seconds, count, bytes_per_op=size)
+        print "{name:<40} {size:>10.0f} bytes/changeset".format(
+            name="", size=size)
+    rows = [Changeset.from_element(elem).as_tuple() for elem in elements]
+    seconds = min(timeit.repeat(
+        lambda: [Changeset.from_row(row) for row in rows],
+        number=1,
+        repeat=repeat))
+    report("Changeset.from_row", seconds, count)
+
+
+def bench_minutely(changesets, per_file=50, repeat=3):
+    """decompress and parse minutely files of per_file changesets each,
+    the way the follower streams them"""
+    import osm
+    from streams import GeneratorReader, gunzip_chunks
+    files = [minutely_gz(changesets[start:start + per_file])
+             for start in range(0, len(changesets), per_file)]
+
+    def parse_all():
+        for data in files:
+            for _ in osm.iter_changesets(
+                    GeneratorReader(gunzip_chunks([data]))):
+                pass
+
+    seconds = min(timeit.repeat(parse_all, number=1, repeat=repeat))
+    report("minutely .osm.gz to Changeset", seconds, len(changesets),
+           files=len(files))
+
+
+def bench_analyze(elements=10000, repeat=5):
+    from cStringIO import StringIO
+    from helpers import analyze_changeset, analyze_changeset_stream
+    document = osmchange_xml(elements)
+    assert analyze_changeset(ET.fromstring(document)) == \
+        analyze_changeset_stream(StringIO(document))
+    for name, func in [
+            ("analyze_changeset(ET.fromstring)",
+             lambda: analyze_changeset(ET.fromstring(document))),
+            ("analyze_changeset_stream",
+             lambda: analyze_changeset_stream(StringIO(document))),
+            ("analyze_changeset_stream details",
+             lambda: analyze_changeset_stream(StringIO(document), True))]:
+        seconds = min(timeit.repeat(func, number=1, repeat=repeat))
+        report(name, seconds, elements)
+
+
+def bench_pool(batches=200, size=20):
+    """per-batch latency of a follower style upsert and state update,
+    opening a connection per batch versus borrowing a pooled one with
+    the statements already prepared; every batch is rolled back"""
+    import database
+    from changesetstore import ChangesetStore
+    batch = testdata.sample1[:size]
+
+    def apply_batch(connection):
+        cursor = connection.cursor()
+        ChangesetStore.upsert_changesets(cursor, batch)
+        ChangesetStore.set_replication_state(cursor, 1, None)
+        connection.rollback()
+
+    def connect_per_batch():
+        connection = database.get_connection()
+        try:
+            apply_batch(connection)
+        finally:
+            connection.close()
+
+    def pooled():
+        with database.pooled_connection() as connection:
+            apply_batch(connection)
+
+    pooled()
+    for name, func in [
+            ("connection per batch", connect_per_batch),
+            ("pooled, prepared", pooled)]:
+        seconds = min(timeit.repeat(func, number=batches, repeat=3))
+        report(name, seconds, batches)
+
+
+def bench_load(changesets, queries=200, size=1.0):
+    """COPY the changesets into the database, then query random boxes
+    of size degrees in the window they were created in, all in one
+    transaction that is rolled back"""
+    import database
+    from changesetstore import ChangesetStore
+    since = min(values[3] for values in changesets)
+    until = max(values[3] for values in changesets) + timedelta(seconds=1)
+    bboxes = random_bboxes(queries, size)
+    with database.pooled_connection() as connection:
+        cursor = connection.cursor()
+        started = time.time()
+        ChangesetStore.copy_changesets(cursor, changesets)
+        seconds = time.time() - started
+        print
+        report("copy_changesets", seconds, len(changesets))
+        cursor.execute("ANALYZE {table}".format(table=config.TABLENAME))
+        found = 0
+        started = time.time()
+        for bbox in bboxes:
+            for _ in ChangesetStore.query_bbox(connection, bbox, since, until):
+                found += 1
+        seconds = time.time() - started
+        report("query_bbox {0:g} degrees".format(size), seconds, queries,
+               rows=found)
+        connection.rollback()
+
+
+def bench_columnar(rows, queries=200, size=1.0, seed=0, days=30,
+                   batch=100000):
+    """Fill a columnar.ColumnarStore with rows synthetic changesets
+    created over days days, batch rows per append, then time selects
+    with one day windows, random boxes of size degrees, single users and
+    editors, alone and combined"""
+    import columnar
+    store = columnar.ColumnarStore()
+    start = datetime(2020, 1, 1, tzinfo=UTC)
+    seconds = 0.0
+    for first in range(0, rows, batch):
+        count = min(batch, rows - first)
+        changesets = synthetic_changesets(
+            count, seed + first, first + 1, float(days) * count / rows,
+            start + timedelta(days=days) * first / rows)
+        started = time.time()
+        store.append(changesets)
+        seconds += time.time() - started
+    report("ColumnarStore.append", seconds, rows)
+    rng = random.Random(seed)
+    windows = []
+    for _ in range(queries):
+        since = start + timedelta(seconds=rng.uniform(0, (days - 1) * 86400))
+        windows.append(dict(since=since, until=since + timedelta(days=1)))
+    bboxes = random_bboxes(queries, size, seed)
+    uids = [rng.choice(testdata.sample1)[1] for _ in range(queries)]
+    editors = [rng.choice(testdata.sample1)[10].get("created_by")
+               for _ in range(queries)]
+    filters = [
+        ("day", lambda index: windows[index]),
+        ("day+bbox", lambda index: dict(
+            windows[index], bbox=bboxes[index])),
+        ("day+uid", lambda index: dict(
+            windows[index], uids=[uids[index]])),
+        ("day+editor", lambda index: dict(
+            windows[index], tag=("created_by", editors[index]))),
+        ("day+bbox+editor", lambda index: dict(
+            windows[index], bbox=bboxes[index],
+            tag=("created_by", editors[index]))),
+        ("bbox", lambda index: dict(bbox=bboxes[index])),
+        ("editor", lambda index: dict(
+            tag=("created_by", editors[index])))]
+    for name, make in filters:
+        calls = [make(index) for index in range(queries)]
+        found = 0
+        started = time.time()
+        for kwargs in calls:
+            found += len(store.select(**kwargs))
+        report("ColumnarStore.select {0}".format(name),
+               time.time() - started, queries, rows=found)
+
+
+def bench_scoring(changesets, per_file=50, repeat=3):
+    """score batches of per_file changesets, the size of a minutely
+    diff, against config.SCORING_RULES, without writing the alerts and
+    with every user new; the user state is reset for every repeat"""
+    import scoring
+    batches = [changesets[start:start + per_file]
+               for start in range(0, len(changesets), per_file)]
+    engine = scoring.ScoringEngine()
+
+    def score_all():
+        engine.state = scoring.UserState()
+        for batch in batches:
+            engine.alerts(engine.changeset_features(None, batch))
+
+    seconds = min(timeit.repeat(score_all, number=1, repeat=repeat))
+    report("ScoringEngine batch of {0}".format(per_file), seconds,
+           len(batches), changesets=len(changesets))
+
+
+def compare(path):
+    """print how every result changed against a saved run"""
+    with open(path) as saved:
+        before = dict(
+            (result["name"], result) for result in json.load(saved)["results"])
+    print "\ncompared with {0}:".format(path)
+    for result in results:
+        old = before.get(result["name"])
+        if old is None:
+            continue
+        print "{name:<40} {old:>10.2f} -> {new:>10.2f} usec/op {ratio:>7.2f}x"\
+            .format(
+                name=result["name"],
+                old=old["usec_per_op"],
+                new=result["usec_per_op"],
+                ratio=old["usec_per_op"] / result["usec_per_op"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument(
+        "--changesets", type=int, default=10000,
+        help="number of synthetic changesets")
+    parser.add_argument(
+        "--elements", type=int, default=10000,
+        help="number of elements in the synthetic osmChange document")
+    parser.add_argument(
+        "--per-file", type=int, default=50,
+        help="changesets per synthetic minutely file")
+    parser.add_argument(
+        "--seed", type=int, default=0,
+        help="seed for the synthetic data")
+    parser.add_argument(
+        "--db", action="store_true",
+        help="also time connection pooling, bulk loads and bbox queries")
+    parser.add_argument(
+        "--queries", type=int, default=200,
+        help="number of bbox queries")
+    parser.add_argument(
+        "--bbox-size", type=float, default=1.0,
+        help="size of the queried boxes in degrees")
+    parser.add_argument(
+        "--columnar-rows", type=int, default=0,
+        help="also time the column store filled with this many synthetic "
+        "changesets; needs numpy")
+    parser.add_argument(
+        "--scoring", action="store_true",
+        help="also time scoring minutely batches; needs numpy")
+    parser.add_argument(
+        "--json", metavar="PATH",
+        help="save the results to PATH")
+    parser.add_argument(
+        "--compare", metavar="PATH",
+        help="compare the results with those saved in PATH")
+    args = parser.parse_args()
+    changesets = synthetic_changesets(
+        args.changesets, args.seed, first_id=10 ** 12)
+    bench_timestamps()
+    bench_convert(changesets)
+    bench_changesets(changesets)
+    bench_minutely(changesets, args.per_file)
+    bench_analyze(args.elements)
+    if args.db:
+        bench_pool()
+        bench_load(changesets, args.queries, args.bbox_size)
+    if args.scoring:
+        bench_scoring(changesets, args.per_file)
+    if args.columnar_rows:
+        bench_columnar(
+            args.columnar_rows, args.queries, args.bbox_size, args.seed)
+    if args.json:
+        with open(args.json, "w") as out:
+            json.dump({
+                "created_at": datetime.utcnow().isoformat() + "Z",
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "options": vars(args),
+                "results": results}, out, indent=2, sort_keys=True)
+    if args.compare:
+        compare(args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,476 @@
+import time
+from cStringIO import StringIO
+from datetime import datetime
+from sys import stdout
+import alerts
+import config
+import database
+import enrichment
+import helpers
+import metrics
+import rollups
+import users
+from sequenceindex import SequenceIndex
+from streams import StageReader
+
+CHANGESETS_WRITTEN = metrics.counter(
+    "changesets_written_total", "Changesets sent to the database.")
+
+DB_BATCHES = metrics.histogram(
+    "db_batch_seconds", "Seconds to write one batch of changesets.")
+
+COLUMNS = (
+    "id", "uid", "username", "created_at", "closed_at", "num_changes",
+    "min_lon", "max_lon", "min_lat", "max_lat", "tags", "bbox")
+
+_partitions = set()
+
+
+def next_month(year, month):
+    return year + month // 12, month % 12 + 1
+
+
+def months(first, last):
+    """yield the (year, month) pairs from first up to and including
+    last"""
+    while first <= last:
+        yield first
+        first = next_month(*first)
+
+
+class ChangesetStore(object):
+
+    table_schema = """
+        CREATE TABLE IF NOT EXISTS {table} (
+            id bigint NOT NULL,
+            uid integer,
+            username text,
+            created_at timestamp with time zone NOT NULL,
+            closed_at timestamp with time zone,
+            num_changes integer,
+            min_lon double precision,
+            max_lon double precision,
+            min_lat double precision,
+            max_lat double precision,
+            tags jsonb,
+            bbox box,
+            PRIMARY KEY (id, created_at))
+        PARTITION BY RANGE (created_at)"""
+
+    partition_schema = """
+        CREATE TABLE IF NOT EXISTS {partition} PARTITION OF {table}
+            FOR VALUES FROM ('{start}') TO ('{end}')"""
+
+    default_partition_schema = """
+        CREATE TABLE IF NOT EXISTS {table}_default PARTITION OF {table}
+            DEFAULT"""
+
+    move_from_default = """
+        CREATE TEMPORARY TABLE {partition}_moving ON COMMIT DROP AS
+            WITH moved AS (
+                DELETE FROM {table}_default
+                WHERE created_at >= '{start}' AND created_at < '{end}'
+                RETURNING *)
+            SELECT * FROM moved"""
+
+    index_schema = """
+        ALTER TABLE {table} ADD COLUMN IF NOT EXISTS bbox box;
+        UPDATE {table}
+            SET bbox = box(point(min_lon, min_lat), point(max_lon, max_lat))
+            WHERE bbox IS NULL AND (min_lon, max_lon, min_lat, max_lat)
+                <> (0.0, 0.0, 0.0, 0.0);
+        CREATE INDEX IF NOT EXISTS {table}_bbox_idx
+            ON {table} USING gist (bbox);
+        CREATE INDEX IF NOT EXISTS {table}_created_at_idx
+            ON {table} USING brin (created_at);
+        CREATE INDEX IF NOT EXISTS {table}_uid_created_at_idx
+            ON {table} (uid, created_at DESC, id DESC)"""
+
+    replication_schema = """
+        CREATE TABLE IF NOT EXISTS replication_state (
+            singleton boolean PRIMARY KEY DEFAULT true CHECK (singleton),
+            sequence integer NOT NULL,
+            last_run timestamp with time zone,
+            updated_at timestamp with time zone NOT NULL DEFAULT now())"""
+
+    @classmethod
+    def initialize_postgres(cls):
+        """Create the tables. The changesets table is partitioned by
+        month of created_at, with partitions from config.PARTITION_START
+        up to next month and a default partition for anything else."""
+        with database.pooled_connection() as connection:
+            cursor = connection.cursor()
+            cursor.execute(cls.table_schema.format(table=config.TABLENAME))
+            cursor.execute(cls.default_partition_schema.format(
+                table=config.TABLENAME))
+            start = datetime.strptime(config.PARTITION_START, "%Y-%m")
+            now = datetime.utcnow()
+            for year, month in months(
+                    (start.year, start.month),
+                    next_month(now.year, now.month)):
+                cls.create_partition(cursor, year, month)
+            cursor.execute(cls.index_schema.format(table=config.TABLENAME))
+            cursor.execute(cls.replication_schema)
+            cursor.execute(SequenceIndex.schema)
+            cursor.execute(enrichment.schema)
+            cursor.execute(rollups.schema)
+            cursor.execute(users.schema)
+            cursor.execute(alerts.schema)
+            connection.commit()
+
+    @classmethod
+    def wipe_database(cls):
+        with database.pooled_connection() as connection:
+            cursor = connection.cursor()
+            cursor.execute(
+                """TRUNCATE {table}, replication_state,
+                       replication_sequences, changeset_actions,
+                       editor_daily, hashtag_daily, users, alerts""".format(
+                    table=config.TABLENAME))
+            connection.commit()
+
+    @classmethod
+    def insert_changesets(cls, changesets):
+        """COPY a sequence of insert-ready tuples (see helpers.as_tuple)
+        into the changesets table in one transaction."""
+        with database.pooled_connection() as connection:
+            cursor = connection.cursor()
+            processed = cls.copy_changesets(cursor, changesets)
+            connection.commit()
+        return processed
+
+    @staticmethod
+    def partition_name(year, month):
+        return "{table}_{year:04d}_{month:02d}".format(
+            table=config.TABLENAME, year=year, month=month)
+
+    @classmethod
+    def create_partition(cls, cursor, year, month):
+        """Create the partition for one month if it does not exist.
+        Postgres refuses to while the default partition holds rows of
+        that month, so those are moved over into the new partition."""
+        end_year, end_month = next_month(year, month)
+        bounds = dict(
+            partition=cls.partition_name(year, month),
+            table=config.TABLENAME,
+            start="{0:04d}-{1:02d}-01 00:00:00+00".format(year, month),
+            end="{0:04d}-{1:02d}-01 00:00:00+00".format(end_year, end_month))
+        cursor.execute(
+            """SELECT EXISTS (SELECT 1 FROM {table}_default
+               WHERE created_at >= %s AND created_at < %s)""".format(
+                **bounds),
+            (bounds["start"], bounds["end"]))
+        moving = cursor.fetchone()[0]
+        if moving:
+            cursor.execute(cls.move_from_default.format(**bounds))
+        cursor.execute(cls.partition_schema.format(**bounds))
+        if moving:
+            cursor.execute(
+                """INSERT INTO {partition} SELECT * FROM {partition}_moving;
+                   DROP TABLE {partition}_moving""".format(**bounds))
+
+    @classmethod
+    def ensure_partitions(cls, cursor, changesets):
+        """Create the partitions for the months the insert-ready tuples
+        were created in, so none of them end up in the default
+        partition. The partitions found in the catalog are remembered
+        for the process, so only new months cost a catalog lookup, and
+        DDL is only issued for months that really have no partition."""
+        missing = {}
+        for values in changesets:
+            if values[3] is None:
+                continue
+            year, month = values[3].year, values[3].month
+            name = cls.partition_name(year, month)
+            if name not in _partitions:
+                missing[name] = year, month
+        if not missing:
+            return
+        _partitions.update(cls.partitions(cursor))
+        for name, (year, month) in missing.iteritems():
+            if name not in _partitions:
+                cls.create_partition(cursor, year, month)
+
+    @staticmethod
+    def partitions(cursor):
+        """get the names of the attached partitions"""
+        cursor.execute(
+            """SELECT c.relname FROM pg_inherits i
+               JOIN pg_class c ON c.oid = i.inhrelid
+               WHERE i.inhparent = %s::regclass
+               ORDER BY c.relname""",
+            (config.TABLENAME,))
+        return [row[0] for row in cursor]
+
+    @classmethod
+    def detach_partitions(cls, cursor, year, month):
+        """Detach the monthly partitions before the given month. They
+        stay around as plain tables, to be archived or dropped. Returns
+        their names."""
+        detached = []
+        for name in cls.partitions(cursor):
+            if name < cls.partition_name(year, month) and \
+                    name != config.TABLENAME + "_default":
+                cursor.execute(
+                    "ALTER TABLE {table} DETACH PARTITION {partition}".format(
+                        table=config.TABLENAME, partition=name))
+                _partitions.discard(name)
+                detached.append(name)
+        return detached
+
+    @classmethod
+    def copy_changesets(cls, cursor, changesets, limit=None,
+                        summarize_users=True, rollup_at_end=False):
+        """Stream insert-ready tuples into the changesets table using
+        COPY ... FROM STDIN, config.COPY_BATCH_SIZE rows at a time.
+        Rows are COPYed straight into their monthly partition, skipping
+        tuple routing; months without one go through the parent into the
+        default partition. Rows without a created_at, which the table
+        cannot hold, are skipped. The rollups, and unless summarize_users
+        is False the user summaries, are updated along with every batch,
+        or with rollup_at_end the rollups only once after the last one,
+        which loaders sharing the rollup tables in parallel need to lock
+        its rows in a single sorted pass. Reports progress on stdout and
+        returns the number of rows sent."""
+        partitions = set(cls.partitions(cursor))
+        rollup = rollups.Rollup()
+        activity = users.UserActivity()
+        buffers = {}
+        processed = 0
+        batched = 0
+        started = time.time()
+        previous = metrics.enter("convert")
+        try:
+            for values in changesets:
+                if not values or values[3] is None:
+                    continue
+                partition = cls.partition_name(
+                    values[3].year, values[3].month)
+                if partition not in partitions:
+                    partition = config.TABLENAME
+                buf = buffers.get(partition)
+                if buf is None:
+                    buf = buffers[partition] = StringIO()
+                buf.write(cls.copy_line(values))
+                rollup.add_values(values)
+                if summarize_users:
+                    activity.add_values(values)
+                processed += 1
+                batched += 1
+                if processed % config.VERBOSITY == 0:
+                    stdout.write(".")
+                if batched >= config.COPY_BATCH_SIZE:
+                    cls._write_batch(
+                        cursor, buffers, None if rollup_at_end else rollup,
+                        activity, batched)
+                    buffers = {}
+                    batched = 0
+                    cls._report(processed, started)
+                if limit and processed >= limit:
+                    break
+            if batched:
+                cls._write_batch(
+                    cursor, buffers, None if rollup_at_end else rollup,
+                    activity, batched)
+                cls._report(processed, started)
+            if rollup_at_end:
+                with metrics.stage("db_write"):
+                    rollup.write(cursor)
+        finally:
+            metrics.enter(previous)
+        return processed
+
+    @classmethod
+    def _write_batch(cls, cursor, buffers, rollup, activity, batched):
+        """COPY one batch of batched rows into its partitions and write
+        the rollup, unless it is None, and user summary deltas that go
+        with it"""
+        with metrics.stage("db_write"), DB_BATCHES.time():
+            for partition, buf in buffers.iteritems():
+                cls._flush(cursor, buf, partition)
+            if rollup is not None:
+                rollup.write(cursor)
+            activity.write(cursor)
+        CHANGESETS_WRITTEN.inc(batched)
+
+    @classmethod
+    def upsert_changesets(cls, cursor, changesets):
+        """Merge insert-ready tuples into the changesets table. Rows are
+        COPYed into a session-wide staging table, and a single statement
+        then inserts new changesets and updates existing ones only where
+        something changed, so reappearing open changesets that did not
+        grow cost no writes. If a changeset occurs more than once, the
+        last occurrence wins. The merge runs as a prepared statement
+        that also returns the previous version of every row it wrote, so
+        the rollups and user summaries can be moved by the difference.
+        Rows without a created_at are skipped. Returns the number of rows
+        written."""
+        latest = {}
+        for values in changesets:
+            if values and values[3] is not None:
+                latest[values[0]] = values
+        if not latest:
+            return 0
+        buf = StringIO()
+        for values in latest.itervalues():
+            buf.write(cls.copy_line(values))
+        buf.seek(0)
+        with metrics.stage("db_write"), DB_BATCHES.time():
+            merged = cls._merge(cursor, latest, buf)
+        CHANGESETS_WRITTEN.inc(len(latest))
+        return merged
+
+    @classmethod
+    def _merge(cls, cursor, latest, buf):
+        """merge the COPY lines in buf and move the rollups and user
+        summaries along, returning the number of rows written"""
+        cls.ensure_partitions(cursor, latest.itervalues())
+        cursor.execute(
+            """CREATE TEMPORARY TABLE IF NOT EXISTS {table}_staging
+               (LIKE {table}) ON COMMIT DELETE ROWS""".format(
+                table=config.TABLENAME))
+        cursor.copy_from(
+            buf, "{table}_staging".format(table=config.TABLENAME),
+            columns=COLUMNS)
+        database.execute_prepared(
+            cursor, "merge_changesets", cls.merge_statement())
+        merged = cursor.fetchall()
+        rollup = rollups.Rollup()
+        activity = users.UserActivity()
+        for row in merged:
+            values, old = row[:-3], row[-3:]
+            rollup.add_values(values)
+            rollup.add(*old, sign=-1)
+            activity.add_values(values, old)
+        rollup.write(cursor)
+        activity.write(cursor)
+        return len(merged)
+
+    @staticmethod
+    def copy_line(values):
+        """get a COPY line for an insert-ready tuple, with the bbox
+        column added"""
+        return helpers.as_copy_line(values + (helpers.as_box(values),))
+
+    @staticmethod
+    def merge_statement():
+        updated = tuple(
+            column for column in COLUMNS
+            if column not in ("id", "created_at"))
+        return """
+            WITH old AS (
+                SELECT c.id, c.created_at, c.num_changes, c.tags
+                FROM {table} c JOIN {table}_staging s USING (id, created_at)
+            ), merged AS (
+                INSERT INTO {table} AS c ({columns})
+                SELECT {columns} FROM {table}_staging
+                ON CONFLICT (id, created_at) DO UPDATE SET {updates}
+                WHERE ({current}) IS DISTINCT FROM ({excluded})
+                RETURNING {returned})
+            SELECT {merged}, o.created_at, o.num_changes, o.tags
+            FROM merged m LEFT JOIN old o USING (id, created_at)""".format(
+            table=config.TABLENAME,
+            columns=", ".join(COLUMNS),
+            returned=", ".join("c." + column for column in COLUMNS[:-1]),
+            merged=", ".join("m." + column for column in COLUMNS[:-1]),
+            updates=", ".join(
+                "{0} = EXCLUDED.{0}".format(column) for column in updated),
+            current=", ".join("c." + column for column in updated),
+            excluded=", ".join("EXCLUDED." + column for column in updated))
+
+    @staticmethod
+    def get_replication_state(cursor):
+        """get the (sequence, last_run) of the last applied minutely
+        diff, or None if nothing has been applied yet"""
+        cursor.execute("SELECT sequence, last_run FROM replication_state")
+        return cursor.fetchone()
+
+    @staticmethod
+    def set_replication_state(cursor, sequence, last_run=None):
+        database.execute_prepared(
+            cursor,
+            "set_replication_state",
+            """INSERT INTO replication_state (sequence, last_run)
+               VALUES ($1, $2)
+               ON CONFLICT (singleton) DO UPDATE SET
+                   sequence = EXCLUDED.sequence,
+                   last_run = EXCLUDED.last_run,
+                   updated_at = now()""",
+            (sequence, last_run))
+
+    @staticmethod
+    def query_bbox(connection, bbox, since=None, until=None, limit=None):
+        """Stream the changesets whose bbox intersects bbox, given as
+        (min_lon, min_lat, max_lon, max_lat), and that were created in
+        the optional [since, until) window, as Changeset records. Rows
+        come through a server-side cursor in no particular order, so
+        results arrive as the index scan produces them. since and until
+        prune the monthly partitions outside the window."""
+        from osm import Changeset
+        conditions = ["bbox && box(point(%s, %s), point(%s, %s))"]
+        params = list(bbox)
+        if since is not None:
+            conditions.append("created_at >= %s")
+            params.append(since)
+        if until is not None:
+            conditions.append("created_at < %s")
+            params.append(until)
+        query = "SELECT {columns} FROM {table} WHERE {conditions}".format(
+            columns=", ".join(COLUMNS[:-1]),
+            table=config.TABLENAME,
+            conditions=" AND ".join(conditions))
+        if limit:
+            query += " LIMIT {limit:d}".format(limit=limit)
+        cursor = connection.cursor("query_bbox")
+        cursor.itersize = 1000
+        cursor.execute(query, params)
+        try:
+            for row in cursor:
+                yield Changeset.from_row(row)
+        finally:
+            cursor.close()
+
+    @classmethod
+    def parse_xml_file(cls, changesetfile, limit=None, workers=1):
+        """Load a (bz2 compressed) changeset metadata dump such as
+        changesets-latest.osm.bz2 into the database, streaming it
+        through iterparse and COPY. Multi-stream bz2 files are split
+        across a pool of processes when more than one worker is asked
+        for. Returns the number of changesets loaded."""
+        from bz2file import BZ2File
+        if workers > 1 and not limit and changesetfile.endswith('.bz2'):
+            import parallelload
+            processed = parallelload.load_parallel(changesetfile, workers)
+            if processed is not None:
+                return processed
+            print "\n{path} is a single bz2 stream, loading it sequentially"\
+                .format(path=changesetfile)
+        if changesetfile.endswith('.bz2'):
+            changeset_xml = StageReader(BZ2File(changesetfile), "decompress")
+        else:
+            changeset_xml = open(changesetfile, 'rb')
+        try:
+            with database.pooled_connection() as connection:
+                cursor = connection.cursor()
+                processed = cls.copy_changesets(
+                    cursor,
+                    (helpers.as_tuple(changeset) for changeset
+                     in helpers.iter_changesets(changeset_xml)),
+                    limit)
+                connection.commit()
+        finally:
+            changeset_xml.close()
+        return processed
+
+    @staticmethod
+    def _flush(cursor, buf, table=config.TABLENAME):
+        buf.seek(0)
+        cursor.copy_from(buf, table, columns=COLUMNS)
+
+    @staticmethod
+    def _report(processed, started):
+        elapsed = time.time() - started
+        stdout.write("\n{processed} changesets, {rate:.0f}/s".format(
+            processed=processed,
+            rate=processed / elapsed if elapsed else 0))
+        stdout.flush()
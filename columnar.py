@@ -0,0 +1,477 @@
+"""In-memory, column oriented store of recent changesets.
+
+Every attribute is held in its own NumPy array: ids, uids and change
+counts as int64, creation and closing times as datetime64[us] in UTC,
+NaT when missing, and the bbox as four float64 arrays, NaN for
+changesets without one. Rows without a creation time never match a time
+window. User names and tag keys and values are dictionary encoded as
+int32 codes into Dictionary tables; the tags of all changesets are one
+flat run of (row, key, value) codes. Filters are whole-array
+expressions that return boolean masks, so they can be combined with &
+and | before the matching rows are materialized.
+
+The store is append only. A changeset that is appended again, as the
+follower does when an open changeset changes or closes, supersedes its
+earlier version, which stays in the arrays, masked out, until the next
+compact. Appends may come from the follower thread while other threads
+filter. start keeps a process wide store of the last days filled by the
+follower, which is what manager.py follow --columnar-days does."""
+import threading
+import time
+from datetime import datetime, timedelta
+import numpy as np
+import config
+import database
+import metrics
+from changesetstore import COLUMNS
+from timeutil import UTC, as_utc
+
+CHUNK_ROWS = 65536
+
+ZONE_COLUMNS = ("id", "created_at")
+
+MIN_TIME = np.datetime64("0001-01-01", "us")
+
+MAX_TIME = np.datetime64("9999-12-31", "us")
+
+NUMERIC_COLUMNS = (
+    ("id", np.int64), ("uid", np.int64), ("num_changes", np.int64),
+    ("created_at", "datetime64[us]"), ("closed_at", "datetime64[us]"),
+    ("min_lon", np.float64), ("max_lon", np.float64),
+    ("min_lat", np.float64), ("max_lat", np.float64),
+    ("username", np.int32), ("live", np.bool_))
+
+_store = None
+
+metrics.gauge(
+    "columnar_changesets",
+    "Live changesets held in the in-memory column store.",
+    func=lambda: len(_store) if _store is not None else 0)
+
+
+def datetime64(value):
+    """get a datetime as a datetime64[us] in UTC, taking a naive one to
+    be in UTC already, and None as NaT"""
+    if value is None:
+        return np.datetime64("NaT", "us")
+    return np.datetime64(as_utc(value).replace(tzinfo=None), "us")
+
+
+class Dictionary(object):
+    """Maps strings to dense int32 codes and back."""
+
+    def __init__(self):
+        self.codes = {}
+        self.values = []
+
+    def encode(self, value):
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+    def lookup(self, value):
+        """get the code of value, or -1 if it was never seen"""
+        return self.codes.get(value, -1)
+
+    def __len__(self):
+        return len(self.values)
+
+
+class GrowableArray(object):
+    """an array with spare capacity at the end, doubled as needed"""
+
+    def __init__(self, dtype, capacity=1024):
+        self.data = np.empty(capacity, dtype=dtype)
+        self.size = 0
+
+    def extend(self, values):
+        needed = self.size + len(values)
+        if needed > len(self.data):
+            grown = np.empty(max(needed, 2 * len(self.data)),
+                             dtype=self.data.dtype)
+            grown[:self.size] = self.data[:self.size]
+            self.data = grown
+        self.data[self.size:needed] = values
+        self.size = needed
+
+    def view(self, size=None):
+        return self.data[:self.size if size is None else size]
+
+
+class ColumnarStore(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.size = 0
+        self.columns = dict(
+            (name, GrowableArray(dtype)) for name, dtype in NUMERIC_COLUMNS)
+        self.tag_rows = GrowableArray(np.int32)
+        self.tag_keys = GrowableArray(np.int32)
+        self.tag_values = GrowableArray(np.int32)
+        self.usernames = Dictionary()
+        self.keys = Dictionary()
+        self.values = Dictionary()
+        self.zones = dict((name, []) for name in ZONE_COLUMNS)
+
+    def __len__(self):
+        """the number of live changesets"""
+        return int(self.column("live").sum())
+
+    def column(self, name):
+        """get a view of a column, that later appends do not change the
+        length of"""
+        return self.snapshot(name)[0]
+
+    def snapshot(self, *names):
+        """get views of columns that all have the same length"""
+        with self.lock:
+            return [self.columns[name].view(self.size) for name in names]
+
+    def append(self, changesets):
+        """Append insert-ready tuples, superseding the rows already held
+        for the same ids. Returns the number of rows appended."""
+        changesets = [values for values in changesets if values]
+        if not changesets:
+            return 0
+        ids = np.array([values[0] for values in changesets], dtype=np.int64)
+        bounds = np.array(
+            [values[6:10] if any(values[6:10]) else (np.nan,) * 4
+             for values in changesets], dtype=np.float64)
+        tag_rows, tag_keys, tag_values = [], [], []
+        with self.lock:
+            first = self.size
+            for offset, values in enumerate(changesets):
+                for key, value in (values[10] or {}).iteritems():
+                    tag_rows.append(first + offset)
+                    tag_keys.append(self.keys.encode(key))
+                    tag_values.append(self.values.encode(value))
+            self._supersede(ids)
+            new = {
+                "id": ids,
+                "uid": [values[1] or 0 for values in changesets],
+                "num_changes": [values[5] or 0 for values in changesets],
+                "created_at": [datetime64(values[3])
+                               for values in changesets],
+                "closed_at": [datetime64(values[4])
+                              for values in changesets],
+                "min_lon": bounds[:, 0],
+                "max_lon": bounds[:, 1],
+                "min_lat": bounds[:, 2],
+                "max_lat": bounds[:, 3],
+                "username": [self.usernames.encode(values[2])
+                             for values in changesets],
+                "live": np.ones(len(changesets), dtype=np.bool_)}
+            for name, values in new.iteritems():
+                self.columns[name].extend(values)
+            self.tag_rows.extend(tag_rows)
+            self.tag_keys.extend(tag_keys)
+            self.tag_values.extend(tag_values)
+            self.size += len(changesets)
+            self._update_zones(first)
+        return len(changesets)
+
+    def _supersede(self, ids):
+        """mask out the rows held for any of ids, looking only in the
+        chunks whose id range overlaps theirs"""
+        held = self.columns["id"].view(self.size)
+        live = self.columns["live"].view(self.size)
+        for start, end, matches in self._chunks("id", ids.min(), ids.max()):
+            if matches is not False:
+                chunk = live[start:end]
+                chunk[np.in1d(held[start:end], ids)] = False
+
+    def _update_zones(self, first):
+        """Recompute the minimum and maximum ids and creation times of
+        the chunks of CHUNK_ROWS rows touched since first. Filters on
+        those columns skip the chunks entirely outside their range, and
+        take the chunks entirely inside it without looking at the
+        rows. Missing creation times are left out of the range, and a
+        chunk with any is never taken without looking."""
+        for name, zones in self.zones.iteritems():
+            column = self.columns[name].view(self.size)
+            for chunk in range(first // CHUNK_ROWS,
+                               (self.size - 1) // CHUNK_ROWS + 1):
+                values = column[chunk * CHUNK_ROWS:(chunk + 1) * CHUNK_ROWS]
+                complete = True
+                if values.dtype.kind == "M":
+                    known = ~np.isnat(values)
+                    if not known.all():
+                        values = values[known]
+                        complete = False
+                if len(values):
+                    zone = (values.min(), values.max(), complete)
+                else:
+                    zone = (MAX_TIME, MIN_TIME, False)
+                if chunk < len(zones):
+                    zones[chunk] = zone
+                else:
+                    zones.append(zone)
+
+    def _chunks(self, name, low, high, size=None):
+        """Yield (start, end, matches) for the chunks of a zone mapped
+        column, where matches is False when no value in the chunk is in
+        [low, high], True when all are, and None when some may be."""
+        if size is None:
+            size = self.size
+        for chunk, (chunk_low, chunk_high, complete) in enumerate(
+                self.zones[name]):
+            start = chunk * CHUNK_ROWS
+            if start >= size:
+                break
+            end = min(start + CHUNK_ROWS, size)
+            if chunk_high < low or chunk_low > high:
+                yield start, end, False
+            elif complete and chunk_low >= low and chunk_high <= high:
+                yield start, end, True
+            else:
+                yield start, end, None
+
+    def on_diff(self, sequence, changesets):
+        """replication listener appending every applied diff"""
+        self.append(changesets)
+
+    def attach(self):
+        """append every diff the follower applies in this process from
+        now on"""
+        import replication
+        replication.add_listener(self.on_diff)
+
+    def detach(self):
+        import replication
+        replication.remove_listener(self.on_diff)
+
+    def load(self, connection, since=None):
+        """Append the changesets created at or after since from the
+        database, config.COPY_BATCH_SIZE rows at a time. Returns the
+        number of rows appended."""
+        query = "SELECT {columns} FROM {table}".format(
+            columns=", ".join(COLUMNS[:-1]), table=config.TABLENAME)
+        params = []
+        if since is not None:
+            query += " WHERE created_at >= %s"
+            params.append(since)
+        cursor = connection.cursor("columnar_load")
+        cursor.itersize = config.COPY_BATCH_SIZE
+        cursor.execute(query + " ORDER BY created_at", params)
+        loaded = 0
+        try:
+            while True:
+                rows = cursor.fetchmany(config.COPY_BATCH_SIZE)
+                if not rows:
+                    break
+                loaded += self.append(rows)
+        finally:
+            cursor.close()
+        return loaded
+
+    def compact(self, since=None):
+        """Drop superseded rows, and with since the rows created before
+        it or without a creation time, rebuilding the arrays in place.
+        The dictionaries are kept."""
+        with self.lock:
+            keep = self.columns["live"].view(self.size).copy()
+            if since is not None:
+                keep &= self.columns["created_at"].view(self.size) >= \
+                    datetime64(since)
+            new_row = np.cumsum(keep) - 1
+            tag_rows = self.tag_rows.view()
+            tags_kept = keep[tag_rows]
+            for name, column in self.columns.iteritems():
+                column.data = column.view()[keep]
+                column.size = len(column.data)
+            for name in ("tag_keys", "tag_values"):
+                tags = getattr(self, name)
+                tags.data = tags.view()[tags_kept]
+                tags.size = len(tags.data)
+            self.tag_rows.data = new_row[tag_rows[tags_kept]].astype(np.int32)
+            self.tag_rows.size = len(self.tag_rows.data)
+            self.size = int(keep.sum())
+            self.zones = dict((name, []) for name in ZONE_COLUMNS)
+            if self.size:
+                self._update_zones(0)
+
+    def live_mask(self):
+        return self.column("live").copy()
+
+    def bbox_mask(self, bbox):
+        """rows whose bbox intersects bbox, given as (min_lon, min_lat,
+        max_lon, max_lat); changesets without a bbox never match"""
+        return _intersects(bbox, *self.snapshot(
+            "min_lon", "max_lon", "min_lat", "max_lat"))
+
+    def time_mask(self, since=None, until=None):
+        """rows created in [since, until)"""
+        with self.lock:
+            created_at = self.columns["created_at"].view(self.size)
+            zones = list(self._chunks(
+                "created_at",
+                MIN_TIME if since is None else datetime64(since),
+                MAX_TIME if until is None
+                else datetime64(until) - np.timedelta64(1, "us"),
+                len(created_at)))
+        if since is None and until is None:
+            return np.ones(len(created_at), dtype=np.bool_)
+        mask = np.zeros(len(created_at), dtype=np.bool_)
+        for start, end, matches in zones:
+            if matches is None:
+                values = created_at[start:end]
+                chunk = np.ones(end - start, dtype=np.bool_)
+                if since is not None:
+                    chunk &= values >= datetime64(since)
+                if until is not None:
+                    chunk &= values < datetime64(until)
+                mask[start:end] = chunk
+            elif matches:
+                mask[start:end] = True
+        return mask
+
+    def uid_mask(self, uids):
+        return np.in1d(self.column("uid"), np.asarray(list(uids),
+                                                      dtype=np.int64))
+
+    def tag_mask(self, key, value=None, first=0, last=None):
+        """Rows with tag key, set to value unless that is None. Only the
+        tags of rows first up to but not including last are looked at;
+        tags are held in row order, so those are found by bisection."""
+        with self.lock:
+            size = self.size
+            tag_rows = self.tag_rows.view()
+            tag_keys = self.tag_keys.view()
+            tag_values = self.tag_values.view()
+        mask = np.zeros(size, dtype=np.bool_)
+        key_code = self.keys.lookup(key)
+        if key_code < 0:
+            return mask
+        start, end = tag_rows.searchsorted(np.array(
+            [first, size if last is None else last], dtype=tag_rows.dtype))
+        tag_rows = tag_rows[start:end]
+        tag_keys = tag_keys[start:end]
+        tag_values = tag_values[start:end]
+        if value is None:
+            matches = np.flatnonzero(tag_keys == key_code)
+        else:
+            value_code = self.values.lookup(value)
+            if value_code < 0:
+                return mask
+            matches = np.flatnonzero(tag_values == value_code)
+            matches = matches[tag_keys[matches] == key_code]
+        mask[tag_rows[matches]] = True
+        return mask
+
+    def select(self, bbox=None, since=None, until=None, uids=None,
+               tag=None):
+        """Get the indices of the live rows matching every filter given;
+        tag is a key or a (key, value) pair. The time window, which can
+        use the zone maps, is applied first; when it leaves few rows, the
+        other filters only look at those."""
+        mask = self.time_mask(since, until)
+        live, uid, lon_low, lon_high, lat_low, lat_high = self.snapshot(
+            "live", "uid", "min_lon", "max_lon", "min_lat", "max_lat")
+        mask &= live[:len(mask)]
+        if np.count_nonzero(mask) * 8 < len(mask):
+            rows = np.flatnonzero(mask)
+        else:
+            rows = slice(0, len(mask))
+        keep = mask[rows]
+        if tag is not None:
+            if not isinstance(tag, tuple):
+                tag = (tag,)
+            if isinstance(rows, slice):
+                keep &= self.tag_mask(*tag)[rows]
+            elif len(rows):
+                keep &= self.tag_mask(*tag, first=rows[0],
+                                      last=rows[-1] + 1)[rows]
+        if uids is not None:
+            keep &= np.in1d(
+                uid[rows], np.asarray(list(uids), dtype=np.int64))
+        if bbox is not None:
+            keep &= _intersects(
+                bbox, lon_low[rows], lon_high[rows], lat_low[rows],
+                lat_high[rows])
+        if isinstance(rows, slice):
+            return np.flatnonzero(keep)
+        return rows[keep]
+
+    def changesets(self, indices):
+        """materialize rows as Changeset records"""
+        from osm import Changeset
+        indices = np.asarray(indices)
+        with self.lock:
+            size = self.size
+            columns = dict(
+                (name, column.view(size))
+                for name, column in self.columns.iteritems())
+            tag_rows = self.tag_rows.view()
+            tag_keys = self.tag_keys.view()
+            tag_values = self.tag_values.view()
+        wanted = np.in1d(tag_rows, indices)
+        tags = {}
+        for row, key, value in zip(tag_rows[wanted], tag_keys[wanted],
+                                   tag_values[wanted]):
+            tags.setdefault(row, {})[self.keys.values[key]] = \
+                self.values.values[value]
+        changesets = []
+        for index in indices:
+            bounds = [columns[name][index] for name in
+                      ("min_lon", "max_lon", "min_lat", "max_lat")]
+            if np.isnan(bounds[0]):
+                bounds = [0.0] * 4
+            changesets.append(Changeset.from_row((
+                int(columns["id"][index]),
+                int(columns["uid"][index]),
+                self.usernames.values[columns["username"][index]],
+                _datetime(columns["created_at"][index]),
+                _datetime(columns["closed_at"][index]),
+                int(columns["num_changes"][index])) + tuple(
+                    float(bound) for bound in bounds) +
+                (tags.get(index, {}),)))
+        return changesets
+
+
+def get_store():
+    """get the process wide store kept by start, or None"""
+    return _store
+
+
+def _horizon(days):
+    return datetime.now(UTC) - timedelta(days=days)
+
+
+def start(days=config.COLUMNAR_DAYS,
+          compact_interval=config.COLUMNAR_COMPACT_INTERVAL):
+    """Fill the process wide store with the changesets created in the
+    last days from the database and append every diff the follower
+    applies in this process from then on. Every compact_interval
+    seconds a daemon thread drops the rows that have grown older than
+    days. Returns the store."""
+    global _store
+    store = ColumnarStore()
+    with database.pooled_connection() as connection:
+        store.load(connection, _horizon(days))
+    store.attach()
+    _store = store
+
+    def run():
+        while True:
+            time.sleep(compact_interval)
+            store.compact(_horizon(days))
+
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    return store
+
+
+def _intersects(bbox, lon_low, lon_high, lat_low, lat_high):
+    min_lon, min_lat, max_lon, max_lat = bbox
+    with np.errstate(invalid="ignore"):
+        return ((lon_low <= max_lon) & (lon_high >= min_lon) &
+                (lat_low <= max_lat) & (lat_high >= min_lat))
+
+
+def _datetime(value):
+    if np.isnat(value):
+        return None
+    return value.astype("datetime64[us]").item().replace(tzinfo=UTC)
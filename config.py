@@ -3,10 +3,85 @@ PG_CONNECTION = {
     "user": "osm",
     "host": "localhost"}
 
+PG_POOL_MIN = 2
+
+PG_POOL_MAX = 10
+
+PG_POOL_CHECK_INTERVAL = 30
+
 TABLENAME = 'changesets'
 
+PARTITION_START = '2005-04'
+
 TMP_DIR = '/tmp'
 
 OSM_API_BASE_URL = 'http://api.osm.org/api/0.6/'
 
+PLANET_BASE_URL = 'http://planet.osm.org/'
+
 VERBOSITY = 1000
+
+COPY_BATCH_SIZE = 50000
+
+LOAD_RUNS_PER_WORKER = 4
+
+REPLICATION_POLL_INTERVAL = 10
+
+STATE_CACHE_TTL = 5
+
+HTTP_POOL_SIZE = 16
+
+HTTP_TIMEOUT = 30
+
+BACKFILL_CONCURRENCY = 8
+
+BACKFILL_RETRIES = 4
+
+ENRICH_WORKERS = 8
+
+ENRICH_RATE = 10
+
+ENRICH_RETRIES = 4
+
+ENRICH_BATCH_SIZE = 100
+
+FETCH_CACHE_DIR = None
+
+FETCH_CACHE_MAX_BYTES = 2 * 1024 ** 3
+
+FETCH_CACHE_MMAP = True
+
+ROLLUP_BATCH_SIZE = 1000
+
+METRICS_PORT = None
+
+METRICS_LOG_INTERVAL = 60
+
+EXPORT_BATCH_SIZE = 50000
+
+EXPORT_COMPRESSION = 'snappy'
+
+EVENTS_PORT = None
+
+EVENTS_QUEUE_SIZE = 1000
+
+EVENTS_BLOCK_TIMEOUT = 5
+
+EVENTS_GRID_DEGREES = 1.0
+
+EVENTS_KEEPALIVE = 15
+
+COLUMNAR_DAYS = None
+
+COLUMNAR_COMPACT_INTERVAL = 3600
+
+SCORING_ENABLED = True
+
+SCORING_RULES = [
+    ("huge_bbox", 30, [("bbox_area", ">", 100.0)]),
+    ("mass_delete", 50, [("deletes", ">", 500)]),
+    ("new_user_mass_edit", 40, [
+        ("user_age_days", "<", 1), ("num_changes", ">", 1000)]),
+    ("watched_editor", 20, [("editor", "in", [])])]
+
+SCORING_MAX_USERS = 1000000
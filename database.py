@@ -0,0 +1,138 @@
+import threading
+import time
+from contextlib import contextmanager
+import psycopg2
+import psycopg2.extensions
+import psycopg2.extras
+import psycopg2.pool
+import config
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+class PreparingConnection(psycopg2.extensions.connection):
+    """A connection that remembers the server-side prepared statements
+    it holds, and when it was last seen working."""
+
+    def __init__(self, *args, **kwargs):
+        super(PreparingConnection, self).__init__(*args, **kwargs)
+        self.prepared = set()
+        self.checked = time.time()
+
+
+def _register(connection):
+    psycopg2.extras.register_json(connection, oid=3802, array_oid=3807)
+    return connection
+
+
+def get_connection():
+    """Open a connection to the changesets database, with jsonb
+    registered so tags come back as dicts. Meant for processes that
+    cannot share the pool, like the parallel loader; everything else
+    borrows from pooled_connection."""
+    return _register(psycopg2.connect(
+        connection_factory=PreparingConnection, **config.PG_CONNECTION))
+
+
+class ConnectionPool(psycopg2.pool.ThreadedConnectionPool):
+
+    def _connect(self, key=None):
+        return _register(
+            psycopg2.pool.ThreadedConnectionPool._connect(self, key))
+
+
+def get_pool():
+    """Get the connection pool shared by the threads of this process,
+    which keeps config.PG_POOL_MIN connections open and opens up to
+    config.PG_POOL_MAX."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ConnectionPool(
+                config.PG_POOL_MIN,
+                config.PG_POOL_MAX,
+                connection_factory=PreparingConnection,
+                **config.PG_CONNECTION)
+    return _pool
+
+
+def healthy(connection):
+    """check that a pooled connection still works; connections that
+    were used successfully within config.PG_POOL_CHECK_INTERVAL seconds
+    are trusted without a round trip"""
+    if connection.closed:
+        return False
+    if time.time() - connection.checked < config.PG_POOL_CHECK_INTERVAL:
+        return True
+    try:
+        connection.cursor().execute("SELECT 1")
+        connection.rollback()
+    except psycopg2.Error:
+        return False
+    connection.checked = time.time()
+    return True
+
+
+@contextmanager
+def pooled_connection():
+    """Borrow a connection from the pool for a with block. Connections
+    that fail their health check are replaced by fresh ones, anything
+    left uncommitted is rolled back when the connection is returned, and
+    connections that broke inside the block are closed instead of
+    returned."""
+    pool = get_pool()
+    connection = pool.getconn()
+    while not healthy(connection):
+        pool.putconn(connection, close=True)
+        connection = pool.getconn()
+    broken = False
+    try:
+        yield connection
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        broken = True
+        raise
+    finally:
+        if not broken and not connection.closed:
+            try:
+                connection.rollback()
+                connection.checked = time.time()
+            except psycopg2.Error:
+                broken = True
+        pool.putconn(connection, close=broken or bool(connection.closed))
+
+
+def execute_prepared(cursor, name, statement, params=()):
+    """Execute statement, which uses $1, $2... placeholders, as the
+    server-side prepared statement name, preparing it the first time it
+    is used on the connection. The server then plans it once per
+    connection instead of on every call."""
+    connection = cursor.connection
+    if name not in connection.prepared:
+        cursor.execute("PREPARE {name} AS {statement}".format(
+            name=name, statement=statement))
+        connection.prepared.add(name)
+    if not params:
+        cursor.execute("EXECUTE {name}".format(name=name))
+        return
+    cursor.execute(
+        "EXECUTE {name} ({placeholders})".format(
+            name=name, placeholders=", ".join(["%s"] * len(params))),
+        params)
+
+
+def latest_created_at(cursor):
+    """get the creation time of the most recent changeset, or None"""
+    execute_prepared(
+        cursor,
+        "latest_changeset",
+        "SELECT max(created_at) FROM {table}".format(
+            table=config.TABLENAME))
+    return cursor.fetchone()[0]
+
+
+def get_latest_changeset():
+    """Get the creation time of the most recent changeset in the
+    local database, or None if there is nothing in it yet."""
+    with pooled_connection() as connection:
+        return latest_created_at(connection.cursor())
@@ -0,0 +1,186 @@
+"""Enrich stored changesets with the number of nodes, ways and relations
+they created, modified and deleted.
+
+A bounded pool of threads downloads osmChange documents over the shared
+keep-alive session, sharing one rate limit and backing off on errors,
+while the calling thread writes the counts back in bulk."""
+import threading
+import time
+from Queue import Queue
+import requests
+import config
+import fetchcache
+import helpers
+import metrics
+from osm import API, get_session
+from streams import open_url
+
+COUNT_COLUMNS = tuple(
+    "{action}_{osmtype}".format(action=action, osmtype=osmtype)
+    for action in helpers.actions for osmtype in helpers.osmtypes)
+
+schema = """
+    CREATE TABLE IF NOT EXISTS changeset_actions (
+        id bigint PRIMARY KEY,
+        {counts},
+        fetched_at timestamp with time zone NOT NULL DEFAULT now())""".format(
+    counts=",\n        ".join(
+        "{0} integer NOT NULL".format(column) for column in COUNT_COLUMNS))
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+QUEUE_DEPTH = metrics.gauge(
+    "enrich_queue_depth", "Changesets waiting to be enriched.")
+
+
+class RateLimiter(object):
+    """spread calls evenly at no more than rate per second across
+    all threads, or let them all through if rate is 0"""
+
+    def __init__(self, rate):
+        if rate < 0:
+            raise ValueError("rate must not be negative")
+        self.interval = 1.0 / rate if rate else 0.0
+        self.lock = threading.Lock()
+        self.next_call = 0
+
+    def wait(self):
+        with self.lock:
+            now = time.time()
+            self.next_call = max(self.next_call, now)
+            delay = self.next_call - now
+            self.next_call += self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+def fetch_details(session, limiter, changeset_id,
+                  retries=config.ENRICH_RETRIES):
+    """Download and analyze the osmChange of one closed changeset, which
+    can no longer change and so goes through the fetch cache. Returns
+    the analyze_changeset breakdown, or None if the API does not have
+    the changeset. Throttling and server errors are retried with
+    exponential backoff, honouring Retry-After."""
+    url = API.osmchange_url(changeset_id)
+    attempt = 0
+    while True:
+        limiter.wait()
+        delay = 2 ** attempt
+        try:
+            return helpers.analyze_changeset_stream(
+                open_url(session, url, fetchcache.get_cache()))
+        except requests.HTTPError as e:
+            status = e.response.status_code
+            if status in (404, 410):
+                return None
+            if status not in RETRY_STATUSES:
+                raise
+            retry_after = e.response.headers.get('retry-after', '')
+            if retry_after.isdigit():
+                delay = max(delay, int(retry_after))
+        except (requests.ConnectionError, requests.Timeout):
+            pass
+        if attempt >= retries:
+            raise IOError("giving up on changeset {id}".format(
+                id=changeset_id))
+        time.sleep(delay)
+        attempt += 1
+
+
+def as_counts(changeset_id, details):
+    """get an insert-ready tuple for changeset_actions"""
+    return (changeset_id,) + tuple(
+        details[action][osmtype]
+        for action in helpers.actions for osmtype in helpers.osmtypes)
+
+
+def pending_changesets(cursor, limit):
+    """get the ids of closed changesets that have not been enriched,
+    newest first"""
+    cursor.execute(
+        """SELECT c.id FROM {table} c
+           LEFT JOIN changeset_actions a ON a.id = c.id
+           WHERE a.id IS NULL AND c.closed_at < now()
+           ORDER BY c.id DESC LIMIT %s""".format(table=config.TABLENAME),
+        (limit,))
+    return [row[0] for row in cursor]
+
+
+def write_counts(cursor, rows):
+    """insert a batch of changeset_actions rows in one statement"""
+    if not rows:
+        return
+    placeholders = "(" + ", ".join(["%s"] * (len(COUNT_COLUMNS) + 1)) + ")"
+    cursor.execute(
+        """INSERT INTO changeset_actions (id, {columns}) VALUES {values}
+           ON CONFLICT (id) DO NOTHING""".format(
+            columns=", ".join(COUNT_COLUMNS),
+            values=", ".join(cursor.mogrify(placeholders, row)
+                             for row in rows)))
+
+
+def enrich(connection, changeset_ids, workers=config.ENRICH_WORKERS,
+           rate=config.ENRICH_RATE, batch_size=config.ENRICH_BATCH_SIZE):
+    """Fetch and store action counts for changeset_ids with a pool of
+    workers threads, scoring every batch written unless
+    config.SCORING_ENABLED is off. Returns (enriched, missing, failed)
+    counts."""
+    session = get_session()
+    limiter = RateLimiter(rate)
+    todo = Queue()
+    for changeset_id in changeset_ids:
+        todo.put(changeset_id)
+    results = Queue()
+
+    def work():
+        while True:
+            changeset_id = todo.get()
+            if changeset_id is None:
+                return
+            try:
+                details = fetch_details(session, limiter, changeset_id)
+            except Exception as e:
+                details = e
+            results.put((changeset_id, details))
+
+    threads = []
+    for _ in range(workers):
+        todo.put(None)
+        thread = threading.Thread(target=work)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+
+    cursor = connection.cursor()
+    engine = None
+    if config.SCORING_ENABLED:
+        import scoring
+        engine = scoring.get_engine()
+
+    def flush(batch):
+        write_counts(cursor, batch)
+        if engine is not None:
+            engine.score_counts(cursor, batch)
+        connection.commit()
+
+    batch = []
+    enriched = missing = failed = 0
+    for done in range(len(changeset_ids)):
+        changeset_id, details = results.get()
+        QUEUE_DEPTH.set(len(changeset_ids) - done - 1)
+        if details is None:
+            missing += 1
+        elif isinstance(details, Exception):
+            failed += 1
+            helpers.handle_error(details, bail=False)
+        else:
+            batch.append(as_counts(changeset_id, details))
+        if len(batch) >= batch_size:
+            flush(batch)
+            enriched += len(batch)
+            batch = []
+    flush(batch)
+    enriched += len(batch)
+    for thread in threads:
+        thread.join()
+    return enriched, missing, failed
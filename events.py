@@ -0,0 +1,411 @@
+"""Push feed of the changesets in every applied minutely diff.
+
+Subscribers register a filter, on a bbox, a set of uids and/or tags,
+and get the matching changesets in a bounded queue of their own. The
+filters are indexed so that publishing a changeset only looks at the
+subscriptions that can match it: bbox filters are kept in a grid of
+config.EVENTS_GRID_DEGREES cells, filters without a bbox are indexed by
+uid or by tag key, and only filters without any of these are checked
+against every changeset.
+
+A subscriber that does not keep up either loses the oldest events in
+its queue (the drop policy) or makes the publisher wait for room, at
+most config.EVENTS_BLOCK_TIMEOUT seconds per event (the block policy).
+Since the bus is fed by the follower, blocking slows replication down to
+the pace of the slowest blocking subscriber.
+
+Events are served to other processes as Server-Sent Events from
+/events, with the filters as query parameters, e.g.
+/events?bbox=4.7,52.3,5.0,52.4&uid=123,456&tag=created_by=JOSM."""
+import BaseHTTPServer
+import Queue
+import SocketServer
+import json
+import math
+import socket
+import threading
+import urlparse
+import config
+import metrics
+
+POLICIES = ("drop", "block")
+
+EVENTS_DELIVERED = metrics.counter(
+    "events_delivered_total", "Changeset events queued for subscribers.")
+
+EVENTS_DROPPED = metrics.counter(
+    "events_dropped_total",
+    "Changeset events dropped because a subscriber queue was full.")
+
+_bus = None
+_bus_lock = threading.Lock()
+
+
+def get_bus():
+    """get the process wide event bus"""
+    global _bus
+    with _bus_lock:
+        if _bus is None:
+            _bus = EventBus()
+    return _bus
+
+
+metrics.gauge(
+    "event_subscribers", "Subscriptions to the changeset event bus.",
+    func=lambda: len(_bus.subscriptions) if _bus is not None else 0)
+
+
+def changeset_event(sequence, values):
+    """get the JSON-ready event for an insert-ready tuple"""
+    bounds = values[6:10]
+    return {
+        "sequence": sequence,
+        "id": values[0],
+        "uid": values[1],
+        "user": values[2],
+        "created_at": values[3] and values[3].isoformat(),
+        "closed_at": values[4] and values[4].isoformat(),
+        "num_changes": values[5],
+        "bbox": [bounds[0], bounds[2], bounds[1], bounds[3]]
+        if any(bounds) else None,
+        "tags": values[10] or {}}
+
+
+class GridIndex(object):
+    """Finds the items whose box may intersect a box, from a grid of
+    cells degrees wide. Items covering more than max_cells cells are
+    kept aside and returned for every query."""
+
+    def __init__(self, degrees=config.EVENTS_GRID_DEGREES, max_cells=4096):
+        self.degrees = degrees
+        self.max_cells = max_cells
+        self.cells = {}
+        self.wide = set()
+        self.items = set()
+
+    def _cells(self, bbox):
+        """get the cells a (min_lon, min_lat, max_lon, max_lat) box
+        covers, or None if there are more than max_cells"""
+        min_x, min_y, max_x, max_y = [
+            int(math.floor(coordinate / self.degrees)) for coordinate in bbox]
+        if (max_x - min_x + 1) * (max_y - min_y + 1) > self.max_cells:
+            return None
+        return [(x, y) for x in range(min_x, max_x + 1)
+                for y in range(min_y, max_y + 1)]
+
+    def add(self, item, bbox):
+        self.items.add(item)
+        cells = self._cells(bbox)
+        if cells is None:
+            self.wide.add(item)
+            return
+        for cell in cells:
+            self.cells.setdefault(cell, set()).add(item)
+
+    def remove(self, item, bbox):
+        self.items.discard(item)
+        cells = self._cells(bbox)
+        if cells is None:
+            self.wide.discard(item)
+            return
+        for cell in cells:
+            items = self.cells.get(cell)
+            if items is not None:
+                items.discard(item)
+                if not items:
+                    del self.cells[cell]
+
+    def query(self, bbox):
+        cells = self._cells(bbox)
+        if cells is None:
+            return set(self.items)
+        found = set(self.wide)
+        for cell in cells:
+            found.update(self.cells.get(cell, ()))
+        return found
+
+
+class Subscription(object):
+    """A filter and the bounded queue of events matching it. All the
+    filters given must match; tags maps keys to the value they must
+    have, or to None for any value."""
+
+    def __init__(self, bus, bbox=None, uids=None, tags=None,
+                 maxsize=config.EVENTS_QUEUE_SIZE, policy="drop"):
+        if policy not in POLICIES:
+            raise ValueError("unknown policy {0!r}".format(policy))
+        self.bus = bus
+        self.bbox = bbox and tuple(float(value) for value in bbox)
+        self.uids = uids and frozenset(int(uid) for uid in uids)
+        self.tags = tags or {}
+        self.policy = policy
+        self.queue = Queue.Queue(maxsize)
+        self.dropped = 0
+
+    def matches(self, values):
+        if self.bbox is not None:
+            min_lon, min_lat, max_lon, max_lat = self.bbox
+            if not any(values[6:10]) or values[6] > max_lon or \
+                    values[7] < min_lon or values[8] > max_lat or \
+                    values[9] < min_lat:
+                return False
+        if self.uids and values[1] not in self.uids:
+            return False
+        tags = values[10] or {}
+        for key, value in self.tags.iteritems():
+            if key not in tags or value is not None and tags[key] != value:
+                return False
+        return True
+
+    def offer(self, event):
+        """Queue an event according to the policy: the drop policy
+        drops the oldest queued event to make room, the block policy
+        waits for room and drops the event itself if there is none in
+        time. Returns whether the event was queued."""
+        if self.policy == "block":
+            try:
+                self.queue.put(event, timeout=config.EVENTS_BLOCK_TIMEOUT)
+                return True
+            except Queue.Full:
+                self._dropped()
+                return False
+        while True:
+            try:
+                self.queue.put_nowait(event)
+                return True
+            except Queue.Full:
+                try:
+                    self.queue.get_nowait()
+                    self._dropped()
+                except Queue.Empty:
+                    pass
+
+    def _dropped(self):
+        self.dropped += 1
+        EVENTS_DROPPED.inc()
+
+    def get(self, timeout=None):
+        """get the next event, or None if there was none within
+        timeout seconds"""
+        try:
+            return self.queue.get(timeout=timeout)
+        except Queue.Empty:
+            return None
+
+    def __iter__(self):
+        while True:
+            yield self.queue.get()
+
+    def close(self):
+        self.bus.unsubscribe(self)
+
+
+class EventBus(object):
+
+    def __init__(self, grid_degrees=config.EVENTS_GRID_DEGREES):
+        self.lock = threading.Lock()
+        self.subscriptions = set()
+        self.grid = GridIndex(grid_degrees)
+        self.by_uid = {}
+        self.by_tag = {}
+        self.unindexed = set()
+
+    def subscribe(self, bbox=None, uids=None, tags=None,
+                  maxsize=config.EVENTS_QUEUE_SIZE, policy="drop",
+                  callback=None):
+        """Subscribe to the changesets matching the filters. With a
+        callback, events are passed to it from a thread of its own;
+        otherwise they are read from the returned subscription."""
+        subscription = Subscription(
+            self, bbox, uids, tags, maxsize, policy)
+        with self.lock:
+            self.subscriptions.add(subscription)
+            if subscription.bbox is not None:
+                self.grid.add(subscription, subscription.bbox)
+            elif subscription.uids:
+                for uid in subscription.uids:
+                    self.by_uid.setdefault(uid, set()).add(subscription)
+            elif subscription.tags:
+                key = sorted(subscription.tags)[0]
+                self.by_tag.setdefault(key, set()).add(subscription)
+            else:
+                self.unindexed.add(subscription)
+        if callback is not None:
+            thread = threading.Thread(
+                target=_deliver, args=(subscription, callback))
+            thread.daemon = True
+            thread.start()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            if subscription not in self.subscriptions:
+                return
+            self.subscriptions.discard(subscription)
+            if subscription.bbox is not None:
+                self.grid.remove(subscription, subscription.bbox)
+            elif subscription.uids:
+                for uid in subscription.uids:
+                    _discard(self.by_uid, uid, subscription)
+            elif subscription.tags:
+                _discard(
+                    self.by_tag, sorted(subscription.tags)[0], subscription)
+            else:
+                self.unindexed.discard(subscription)
+
+    def candidates(self, values):
+        """get the subscriptions that may match an insert-ready tuple"""
+        bounds = values[6:10]
+        found = set(self.unindexed)
+        if any(bounds):
+            found.update(self.grid.query(
+                (bounds[0], bounds[2], bounds[1], bounds[3])))
+        found.update(self.by_uid.get(values[1], ()))
+        for key in values[10] or ():
+            found.update(self.by_tag.get(key, ()))
+        return found
+
+    def publish(self, sequence, changesets):
+        """Queue every changeset for the subscriptions it matches.
+        Returns the number of events queued."""
+        deliveries = []
+        with self.lock:
+            if not self.subscriptions:
+                return 0
+            for values in changesets:
+                matched = [subscription for subscription
+                           in self.candidates(values)
+                           if subscription.matches(values)]
+                if matched:
+                    deliveries.append((values, matched))
+        delivered = 0
+        for values, matched in deliveries:
+            event = changeset_event(sequence, values)
+            for subscription in matched:
+                if subscription.offer(event):
+                    delivered += 1
+        EVENTS_DELIVERED.inc(delivered)
+        return delivered
+
+    def on_diff(self, sequence, changesets):
+        """replication listener publishing every applied diff"""
+        self.publish(sequence, changesets)
+
+    def attach(self):
+        """publish every diff the follower applies in this process from
+        now on"""
+        import replication
+        replication.add_listener(self.on_diff)
+
+    def detach(self):
+        import replication
+        replication.remove_listener(self.on_diff)
+
+
+def _discard(index, key, subscription):
+    subscriptions = index.get(key)
+    if subscriptions is not None:
+        subscriptions.discard(subscription)
+        if not subscriptions:
+            del index[key]
+
+
+def _deliver(subscription, callback):
+    for event in subscription:
+        try:
+            callback(event)
+        except Exception as e:
+            import helpers
+            helpers.handle_error(e, bail=False)
+
+
+def parse_filters(query):
+    """Get the subscribe arguments from an /events query string, with
+    bbox as min_lon,min_lat,max_lon,max_lat, uid as comma separated ids,
+    tag as key or key=value, repeated for more tags, and policy as drop
+    or block. Raises ValueError for malformed values."""
+    params = urlparse.parse_qs(query)
+    filters = {}
+    if "bbox" in params:
+        bbox = [float(value) for value in params["bbox"][-1].split(",")]
+        if len(bbox) != 4:
+            raise ValueError("bbox needs four coordinates")
+        filters["bbox"] = bbox
+    if "uid" in params:
+        filters["uids"] = [
+            int(uid) for value in params["uid"] for uid in value.split(",")]
+    if "tag" in params:
+        filters["tags"] = dict(
+            (value.split("=", 1) + [None])[:2] for value in params["tag"])
+    if "policy" in params:
+        if params["policy"][-1] not in POLICIES:
+            raise ValueError("policy must be drop or block")
+        filters["policy"] = params["policy"][-1]
+    return filters
+
+
+class EventsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        if url.path != "/events":
+            self.send_error(404)
+            return
+        try:
+            filters = parse_filters(url.query)
+        except ValueError as e:
+            self.send_error(400, str(e))
+            return
+        subscription = self.server.bus.subscribe(**filters)
+        try:
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Cache-Control", "no-cache")
+            self.end_headers()
+            self.wfile.flush()
+            while True:
+                event = subscription.get(config.EVENTS_KEEPALIVE)
+                if event is None:
+                    self.wfile.write(": keepalive\n\n")
+                else:
+                    self.wfile.write(
+                        "id: {sequence}\nevent: changeset\n"
+                        "data: {data}\n\n".format(
+                            sequence=event["sequence"],
+                            data=json.dumps(event)))
+                self.wfile.flush()
+        except socket.error:
+            pass
+        finally:
+            subscription.close()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class EventsServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, address, bus):
+        BaseHTTPServer.HTTPServer.__init__(self, address, EventsHandler)
+        self.bus = bus
+
+
+def serve(bus, port, host="127.0.0.1"):
+    """serve /events on a local port from a daemon thread"""
+    server = EventsServer((host, port), bus)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def start(port=config.EVENTS_PORT):
+    """publish the diffs the follower applies and, unless port is None
+    or 0, serve them as Server-Sent Events"""
+    bus = get_bus()
+    bus.attach()
+    if port:
+        serve(bus, port)
+    return bus
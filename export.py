@@ -0,0 +1,180 @@
+"""Export changesets to Parquet for analysis with pandas or Arrow.
+
+Rows are streamed out of the changesets table through a server-side
+cursor, config.EXPORT_BATCH_SIZE at a time, turned into Arrow record
+batches column by column and appended to one Parquet file per month, in
+year=YYYY/month=MM directories that pyarrow and pandas read as a
+partitioned dataset. Every month is read with its own query, which only
+touches that month's partition, so memory stays at about one batch no
+matter how much is exported. Timestamps are stored as int64 microseconds
+since the epoch in UTC. Tags are a map column with pyarrow 1.0 and later;
+pyarrow 0.16, the last release for Python 2, cannot write maps, so there
+they are two list columns, tag_keys and tag_values (see tags_fields).
+
+pyarrow is only needed here, and only imported once an export starts."""
+import os
+from datetime import datetime, timedelta
+from distutils.version import LooseVersion
+import config
+from changesetstore import months, next_month
+from timeutil import UTC, as_utc
+
+EXPORT_COLUMNS = (
+    "id", "uid", "username",
+    "(extract(epoch FROM created_at) * 1000000)::bigint",
+    "(extract(epoch FROM closed_at) * 1000000)::bigint",
+    "num_changes", "min_lon", "max_lon", "min_lat", "max_lat", "tags")
+
+
+def tags_fields(pa):
+    """Get the Arrow fields holding the tags: a map from key to value
+    with pyarrow 1.0 and later. Older versions cannot write maps, or
+    lists of key/value structs, to Parquet, so there the keys and the
+    values go into two lists of the same length instead."""
+    if LooseVersion(pa.__version__) >= LooseVersion("1.0"):
+        return [pa.field("tags", pa.map_(pa.string(), pa.string()))]
+    return [pa.field("tag_keys", pa.list_(pa.string())),
+            pa.field("tag_values", pa.list_(pa.string()))]
+
+
+def arrow_schema(pa):
+    timestamp = pa.timestamp("us", tz="UTC")
+    return pa.schema([
+        pa.field("id", pa.int64(), nullable=False),
+        pa.field("uid", pa.int32()),
+        pa.field("username", pa.string()),
+        pa.field("created_at", timestamp, nullable=False),
+        pa.field("closed_at", timestamp),
+        pa.field("num_changes", pa.int32()),
+        pa.field("min_lon", pa.float64()),
+        pa.field("max_lon", pa.float64()),
+        pa.field("min_lat", pa.float64()),
+        pa.field("max_lat", pa.float64())] + tags_fields(pa))
+
+
+def tags_arrays(pa, column):
+    """build the tags columns from flat key and value arrays and their
+    offsets, without an Arrow object per tag"""
+    offsets = [0]
+    keys = []
+    values = []
+    for tags in column:
+        if tags:
+            keys.extend(tags.iterkeys())
+            values.extend(tags.itervalues())
+        offsets.append(len(keys))
+    offsets = pa.array(offsets, type=pa.int32())
+    keys = pa.array(keys, type=pa.string())
+    values = pa.array(values, type=pa.string())
+    if len(tags_fields(pa)) == 1:
+        return [pa.MapArray.from_arrays(offsets, keys, values)]
+    return [pa.ListArray.from_arrays(offsets, keys),
+            pa.ListArray.from_arrays(offsets, values)]
+
+
+def record_batch(pa, schema, rows):
+    """turn rows selected as EXPORT_COLUMNS into a record batch"""
+    columns = zip(*rows)
+    arrays = [pa.array(column, type=field.type)
+              for column, field in zip(columns[:-1], schema)]
+    arrays.extend(tags_arrays(pa, columns[-1]))
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def partition_path(directory, year, month):
+    return os.path.join(
+        directory,
+        "year={year:04d}".format(year=year),
+        "month={month:02d}".format(month=month),
+        "part-0.parquet")
+
+
+def _window(cursor, since, until):
+    """fill in an open start or end of the export window from the
+    oldest and newest changesets"""
+    if since is None or until is None:
+        cursor.execute(
+            "SELECT min(created_at), max(created_at) FROM {table}".format(
+                table=config.TABLENAME))
+        first, last = cursor.fetchone()
+        if first is None:
+            return None, None
+        since = since or first
+        until = until or last + timedelta(microseconds=1)
+    return since, until
+
+
+def export_month(connection, pa, pq, schema, path, since, until,
+                 bbox=None, batch_size=config.EXPORT_BATCH_SIZE,
+                 compression=config.EXPORT_COMPRESSION):
+    """Write the changesets created in [since, until) to a Parquet
+    file at path, one row group per batch, and return how many there
+    were. The file is written under a temporary name and only renamed
+    to path once it is complete; none is written for an empty
+    window."""
+    conditions = ["created_at >= %s", "created_at < %s"]
+    params = [since, until]
+    if bbox is not None:
+        conditions.append("bbox && box(point(%s, %s), point(%s, %s))")
+        params.extend(bbox)
+    cursor = connection.cursor("export")
+    cursor.itersize = batch_size
+    cursor.execute(
+        "SELECT {columns} FROM {table} WHERE {conditions}".format(
+            columns=", ".join(EXPORT_COLUMNS),
+            table=config.TABLENAME,
+            conditions=" AND ".join(conditions)),
+        params)
+    writer = None
+    exported = 0
+    try:
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            if writer is None:
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                writer = pq.ParquetWriter(
+                    path + ".incoming", schema, compression=compression)
+            writer.write_table(pa.Table.from_batches(
+                [record_batch(pa, schema, rows)]))
+            exported += len(rows)
+    finally:
+        cursor.close()
+        if writer is not None:
+            writer.close()
+    if writer is not None:
+        os.rename(path + ".incoming", path)
+    return exported
+
+
+def export(connection, directory, since=None, until=None, bbox=None,
+           batch_size=config.EXPORT_BATCH_SIZE,
+           compression=config.EXPORT_COMPRESSION):
+    """Export the changesets created in [since, until), by default all
+    of them, and optionally only those whose bbox intersects bbox, given
+    as (min_lon, min_lat, max_lon, max_lat), to monthly Parquet files
+    under directory. Naive since and until are taken to be in UTC.
+    Yields (path, rows) for every file written."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    schema = arrow_schema(pa)
+    since, until = _window(connection.cursor(), since, until)
+    if since is None:
+        return
+    since = as_utc(since)
+    until = as_utc(until)
+    for year, month in months((since.year, since.month),
+                              (until.year, until.month)):
+        start = datetime(year, month, 1, tzinfo=UTC)
+        end = datetime(*next_month(year, month) + (1,), tzinfo=UTC)
+        if end <= since or start >= until:
+            continue
+        path = partition_path(directory, year, month)
+        exported = export_month(
+            connection, pa, pq, schema, path,
+            max(start, since), min(end, until), bbox, batch_size,
+            compression)
+        if exported:
+            yield path, exported
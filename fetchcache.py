@@ -0,0 +1,212 @@
+"""On-disk cache for immutable downloads: the sequence-addressed minutely
+diffs and their state files, and the osmChange documents of closed
+changesets. Anything that can still change, such as the current state,
+changeset metadata or the current version of an element, must not go
+through it, as entries are served for as long as they are cached.
+
+Entries are keyed by the SHA-1 of their URL and stored compressed:
+bodies that already are gzip (the .osm.gz diffs) are kept as they are,
+anything else is gzipped on the way in. Downloads are written to the
+cache as they stream through, so they are never held in memory whole.
+The least recently used entries are evicted once the cache grows past
+its size limit; reading an entry counts as using it. The entries and
+their sizes are indexed in memory in order of use, starting from their
+modification times when the cache is opened, so evicting never lists
+the directory. Entries can be read through mmap so a replay reads
+straight from the page cache."""
+import gzip
+import hashlib
+import mmap
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from cStringIO import StringIO
+import config
+import metrics
+
+GZIP_MAGIC = '\x1f\x8b'
+
+_cache = None
+
+
+def _stat(name):
+    return _cache.stats()[name] if _cache is not None else 0
+
+
+for _result, _name in (("hit", "hits"), ("miss", "misses")):
+    metrics.gauge(
+        "fetch_cache_lookups",
+        "Downloads looked up in the fetch cache, by whether they were "
+        "cached.",
+        func=lambda name=_name: _stat(name), result=_result)
+
+for _direction, _name in (("read", "bytes_read"),
+                          ("written", "bytes_written")):
+    metrics.gauge(
+        "fetch_cache_bytes",
+        "Bytes of cache entries read and written, as stored on disk.",
+        func=lambda name=_name: _stat(name), direction=_direction)
+
+metrics.gauge(
+    "fetch_cache_evictions", "Entries evicted from the fetch cache.",
+    func=lambda: _stat("evictions"))
+
+metrics.gauge(
+    "fetch_cache_size_bytes", "Bytes the fetch cache holds on disk.",
+    func=lambda: _stat("size"))
+
+
+def get_cache():
+    """Get the process wide cache, or None when config.FETCH_CACHE_DIR
+    is not set."""
+    global _cache
+    if _cache is None and config.FETCH_CACHE_DIR:
+        _cache = FetchCache(
+            config.FETCH_CACHE_DIR,
+            config.FETCH_CACHE_MAX_BYTES,
+            config.FETCH_CACHE_MMAP)
+    return _cache
+
+
+class FetchCache(object):
+
+    def __init__(self, directory, max_bytes, use_mmap=True):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.use_mmap = use_mmap
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.evictions = 0
+        self.size = 0
+        self.entries = OrderedDict()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        entries = []
+        for path in self._entries():
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, path, stat.st_size))
+        for _, path, size in sorted(entries):
+            self._use(path, size)
+
+    def _path(self, url):
+        digest = hashlib.sha1(url).hexdigest()
+        return os.path.join(self.directory, digest[:2], digest[2:])
+
+    def _entries(self):
+        for dirpath, _, filenames in os.walk(self.directory):
+            for filename in filenames:
+                if not filename.startswith('.'):
+                    yield os.path.join(dirpath, filename)
+
+    def open(self, url):
+        """Get a file object with the original body cached for url, or
+        None if it is not cached."""
+        path = self._path(url)
+        for suffix, gzipped in (('.raw', False), ('.gz', True)):
+            try:
+                fd = open(path + suffix, 'rb')
+            except IOError:
+                continue
+            with fd:
+                os.utime(path + suffix, None)
+                size = os.fstat(fd.fileno()).st_size
+                if self.use_mmap and size:
+                    body = mmap.mmap(
+                        fd.fileno(), 0, access=mmap.ACCESS_READ)
+                else:
+                    body = StringIO(fd.read())
+            with self.lock:
+                self.hits += 1
+                self.bytes_read += size
+                self._use(path + suffix, size)
+            if gzipped:
+                return gzip.GzipFile(fileobj=body, mode='rb')
+            return body
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, url, body):
+        """Store the body downloaded from url."""
+        for _ in self.store(url, [body]):
+            pass
+
+    def store(self, url, chunks):
+        """Pass on the chunks of the body downloaded from url, writing
+        them to the cache as they go through. The entry is only added
+        once the last chunk has been passed on, so a download that
+        fails or is not read to the end is never cached."""
+        path = self._path(url)
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                pass
+        fd, temp = tempfile.mkstemp(dir=directory, prefix='.incoming')
+        out = os.fdopen(fd, 'wb')
+        writer = None
+        try:
+            for chunk in chunks:
+                if writer is None:
+                    if chunk.startswith(GZIP_MAGIC):
+                        path += '.raw'
+                        writer = out
+                    else:
+                        path += '.gz'
+                        writer = gzip.GzipFile(
+                            filename='', mode='wb', fileobj=out)
+                writer.write(chunk)
+                yield chunk
+            if writer is None:
+                path += '.gz'
+                writer = gzip.GzipFile(filename='', mode='wb', fileobj=out)
+            if writer is not out:
+                writer.close()
+            out.close()
+            size = os.path.getsize(temp)
+            os.rename(temp, path)
+            temp = None
+        finally:
+            out.close()
+            if temp is not None:
+                os.remove(temp)
+        with self.lock:
+            self.bytes_written += size
+            self._use(path, size)
+            if self.size > self.max_bytes:
+                self._evict()
+
+    def _use(self, path, size):
+        """index path as the most recently used entry, replacing what
+        was indexed for it before"""
+        self.size += size - self.entries.pop(path, 0)
+        self.entries[path] = size
+
+    def _evict(self):
+        """drop least recently used entries until the cache is back
+        under nine tenths of its limit"""
+        while self.entries and self.size > self.max_bytes * 0.9:
+            path, size = self.entries.popitem(last=False)
+            self.size -= size
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self.evictions += 1
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "bytes_read": self.bytes_read,
+            "bytes_written": self.bytes_written,
+            "evictions": self.evictions,
+            "size": self.size}
@@ -1,12 +1,19 @@
 import config
+import json
 import requests
 import os
 import sys
 import xml.etree.ElementTree as ET
 import database
+import fetchcache
+import osm
+from osm import Planet, get_session
+from streams import open_gzip_url, open_url
+from timeutil import parse_timestamp
 
 osmtypes = ["node", "way", "relation"]
 actions = ["create", "modify", "delete"]
+bbox_keys = ["min_lon", "max_lon", "min_lat", "max_lat"]
 
 
 def get_connection_string():
@@ -21,37 +28,14 @@ def get_connection_string():
 def get_current_state_from_server():
     """Get the current state from the OSM server, including the current
     delta sequence number, and the last run time."""
-    # I dislike PyYAML, that is why
-    from dateutil.parser import parse
-    current_state_file_url =\
-        "http://planet.openstreetmap.org/replication/changesets/state.yaml"
-    state_file = requests.get(current_state_file_url).text
-    current_state = {}
-    for line in state_file.split('\n'):
-        elems = line.split(':')
-        if len(elems) > 1:
-            current_state[elems[0].strip()] = ":".join(elems[1:]).strip()
-    if not 'last_run' and 'sequence' in current_state:
-        return {}
-    current_state['sequence'] = int(current_state['sequence'])
-    current_state['last_run'] = parse(current_state['last_run'])
-    return current_state
+    return Planet.get_current_state()
 
 
 def get_changeset_path_for(utctime):
-    """Given an UTC timestamp, get the path for what is likely to be
-    the corresponding changeset minutely delta. This may break down when
-    the minutely updates were interrupted, but it will always return a
-    path to a file that has changesets for the given timestamp or before,
-    guaranteed not after."""
-    from math import floor
-    current_state = get_current_state_from_server()
-    if 'last_run' not in current_state:
-        return ""
-    minutes = int(floor(
-        (current_state['last_run'] - utctime).total_seconds() / 60))
-    rem = current_state['sequence'] - minutes
-    return path_for_sequence(rem)
+    """Given an UTC timestamp, get the path for the changeset minutely
+    delta published last at or before it, which has changesets for the
+    given timestamp or before, guaranteed not after."""
+    return Planet.get_changeset_path_for(utctime)
 
 
 def path_for_sequence(sequence_number):
@@ -63,50 +47,35 @@ def path_for_sequence(sequence_number):
         sequence_number = (sequence_number - sequence_number % 1000) / 1000
     while len(parts) < 3:
         parts.insert(0, "000")
-    parts.insert(0, "http://planet.osm.org/replication/changesets/")
+    parts.insert(0, config.PLANET_BASE_URL + "replication/changesets/")
     return '{path}.osm.gz'.format(path=os.path.join(*parts))
 
 
-def changesets_for_minutely(sequence_number):
-    """Read a minutely changeset file and resurn the changesets
-    containted within it as an elementtree object"""
-    import gzip
-    chunk_size = 1024
-    tempfile = os.path.join(config.TMP_DIR, 'temp.gz')
+def changesets_for_minutely(sequence_number, session=None):
+    """Read a minutely changeset file and return the changesets
+    contained within it as a list of dicts, decompressing and parsing
+    it while it downloads"""
     path = path_for_sequence(sequence_number)
-    changesets = []
-    with open(tempfile, 'wb') as fd:
-        for chunk in requests.get(path).iter_content(chunk_size):
-            fd.write(chunk)
-    with gzip.open(tempfile) as changeset_xml:
-        for event, elem in ET.iterparse(changeset_xml):
-            if event == "end" and elem.tag == "changeset":
-                changesets.append(
-                    get_changeset_values_as_dict(elem))
-    return changesets
+    changeset_xml = open_gzip_url(
+        session or get_session(), path, fetchcache.get_cache())
+    return list(iter_changesets(changeset_xml))
 
 
 def backfill_changeset_database():
     """Make the changeset database catch up."""
-    # get latest changeset in db
-    latest_changeset_in_local_db = database.get_latest_changeset()
-    # figure out which changeset minutely to fetch first
-    first_changeset_to_fetch =\
-        get_changeset_path_for(latest_changeset_in_local_db)
-    # enqueue fetching changeset minutelies to process
-    print first_changeset_to_fetch
+    import replication
+    return replication.catch_up_once()
 
 
 def get_changeset_values_as_dict(elem):
     """Parse a changeset XML element from the OSM changeset
     metadata file into a tuple of values ready to insert into
     the changeset database schema"""
-    from dateutil.parser import parse
     tags = {}
     changeset = {}
     for key in elem.attrib:
         if key in ['created_at', 'closed_at']:
-            changeset[key] = parse(elem.attrib[key])
+            changeset[key] = parse_timestamp(elem.attrib[key])
         else:
             changeset[key] = elem.attrib[key]
     for child in elem:
@@ -138,7 +107,7 @@ def as_tuple(changeset):
     else:
         values.append(None)
     # add bbox if present
-    if "min_lon" and "max_lon" and "min_lat" and "max_lat" in changeset:
+    if all(key in changeset for key in bbox_keys):
         values.extend([
             float(changeset["min_lon"]),
             float(changeset["max_lon"]),
@@ -153,6 +122,48 @@ def as_tuple(changeset):
     return tuple(values)
 
 
+def iter_changesets(changeset_xml):
+    """Stream changeset dicts out of a changeset metadata XML file
+    object, with the same streaming parser as osm.iter_changesets."""
+    return osm.iter_changesets(changeset_xml, get_changeset_values_as_dict)
+
+
+def _copy_escape(value):
+    """escape a text value for the PostgreSQL COPY text format"""
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return value.replace('\\', '\\\\').replace('\t', '\\t')\
+        .replace('\n', '\\n').replace('\r', '\\r')
+
+
+def as_copy_line(values):
+    """get a line for COPY ... FROM STDIN from an insert-ready tuple"""
+    fields = []
+    for value in values:
+        if value is None:
+            fields.append('\\N')
+        elif isinstance(value, dict):
+            fields.append(_copy_escape(json.dumps(value, ensure_ascii=False)))
+        elif isinstance(value, basestring):
+            fields.append(_copy_escape(value))
+        elif hasattr(value, 'isoformat'):
+            fields.append(value.isoformat())
+        elif isinstance(value, float):
+            fields.append(repr(value))
+        else:
+            fields.append(str(value))
+    return '\t'.join(fields) + '\n'
+
+
+def as_box(values):
+    """get a PostgreSQL box literal for the bbox of an insert-ready
+    tuple, or None for changesets without a bbox"""
+    bounds = values[6:10]
+    if not any(bounds):
+        return None
+    return "({0!r},{2!r}),({1!r},{3!r})".format(*bounds)
+
+
 def analyze_changeset(elementtree):
     """get created, modified, deleted nodes, ways, relations
     for a changeset xml object"""
@@ -169,15 +180,67 @@ def analyze_changeset(elementtree):
     return result
 
 
-def get_changeset_details_from_osm(changeset_id):
-    """gets the full changeset from the OSM API and returns it as a dict"""
+def analyze_changeset_stream(osmchange_xml, details=False):
+    """Count created, modified and deleted nodes, ways and relations in
+    an osmChange file object in a single pass. The document is fed to
+    expat as it is read and no tree is ever built, so memory stays
+    constant however large the changeset is. The counts have the same
+    shape as analyze_changeset. With details, also collect the ids per
+    action and osmtype and, per action, how many elements carry each
+    tag key, and return (counts, details)."""
+    from xml.parsers import expat
+    result = dict(
+        (action, dict((osmtype, 0) for osmtype in osmtypes))
+        for action in actions)
+    ids = dict(
+        (action, dict((osmtype, []) for osmtype in osmtypes))
+        for action in actions)
+    tag_keys = dict((action, {}) for action in actions)
+    # depth, the action being read, and the tag counts of the element
+    # being read if it is counted with details
+    state = [0, None, None]
+
+    def start_element(name, attrs):
+        depth = state[0]
+        state[0] = depth + 1
+        if depth == 1:
+            state[1] = name if name in result else None
+        elif depth == 2:
+            action = state[1]
+            if action is not None and name in osmtypes:
+                result[action][name] += 1
+                if details:
+                    ids[action][name].append(int(attrs["id"]))
+                    state[2] = tag_keys[action]
+        elif depth == 3 and state[2] is not None and name == "tag":
+            keys = state[2]
+            key = attrs["k"]
+            keys[key] = keys.get(key, 0) + 1
+
+    def end_element(name):
+        state[0] -= 1
+        if state[0] == 2:
+            state[2] = None
+
+    parser = expat.ParserCreate()
+    parser.StartElementHandler = start_element
+    parser.EndElementHandler = end_element
+    parser.ParseFile(osmchange_xml)
+    if details:
+        return result, {"ids": ids, "tags": tag_keys}
+    return result
+
+
+def get_changeset_details_from_osm(changeset_id, closed=False):
+    """gets the full changeset from the OSM API and returns it as a dict.
+    Only the download of a changeset known to be closed is cached."""
     url = os.path.join(
         config.OSM_API_BASE_URL,
         'changeset',
-        changeset_id,
+        str(changeset_id),
         'download')
-    response = requests.get(url)
-    return analyze_changeset(ET.fromstring(response.content))
+    return analyze_changeset_stream(open_url(
+        get_session(), url, fetchcache.get_cache() if closed else None))
 
 
 def resolve_user(changeset):
@@ -1,9 +1,11 @@
 import argparse
 import os
+import config
 from sys import stdout, exit
 from changesetstore import ChangesetStore
 from helpers import handle_error
 
+
 def wipe_database(args):
     print "going to wipe database..."
     raw_input("press ^C now if you don't want "
@@ -30,19 +32,225 @@ def load_database(args):
 
     try:
         processed = ChangesetStore.parse_xml_file(
-            args.changesetfile, args.limit)
+            args.changesetfile, args.limit, args.workers)
     except IOError as e:
         handle_error(e)
     print "\ndone. {counter} changesets processed.".format(counter=processed)
 
 
-def make_database_catch_up():
-    pass
+def start_scoring():
+    if config.SCORING_ENABLED:
+        import scoring
+        scoring.get_engine().attach()
+
+
+def make_database_catch_up(args):
+    print "going to catch up with the minutely changeset diffs..."
+    import replication
+    start_scoring()
+    try:
+        applied = replication.catch_up_once(args.concurrency)
+    except IOError as e:
+        handle_error(e)
+    print "done. {counter} diffs applied.".format(counter=applied)
+
+
+def follow_replication(args):
+    print "following the minutely changeset diffs, ^C to stop..."
+    import replication
+    start_scoring()
+    if args.events_port:
+        import events
+        events.start(args.events_port)
+        print "serving changeset events on http://127.0.0.1:{port}/events"\
+            .format(port=args.events_port)
+    if args.columnar_days:
+        import columnar
+        store = columnar.start(args.columnar_days)
+        print "keeping {count} changesets of the last {days:g} days in "\
+            "memory".format(count=len(store), days=args.columnar_days)
+    replication.follow(args.interval, args.concurrency)
+
+
+def enrich_changesets(args):
+    import database
+    import enrichment
+    with database.pooled_connection() as connection:
+        changeset_ids = enrichment.pending_changesets(
+            connection.cursor(), args.limit)
+        print "enriching {count} changesets...".format(
+            count=len(changeset_ids))
+        enriched, missing, failed = enrichment.enrich(
+            connection, changeset_ids, args.workers, args.rate)
+    print "done. {enriched} enriched, {missing} missing, {failed} failed."\
+        .format(enriched=enriched, missing=missing, failed=failed)
+
+
+def report(args):
+    import database
+    import rollups
+    from datetime import date, timedelta
+    from timeutil import parse_timestamp
+    until = args.until and parse_timestamp(args.until).date() or \
+        date.today() + timedelta(days=1)
+    since = args.since and parse_timestamp(args.since).date() or \
+        until - timedelta(days=30)
+    with database.pooled_connection() as connection:
+        if args.rebuild:
+            print "rebuilding the rollups..."
+            rollups.rebuild(connection)
+        cursor = connection.cursor()
+        if args.hashtag:
+            for day, changesets, edits in rollups.hashtag_report(
+                    cursor, args.hashtag, since, until):
+                print "{day}\t{changesets}\t{edits}".format(
+                    day=day.isoformat(), changesets=changesets, edits=edits)
+        else:
+            for editor, changesets, edits in rollups.editor_report(
+                    cursor, since, until, args.limit):
+                print u"{editor}\t{changesets}\t{edits}".format(
+                    editor=editor.decode('utf-8'),
+                    changesets=changesets,
+                    edits=edits).encode('utf-8')
+
+
+def user_history(args):
+    import database
+    import users
+    from timeutil import parse_timestamp
+    after = None
+    if args.after:
+        created_at, changeset_id = args.after.split(',')
+        after = (parse_timestamp(created_at), int(changeset_id))
+    with database.pooled_connection() as connection:
+        cursor = connection.cursor()
+        summary = users.get_user(cursor, args.uid)
+        if summary is None:
+            print "user {uid} was never seen.".format(uid=args.uid)
+            return
+        print "{1} ({0}): {4} changesets, {5} edits, " \
+            "first seen {2:%Y-%m-%d}, last seen {3:%Y-%m-%d}".format(
+                *summary)
+        changesets, after = users.user_changesets(
+            cursor, args.uid, after, args.limit)
+        for changeset in changesets:
+            print "{id}\t{created_at}\t{num_changes}".format(
+                id=changeset.id,
+                created_at=changeset.created_at.isoformat()
+                if changeset.created_at else '',
+                num_changes=changeset.num_changes)
+        if after:
+            print "next page: --after {created_at},{id}".format(
+                created_at=after[0].isoformat(), id=after[1])
+
+
+def list_new_users(args):
+    import database
+    import users
+    from datetime import datetime, timedelta
+    from timeutil import UTC, as_utc, parse_timestamp
+    since = args.since and as_utc(parse_timestamp(args.since)) or \
+        datetime.now(UTC).replace(hour=0, minute=0, second=0, microsecond=0)
+    until = args.until and as_utc(parse_timestamp(args.until)) or \
+        since + timedelta(days=1)
+    with database.pooled_connection() as connection:
+        for uid, username, first_seen, changesets, edits in users.new_users(
+                connection.cursor(), since, until, args.limit):
+            print "{uid}\t{username}\t{first_seen}\t{changesets}\t{edits}"\
+                .format(
+                    uid=uid,
+                    username=username,
+                    first_seen=first_seen.isoformat(),
+                    changesets=changesets,
+                    edits=edits)
+
+
+def list_alerts(args):
+    import alerts
+    import database
+    from datetime import datetime, timedelta
+    from timeutil import UTC, as_utc, parse_timestamp
+    until = args.until and as_utc(parse_timestamp(args.until)) or \
+        datetime.now(UTC)
+    since = args.since and as_utc(parse_timestamp(args.since)) or \
+        until - timedelta(days=1)
+    with database.pooled_connection() as connection:
+        for changeset_id, uid, username, score, rules, detected_at in \
+                alerts.top_changesets(
+                    connection.cursor(), since, until, args.limit):
+            print "{id}\t{score}\t{uid}\t{username}\t{rules}\t{detected_at}"\
+                .format(
+                    id=changeset_id,
+                    score=score,
+                    uid=uid,
+                    username=username,
+                    rules=",".join(rules),
+                    detected_at=detected_at.isoformat())
+
+
+def detach_partitions(args):
+    import database
+    from datetime import datetime
+    before = datetime.strptime(args.before, "%Y-%m")
+    with database.pooled_connection() as connection:
+        detached = ChangesetStore.detach_partitions(
+            connection.cursor(), before.year, before.month)
+        connection.commit()
+    for name in detached:
+        print name
+    print "done. {count} partitions detached.".format(count=len(detached))
+
+
+def query_database(args):
+    import database
+    from timeutil import as_utc, parse_timestamp
+    since = args.since and as_utc(parse_timestamp(args.since))
+    until = args.until and as_utc(parse_timestamp(args.until))
+    with database.pooled_connection() as connection:
+        for changeset in ChangesetStore.query_bbox(
+                connection, args.bbox, since, until, args.limit):
+            print u"{id}\t{created_at}\t{num_changes}\t{user}".format(
+                id=changeset.id,
+                created_at=changeset.created_at.isoformat()
+                if changeset.created_at else '',
+                num_changes=changeset.num_changes,
+                user=changeset.user.decode('utf-8')).encode('utf-8')
+
+
+def export_changesets(args):
+    import database
+    import export
+    import time
+    from timeutil import parse_timestamp
+    since = args.since and parse_timestamp(args.since)
+    until = args.until and parse_timestamp(args.until)
+    total = 0
+    started = time.time()
+    with database.pooled_connection() as connection:
+        for path, exported in export.export(
+                connection, args.directory, since, until, args.bbox,
+                args.batch_size):
+            total += exported
+            print "{path}: {exported} changesets".format(
+                path=path, exported=exported)
+    print "done. {total} changesets exported, {rate:.0f}/s.".format(
+        total=total, rate=total / max(time.time() - started, 0.001))
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         description="Various database management commands to manually"
                     "initialize and control the changesets application")
+    parser.add_argument(
+        '--metrics-port',
+        type=int,
+        default=config.METRICS_PORT,
+        help='serve Prometheus metrics on this local port')
+    parser.add_argument(
+        '--metrics-interval',
+        type=int,
+        default=config.METRICS_LOG_INTERVAL,
+        help='seconds between metrics log lines on stderr, 0 for none')
     subparsers = parser.add_subparsers(
         help="choose between database initialization and loading.")
 
@@ -73,10 +281,234 @@ if __name__ == "__main__":
         '--limit',
         type=int,
         help='limit -- for testing')
+    parser_load.add_argument(
+        '--workers',
+        type=int,
+        default=1,
+        help='number of processes to load a multi-stream bz2 file with')
     parser_load.add_argument(
         '-test',
         action='store_true',
         help='small sample data test')
 
+    # the catch up subcommand
+    parser_catchup = subparsers.add_parser(
+        "catchup",
+        help="apply all minutely changeset diffs published since the "
+        "last one that was applied, then exit")
+    parser_catchup.set_defaults(func=make_database_catch_up)
+    parser_catchup.add_argument(
+        '--concurrency',
+        type=int,
+        default=config.BACKFILL_CONCURRENCY,
+        help='number of diffs to download at the same time')
+
+    # the follow subcommand
+    parser_follow = subparsers.add_parser(
+        "follow",
+        help="keep applying minutely changeset diffs as they are "
+        "published. Resumes from the last applied diff after a restart.")
+    parser_follow.set_defaults(func=follow_replication)
+    parser_follow.add_argument(
+        '--interval',
+        type=int,
+        default=config.REPLICATION_POLL_INTERVAL,
+        help='seconds between polls of the replication state')
+    parser_follow.add_argument(
+        '--concurrency',
+        type=int,
+        default=config.BACKFILL_CONCURRENCY,
+        help='number of diffs to download at the same time when behind')
+    parser_follow.add_argument(
+        '--events-port',
+        type=int,
+        default=config.EVENTS_PORT,
+        help='serve the applied changesets as Server-Sent Events on this '
+        'local port')
+    parser_follow.add_argument(
+        '--columnar-days',
+        type=float,
+        default=config.COLUMNAR_DAYS,
+        help='keep the changesets of this many last days in an in-memory '
+        'column store, loaded from the database and then filled with '
+        'every applied diff')
+
+    # the query subcommand
+    parser_query = subparsers.add_parser(
+        "query",
+        help="print the changesets touching a bbox, optionally within "
+        "a time window")
+    parser_query.set_defaults(func=query_database)
+    parser_query.add_argument(
+        '--bbox',
+        required=True,
+        nargs=4,
+        type=float,
+        metavar=('MIN_LON', 'MIN_LAT', 'MAX_LON', 'MAX_LAT'),
+        help='the bbox, as four numbers separated by spaces')
+    parser_query.add_argument(
+        '--since',
+        help='only changesets created at or after this time, UTC unless '
+        'it says otherwise')
+    parser_query.add_argument(
+        '--until',
+        help='only changesets created before this time, UTC unless it '
+        'says otherwise')
+    parser_query.add_argument(
+        '--limit',
+        type=int,
+        help='stop after this many changesets')
+
+    # the enrich subcommand
+    parser_enrich = subparsers.add_parser(
+        "enrich",
+        help="download the osmChange of closed changesets that have not "
+        "been enriched yet and store their create/modify/delete counts")
+    parser_enrich.set_defaults(func=enrich_changesets)
+    parser_enrich.add_argument(
+        '--limit',
+        type=int,
+        default=1000,
+        help='number of changesets to enrich, newest first')
+    parser_enrich.add_argument(
+        '--workers',
+        type=int,
+        default=config.ENRICH_WORKERS,
+        help='number of downloads to run at the same time')
+    parser_enrich.add_argument(
+        '--rate',
+        type=float,
+        default=config.ENRICH_RATE,
+        help='maximum number of API requests per second, 0 for no limit')
+
+    # the report subcommand
+    parser_report = subparsers.add_parser(
+        "report",
+        help="print changesets and edits per editor, or per day for a "
+        "hashtag, from the daily rollups")
+    parser_report.set_defaults(func=report)
+    parser_report.add_argument(
+        '--hashtag',
+        help='report on this hashtag instead of on editors')
+    parser_report.add_argument(
+        '--since',
+        help='first day to report on, defaults to 30 days before --until')
+    parser_report.add_argument(
+        '--until',
+        help='day after the last day to report on, defaults to tomorrow')
+    parser_report.add_argument(
+        '--limit',
+        type=int,
+        help='only the busiest editors')
+    parser_report.add_argument(
+        '--rebuild',
+        action='store_true',
+        help='recompute the rollups from the changesets table first')
+
+    # the user subcommand
+    parser_user = subparsers.add_parser(
+        "user",
+        help="print the summary of a user and a page of their "
+        "changesets, newest first")
+    parser_user.set_defaults(func=user_history)
+    parser_user.add_argument(
+        'uid',
+        type=int,
+        help='the user id')
+    parser_user.add_argument(
+        '--after',
+        help='the next page key printed with the previous page')
+    parser_user.add_argument(
+        '--limit',
+        type=int,
+        default=50,
+        help='number of changesets per page')
+
+    # the newusers subcommand
+    parser_newusers = subparsers.add_parser(
+        "newusers",
+        help="print the users first seen in a time window, today by "
+        "default")
+    parser_newusers.set_defaults(func=list_new_users)
+    parser_newusers.add_argument(
+        '--since',
+        help='start of the window, UTC unless it says otherwise, '
+        'defaults to midnight UTC')
+    parser_newusers.add_argument(
+        '--until',
+        help='end of the window, UTC unless it says otherwise, defaults '
+        'to a day after --since')
+    parser_newusers.add_argument(
+        '--limit',
+        type=int,
+        help='stop after this many users')
+
+    # the alerts subcommand
+    parser_alerts = subparsers.add_parser(
+        "alerts",
+        help="print the changesets the scoring rules fired on, highest "
+        "score first")
+    parser_alerts.set_defaults(func=list_alerts)
+    parser_alerts.add_argument(
+        '--since',
+        help='start of the window, UTC unless it says otherwise, '
+        'defaults to a day before --until')
+    parser_alerts.add_argument(
+        '--until',
+        help='end of the window, UTC unless it says otherwise, defaults '
+        'to now')
+    parser_alerts.add_argument(
+        '--limit',
+        type=int,
+        help='stop after this many changesets')
+
+    # the detach subcommand
+    parser_detach = subparsers.add_parser(
+        "detach",
+        help="detach the monthly partitions of the changesets table "
+        "before a month, leaving them as plain tables to archive or drop")
+    parser_detach.set_defaults(func=detach_partitions)
+    parser_detach.add_argument(
+        '--before',
+        required=True,
+        help='first month to keep, as YYYY-MM')
+
+    # the export subcommand
+    parser_export = subparsers.add_parser(
+        "export",
+        help="write changesets to monthly Parquet files for analysis "
+        "with pandas or Arrow; needs pyarrow",
+        description="Write changesets to monthly Parquet files. Tags are "
+        "a map column with pyarrow 1.0 and later. Older pyarrow, which "
+        "includes 0.16, the last release for Python 2, cannot write "
+        "maps, so there the tags are two list columns of the same "
+        "length, tag_keys and tag_values.")
+    parser_export.set_defaults(func=export_changesets)
+    parser_export.add_argument(
+        'directory',
+        help='directory to write the year=/month= partitions to')
+    parser_export.add_argument(
+        '--since',
+        help='only changesets created at or after this time, UTC unless '
+        'it says otherwise')
+    parser_export.add_argument(
+        '--until',
+        help='only changesets created before this time, UTC unless it '
+        'says otherwise')
+    parser_export.add_argument(
+        '--bbox',
+        nargs=4,
+        type=float,
+        metavar=('MIN_LON', 'MIN_LAT', 'MAX_LON', 'MAX_LAT'),
+        help='only changesets touching this bbox, as four numbers '
+        'separated by spaces')
+    parser_export.add_argument(
+        '--batch-size',
+        type=int,
+        default=config.EXPORT_BATCH_SIZE,
+        help='rows per record batch and Parquet row group')
+
     args = parser.parse_args()
+    import metrics
+    metrics.start(args.metrics_port, args.metrics_interval)
     args.func(args)
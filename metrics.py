@@ -0,0 +1,303 @@
+"""Counters, gauges and latency histograms for the loading and
+replication pipeline, served in the Prometheus text format and
+summarized in a periodic log line.
+
+Time is also accounted per pipeline stage: every thread has a current
+stage, and enter switches it, charging the time since the previous
+switch to the stage that was current. Because a stage that reads from
+another one (parse reading decompressed data, decompress reading from
+the network) switches to it for the duration of the read, the totals are
+exclusive, and the stage with the largest share is the one limiting
+throughput."""
+import threading
+import time
+import weakref
+import BaseHTTPServer
+from contextlib import contextmanager
+from sys import stderr
+import config
+
+STAGES = ("fetch", "decompress", "parse", "convert", "db_write")
+
+DEFAULT_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+    5.0, 10.0, 30.0)
+
+_lock = threading.Lock()
+_families = {}
+_stage_totals = {}
+_finished_totals = dict.fromkeys(STAGES, 0.0)
+_local = threading.local()
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(
+        '{0}="{1}"'.format(key, value)
+        for key, value in sorted(labels.iteritems())) + "}"
+
+
+def _register(kind, name, help, metric):
+    with _lock:
+        family = _families.setdefault(name, (kind, help, []))
+        family[2].append(metric)
+    return metric
+
+
+class Counter(object):
+
+    def __init__(self, labels):
+        self.labels = labels
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def samples(self, name):
+        yield name, self.labels, self.value
+
+
+class Gauge(object):
+    """a value that is set, or computed by func when it is read"""
+
+    def __init__(self, labels, func=None):
+        self.labels = labels
+        self.value = 0
+        self.func = func
+
+    def set(self, value):
+        self.value = value
+
+    def get(self):
+        if self.func is not None:
+            return self.func()
+        return self.value
+
+    def samples(self, name):
+        yield name, self.labels, self.get()
+
+
+class Histogram(object):
+
+    def __init__(self, labels, buckets=DEFAULT_BUCKETS):
+        self.labels = labels
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        with self.lock:
+            self.count += 1
+            self.sum += value
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[index] += 1
+                    break
+
+    @contextmanager
+    def time(self):
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - started)
+
+    def samples(self, name):
+        with self.lock:
+            counts = list(self.counts)
+            count, total = self.count, self.sum
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, counts):
+            cumulative += bucket_count
+            labels = dict(self.labels, le=repr(bound))
+            yield name + "_bucket", labels, cumulative
+        yield name + "_bucket", dict(self.labels, le="+Inf"), count
+        yield name + "_sum", self.labels, total
+        yield name + "_count", self.labels, count
+
+
+def counter(name, help, **labels):
+    return _register("counter", name, help, Counter(labels))
+
+
+def gauge(name, help, func=None, **labels):
+    return _register("gauge", name, help, Gauge(labels, func))
+
+
+def histogram(name, help, buckets=DEFAULT_BUCKETS, **labels):
+    return _register("histogram", name, help, Histogram(labels, buckets))
+
+
+class _Clock(object):
+    """The current stage of one thread, when it was entered and the
+    seconds charged to every stage. The clock only lives in the thread's
+    local storage, so it goes away when the thread ends, and its totals
+    are then folded into _finished_totals."""
+
+    __slots__ = ("stage", "since", "totals", "__weakref__")
+
+    def __init__(self):
+        self.stage = None
+        self.since = time.time()
+        self.totals = dict.fromkeys(STAGES, 0.0)
+
+
+def _thread_state():
+    state = getattr(_local, "state", None)
+    if state is None:
+        state = _local.state = _Clock()
+        with _lock:
+            _stage_totals[weakref.ref(state, _fold)] = state.totals
+    return state
+
+
+def _fold(ref):
+    """add the totals of a thread that ended to _finished_totals"""
+    with _lock:
+        totals = _stage_totals.pop(ref)
+        for name, value in totals.iteritems():
+            _finished_totals[name] += value
+
+
+def enter(stage):
+    """Make stage the current stage of this thread, charging the time
+    since the last switch to the stage that was current. Returns that
+    stage, to switch back to with enter. None stops the clock."""
+    state = _thread_state()
+    now = time.time()
+    previous = state.stage
+    if previous is not None:
+        state.totals[previous] += now - state.since
+    state.stage = stage
+    state.since = now
+    return previous
+
+
+@contextmanager
+def stage(name):
+    previous = enter(name)
+    try:
+        yield
+    finally:
+        enter(previous)
+
+
+def stage_seconds():
+    """get the seconds spent in every stage, over all threads"""
+    with _lock:
+        totals = dict(_finished_totals)
+        per_thread = _stage_totals.values()
+    for seconds in per_thread:
+        for name, value in seconds.items():
+            totals[name] += value
+    return totals
+
+
+def render():
+    """get all metrics in the Prometheus text exposition format"""
+    lines = []
+    lines.append("# HELP stage_seconds_total Seconds spent in each "
+                 "pipeline stage, exclusive of the stages it reads from.")
+    lines.append("# TYPE stage_seconds_total counter")
+    for name, value in sorted(stage_seconds().iteritems()):
+        lines.append('stage_seconds_total{{stage="{0}"}} {1!r}'.format(
+            name, value))
+    with _lock:
+        families = sorted(
+            (name, kind, help, list(metrics))
+            for name, (kind, help, metrics) in _families.iteritems())
+    for name, kind, help, metrics in families:
+        lines.append("# HELP {0} {1}".format(name, help))
+        lines.append("# TYPE {0} {1}".format(name, kind))
+        for metric in metrics:
+            for sample, labels, value in metric.samples(name):
+                lines.append("{0}{1} {2!r}".format(
+                    sample, _labels(labels), float(value)))
+    return "\n".join(lines) + "\n"
+
+
+def value(name):
+    """get the summed value of a counter or gauge family"""
+    with _lock:
+        metrics = list(_families.get(name, (None, None, []))[2])
+    return sum(metric.get() if isinstance(metric, Gauge) else metric.value
+               for metric in metrics)
+
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port, host="127.0.0.1"):
+    """serve /metrics on a local port from a daemon thread"""
+    server = BaseHTTPServer.HTTPServer((host, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def report_line(previous, interval):
+    """get the log line summarizing the last interval, along with the
+    snapshot to compare the next interval with"""
+    snapshot = (stage_seconds(), value("changesets_parsed_total"),
+                value("changesets_written_total"))
+    stages, parsed, written = snapshot
+    if previous is None:
+        previous = (dict.fromkeys(STAGES, 0.0), 0, 0)
+    busy = " ".join(
+        "{0} {1:.1f}s".format(name, stages[name] - previous[0][name])
+        for name in STAGES)
+    line = "{busy} | {parsed:.0f} parsed/s {written:.0f} written/s | " \
+        "lag {lag:.0f}s | backfill queue {backfill:.0f} " \
+        "enrich queue {enrich:.0f}".format(
+            busy=busy,
+            parsed=(parsed - previous[1]) / interval,
+            written=(written - previous[2]) / interval,
+            lag=value("replication_lag_seconds"),
+            backfill=value("backfill_queue_depth"),
+            enrich=value("enrich_queue_depth"))
+    return line, snapshot
+
+
+def log_periodically(interval):
+    """write a summary line to stderr every interval seconds, from a
+    daemon thread"""
+    def run():
+        snapshot = None
+        while True:
+            time.sleep(interval)
+            line, snapshot = report_line(snapshot, interval)
+            stderr.write("[metrics] " + line + "\n")
+
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def start(port=config.METRICS_PORT, interval=config.METRICS_LOG_INTERVAL):
+    """start the metrics endpoint and the periodic log line, either of
+    which is left off when its setting is None or 0"""
+    if port:
+        serve(port)
+    if interval:
+        log_periodically(interval)
@@ -1,118 +1,189 @@
-from dateutil.parser import parse
 import requests
 import os
+import threading
+import time
 import xmltodict
-import gzip
 import config
-from collections import OrderedDict
+import fetchcache
+import metrics
+from streams import open_gzip_url, open_url
+from timeutil import parse_timestamp
+import xml.etree.ElementTree as ET
+from collections import OrderedDict, namedtuple
+
+_session = None
+
+CHANGESETS_PARSED = metrics.counter(
+    "changesets_parsed_total", "Changesets parsed from XML.")
+
+
+def get_session():
+    """Get the requests session shared by this process, which keeps
+    up to config.HTTP_POOL_SIZE connections per host alive."""
+    global _session
+    if _session is None:
+        _session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=config.HTTP_POOL_SIZE,
+            pool_maxsize=config.HTTP_POOL_SIZE)
+        _session.mount('http://', adapter)
+        _session.mount('https://', adapter)
+    return _session
+
+
+def parse_state(state_file):
+    """parse a replication state file into an OrderedDict with the
+    sequence number and last run time, or {} if either is missing"""
+    # I dislike PyYAML, that is why
+    current_state = {}
+    for line in state_file.split('\n'):
+        elems = line.split(':')
+        if len(elems) > 1:
+            current_state[elems[0].strip()] = ":".join(elems[1:]).strip()
+    if 'last_run' not in current_state or 'sequence' not in current_state:
+        return {}
+    current_state['sequence'] = int(current_state['sequence'])
+    current_state['last_run'] = parse_timestamp(current_state['last_run'])
+    return OrderedDict(current_state)
+
+
+class StateCache(object):
+    """Cache of a replication state file. Within ttl seconds of the last
+    check the cached state is returned as is; after that the server is
+    asked again with If-None-Match/If-Modified-Since, so an unchanged
+    state costs a 304 and no parsing."""
+
+    def __init__(self, ttl=config.STATE_CACHE_TTL):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.url = None
+        self.state = None
+        self.checked = 0
+        self.etag = None
+        self.last_modified = None
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+
+    def get(self, url):
+        with self.lock:
+            if url != self.url:
+                self.url = url
+                self.state = self.etag = self.last_modified = None
+            if self.state and time.time() - self.checked < self.ttl:
+                self.hits += 1
+                return OrderedDict(self.state)
+            headers = {}
+            if self.state and self.etag:
+                headers['If-None-Match'] = self.etag
+            if self.state and self.last_modified:
+                headers['If-Modified-Since'] = self.last_modified
+            response = get_session().get(
+                url, headers=headers, timeout=config.HTTP_TIMEOUT)
+            self.checked = time.time()
+            if response.status_code == 304 and self.state:
+                self.not_modified += 1
+                return OrderedDict(self.state)
+            response.raise_for_status()
+            self.misses += 1
+            self.state = parse_state(response.text)
+            self.etag = response.headers.get('etag')
+            self.last_modified = response.headers.get('last-modified')
+            return OrderedDict(self.state)
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "not_modified": self.not_modified}
+
+
+def _timestamp(value):
+    if isinstance(value, basestring):
+        return parse_timestamp(value)
+    return value
+
+
+def _intern_key(key):
+    """intern a tag key, so a day worth of changesets shares one copy
+    of created_by, comment, source and friends"""
+    return intern(key) if type(key) is str else key
+
+
+def _intern_keys(tags):
+    return dict((_intern_key(key), val) for key, val in tags.iteritems())
 
 
 class Changeset(object):
+    """A compact changeset record. The keyword constructor converts
+    its input to the right types; from_element and from_row build
+    records straight from parsed XML and database rows."""
+
+    __slots__ = (
+        "id", "uid", "user", "created_at", "closed_at", "num_changes",
+        "min_lon", "max_lon", "min_lat", "max_lat", "tags")
 
     def __init__(self, **kwargs):
-        self.id = kwargs.get("id", 0)
-        self.uid = kwargs.get("uid", "")
-        self.user = kwargs.get("user", 0)
-        self.created_at = kwargs.get("created_at", None)
-        self.closed_at = kwargs.get("closed_at", None)
-        self.num_changes = kwargs.get("num_changes", None)
-        self.min_lat = kwargs.get("min_lat", 0.0)
-        self.min_lon = kwargs.get("min_lon", 0.0)
-        self.max_lat = kwargs.get("max_lat", 0.0)
-        self.max_lon = kwargs.get("max_lon", 0.0)
-        self.tags = kwargs.get("tags", {})
-
-        @property
-        def id(self):
-            return self._id
-
-        @id.setter
-        def id(self, value):
-            self._id = int(value)
-
-        @property
-        def uid(self):
-            return self._uid
-
-        @uid.setter
-        def uid(self, value):
-            self._uid = int(value)
-
-        @property
-        def user(self):
-            return self._user
-
-        @user.setter
-        def user(self, value):
-            self._user = value
-
-        @property
-        def created_at(self):
-            return self._created_at
-
-        @created_at.setter
-        def created_at(self, value):
-            self._created_at = parse(value)
-
-        @property
-        def closed_at(self):
-            return self._closed_at
-
-        @closed_at.setter
-        def closed_at(self, value):
-            self._closed_at = parse(value)
-
-        @property
-        def num_changes(self):
-            return self._num_changes
-
-        @num_changes.setter
-        def num_changes(self, value):
-            self._num_changes = int(value)
-
-        @property
-        def min_lat(self):
-            return self._min_lat
-
-        @min_lat.setter
-        def min_lat(self, value):
-            self._min_lat = float(value)
-
-        @property
-        def min_lon(self):
-            return self._min_lon
-
-        @min_lon.setter
-        def min_lon(self, value):
-            self._min_lon = float(value)
-
-        @property
-        def max_lat(self):
-            return self._max_lat
-
-        @max_lat.setter
-        def max_lat(self, value):
-            self._max_lat = float(value)
-
-        @property
-        def max_lon(self):
-            return self._max_lon
-
-        @max_lon.setter
-        def max_lon(self, value):
-            self._max_lon = float(value)
-
-        @property
-        def tags(self):
-            return self._tags
-
-        @tags.setter
-        def tags(self, value):
-            self._tags = value
+        self.id = int(kwargs.get("id", 0))
+        self.uid = int(kwargs.get("uid", 0))
+        self.user = kwargs.get("user", "anonymous")
+        self.created_at = _timestamp(kwargs.get("created_at", None))
+        self.closed_at = _timestamp(kwargs.get("closed_at", None))
+        num_changes = kwargs.get("num_changes", None)
+        self.num_changes = None if num_changes is None else int(num_changes)
+        self.min_lon = float(kwargs.get("min_lon", 0.0))
+        self.max_lon = float(kwargs.get("max_lon", 0.0))
+        self.min_lat = float(kwargs.get("min_lat", 0.0))
+        self.max_lat = float(kwargs.get("max_lat", 0.0))
+        self.tags = _intern_keys(kwargs.get("tags", {}))
+
+    @classmethod
+    def from_element(cls, elem):
+        """build a changeset from a <changeset> element of a changeset
+        metadata file or API response"""
+        attrib = elem.attrib
+        changeset = cls.__new__(cls)
+        changeset.id = int(attrib["id"])
+        if "uid" in attrib:
+            changeset.uid = int(attrib["uid"])
+            changeset.user = attrib["user"]
+        else:
+            changeset.uid = 0
+            changeset.user = "anonymous"
+        created_at = attrib.get("created_at")
+        changeset.created_at = created_at and parse_timestamp(created_at)
+        closed_at = attrib.get("closed_at")
+        changeset.closed_at = closed_at and parse_timestamp(closed_at)
+        num_changes = attrib.get("num_changes")
+        changeset.num_changes = num_changes and int(num_changes)
+        if "min_lon" in attrib:
+            changeset.min_lon = float(attrib["min_lon"])
+            changeset.max_lon = float(attrib["max_lon"])
+            changeset.min_lat = float(attrib["min_lat"])
+            changeset.max_lat = float(attrib["max_lat"])
+        else:
+            changeset.min_lon = changeset.max_lon = 0.0
+            changeset.min_lat = changeset.max_lat = 0.0
+        tags = {}
+        for tag in elem:
+            tags[_intern_key(tag.attrib["k"])] = tag.attrib["v"]
+        changeset.tags = tags
+        return changeset
+
+    @classmethod
+    def from_row(cls, row):
+        """build a changeset from an already typed database row or
+        insert-ready tuple, without any conversion"""
+        changeset = cls.__new__(cls)
+        (changeset.id, changeset.uid, changeset.user, changeset.created_at,
+         changeset.closed_at, changeset.num_changes, changeset.min_lon,
+         changeset.max_lon, changeset.min_lat, changeset.max_lat,
+         changeset.tags) = row
+        return changeset
 
     def as_tuple(self):
-        """get an insert-ready tuple from a changeset dict"""
-        # add the changeset id
+        """get an insert-ready tuple, in the same column order as
+        helpers.as_tuple"""
         return (
             self.id,
             self.uid,
@@ -120,76 +191,225 @@ class Changeset(object):
             self.created_at,
             self.closed_at,
             self.num_changes,
-            self.min_lat,
-            self.max_lat,
             self.min_lon,
             self.max_lon,
+            self.min_lat,
+            self.max_lat,
             self.tags)
 
+    def __repr__(self):
+        return "<Changeset {id}>".format(id=self.id)
+
+
+OSMElement = namedtuple("OSMElement", [
+    "action", "type", "id", "version", "changeset", "uid", "user",
+    "timestamp", "visible", "lat", "lon", "tags", "nodes", "members"])
+
+
+def element_from_xml(action, elem):
+    """build an OSMElement from a parsed node, way or relation"""
+    attrib = elem.attrib
+    tags = {}
+    nodes = []
+    members = []
+    for child in elem:
+        if child.tag == "tag":
+            tags[_intern_key(child.attrib["k"])] = child.attrib["v"]
+        elif child.tag == "nd":
+            nodes.append(int(child.attrib["ref"]))
+        elif child.tag == "member":
+            members.append((
+                child.attrib["type"],
+                int(child.attrib["ref"]),
+                child.attrib.get("role", "")))
+    timestamp = attrib.get("timestamp")
+    lat = attrib.get("lat")
+    lon = attrib.get("lon")
+    return OSMElement(
+        action,
+        elem.tag,
+        int(attrib["id"]),
+        int(attrib.get("version", 0)),
+        int(attrib.get("changeset", 0)),
+        int(attrib.get("uid", 0)),
+        attrib.get("user", "anonymous"),
+        timestamp and parse_timestamp(timestamp),
+        attrib.get("visible", "true") == "true",
+        lat and float(lat),
+        lon and float(lon),
+        tags,
+        tuple(nodes),
+        tuple(members))
+
+
+def iter_elements(osm_xml):
+    """Stream OSMElement records out of an osmChange or OSM file object
+    as they are parsed, clearing each element afterwards so memory is
+    bounded by the largest single element. action is None for plain
+    OSM documents."""
+    root = parent = action = None
+    depth = 0
+    for event, elem in ET.iterparse(osm_xml, events=("start", "end")):
+        if event == "start":
+            if root is None:
+                root = parent = elem
+            elif depth == 1 and elem.tag in ("create", "modify", "delete"):
+                parent = elem
+                action = elem.tag
+            depth += 1
+            continue
+        depth -= 1
+        if elem.tag in ("node", "way", "relation") and \
+                depth == (2 if action else 1):
+            yield element_from_xml(action, elem)
+            parent.clear()
+        elif depth == 1:
+            root.clear()
+            parent = root
+            action = None
+
+
+def iter_changesets(changeset_xml, convert=Changeset.from_element):
+    """Stream Changeset records, or whatever else convert builds from a
+    <changeset> element, out of a changeset metadata file object as they
+    are parsed. Every element is cleared once it has been converted, so
+    memory stays flat no matter how big the file is."""
+    root = None
+    previous = metrics.enter("parse")
+    try:
+        for event, elem in ET.iterparse(
+                changeset_xml, events=("start", "end")):
+            if root is None:
+                root = elem
+            if event == "end" and elem.tag == "changeset":
+                metrics.enter("convert")
+                changeset = convert(elem)
+                CHANGESETS_PARSED.inc()
+                metrics.enter(previous)
+                yield changeset
+                metrics.enter("parse")
+                elem.clear()
+                root.clear()
+    finally:
+        metrics.enter(previous)
+
+
+def _stream(url, immutable=False):
+    """stream a download, going through the fetch cache only if the
+    body at url can never change"""
+    return open_url(
+        get_session(), url, fetchcache.get_cache() if immutable else None)
+
 
 class API(object):
 
-    base_url = 'http://api.osm.org/api/0.6/'
+    base_url = config.OSM_API_BASE_URL
 
     @classmethod
-    def osmchange(cls, changeset_id):
-        url = os.path.join(
+    def osmchange_url(cls, changeset_id):
+        return os.path.join(
             cls.base_url,
             'changeset',
             str(changeset_id),
             'download')
-        response = requests.get(url)
+
+    @classmethod
+    def osmchange(cls, changeset_id):
+        response = get_session().get(cls.osmchange_url(changeset_id))
         if response.status_code != 200:
             return {"error": response.status_code}
         return xmltodict.parse(response.content)
 
     @classmethod
-    def changeset(cls, changeset_id):
-        url = os.path.join(
+    def iter_osmchange(cls, changeset_id, closed=False):
+        """yield the OSMElements of a changeset while it downloads; the
+        download is only cached if the changeset is known to be closed,
+        as the osmChange of an open one still grows"""
+        return iter_elements(
+            _stream(cls.osmchange_url(changeset_id), immutable=closed))
+
+    @classmethod
+    def changeset_url(cls, changeset_id):
+        return os.path.join(
             cls.base_url,
             'changeset',
             str(changeset_id))
-        response = requests.get(url)
+
+    @classmethod
+    def changeset(cls, changeset_id):
+        response = get_session().get(cls.changeset_url(changeset_id))
         if response.status_code != 200:
             return {"error": response.status_code}
         return xmltodict.parse(response.content)
 
     @classmethod
-    def element(cls, osm_type, id):
-        if osm_type not in ['node', 'way', 'relation']:
-            return False
-        url = os.path.join(
+    def iter_changeset(cls, changeset_id):
+        """yield the Changeset record of a changeset"""
+        return iter_changesets(_stream(cls.changeset_url(changeset_id)))
+
+    @classmethod
+    def element_url(cls, osm_type, id):
+        return os.path.join(
             cls.base_url,
             osm_type,
             str(id))
+
+    @classmethod
+    def element(cls, osm_type, id):
+        if osm_type not in ['node', 'way', 'relation']:
+            return False
+        url = cls.element_url(osm_type, id)
         print url
-        response = requests.get(url)
+        response = get_session().get(url)
         if len(response.content) == 0:
             return {"error": "no content"}
         if response.status_code != 200:
             return {"error": response.status_code}
         return xmltodict.parse(response.content)
 
+    @classmethod
+    def iter_element(cls, osm_type, id):
+        """yield the OSMElement records of an element, and of the
+        nodes and members the API sends along with it"""
+        if osm_type not in ['node', 'way', 'relation']:
+            raise ValueError("not an OSM type: {0}".format(osm_type))
+        return iter_elements(_stream(cls.element_url(osm_type, id)))
+
 
 class Planet(object):
 
-    base_url = 'http://planet.osm.org/'
+    base_url = config.PLANET_BASE_URL
+    state_cache = StateCache()
 
     @classmethod
     def changesets_for_minutely(cls, sequence_number):
-        """Read a minutely changeset file and resurn the changesets
-        containted within it as an elementtree object"""
-        chunk_size = 1024
-        tempfile = os.path.join(config.TMP_DIR, 'temp.gz')
-        path = cls.path_for_sequence(sequence_number)
-        with open(tempfile, 'wb') as fd:
-            for chunk in requests.get(path).iter_content(chunk_size):
-                fd.write(chunk)
-        with gzip.open(tempfile) as changeset_xml:
-            return xmltodict.parse(changeset_xml)
+        """Read a minutely changeset file and return the changesets
+        contained within it as a dict, decompressing and parsing it
+        while it downloads"""
+        path = cls.changeset_path_for_sequence(sequence_number)
+        return xmltodict.parse(
+            open_gzip_url(get_session(), path, fetchcache.get_cache()))
+
+    @classmethod
+    def iter_changesets_for_minutely(cls, sequence_number, session=None):
+        """Yield the changesets in a minutely changeset file as Changeset
+        records, decompressing and parsing it while it downloads"""
+        path = cls.changeset_path_for_sequence(sequence_number)
+        return iter_changesets(open_gzip_url(
+            session or get_session(), path, fetchcache.get_cache()))
 
     @classmethod
     def changeset_path_for_sequence(cls, sequence_number):
+        return '{path}.osm.gz'.format(
+            path=cls.path_for_sequence(sequence_number))
+
+    @classmethod
+    def state_path_for_sequence(cls, sequence_number):
+        return '{path}.state.txt'.format(
+            path=cls.path_for_sequence(sequence_number))
+
+    @classmethod
+    def path_for_sequence(cls, sequence_number):
         parts = []
         if sequence_number < 0:
             sequence_number = 0
@@ -198,40 +418,56 @@ class Planet(object):
             sequence_number = (sequence_number - sequence_number % 1000) / 1000
         while len(parts) < 3:
             parts.insert(0, "000")
-        parts.insert(0, "http://planet.osm.org/replication/changesets/")
-        return '{path}.osm.gz'.format(path=os.path.join(*parts))
+        parts.insert(0, cls.base_url + "replication/changesets/")
+        return os.path.join(*parts)
+
+    @classmethod
+    def get_state_for_sequence(cls, sequence_number):
+        """Get the state (sequence number and last run time) that was
+        published together with a minutely changeset diff."""
+        return parse_state(open_url(
+            get_session(),
+            cls.state_path_for_sequence(sequence_number),
+            fetchcache.get_cache()).read())
+
+    @classmethod
+    def get_sequence_for(cls, utctime):
+        """Given an UTC timestamp, get the sequence number of the last
+        changeset minutely delta published at or before it, from the
+        sequence index (see sequenceindex), or None if the replication
+        state is not available."""
+        import database
+        from sequenceindex import SequenceIndex
+        with database.pooled_connection() as connection:
+            try:
+                return SequenceIndex(connection).sequence_for(utctime)
+            except IOError:
+                return None
 
     @classmethod
     def get_changeset_path_for(cls, utctime):
-        """Given an UTC timestamp, get the path for what is likely to be
-        the corresponding changeset minutely delta. This may break down when
-        the minutely updates were interrupted, but it will always return a
-        path to a file that has changesets for the given timestamp or before,
-        guaranteed not after."""
-        from math import floor
-        current_state = cls.get_current_state()
-        if 'last_run' not in current_state:
+        """Given an UTC timestamp, get the path for the changeset minutely
+        delta published last at or before it, which has changesets for
+        the given timestamp or before, guaranteed not after."""
+        sequence = cls.get_sequence_for(utctime)
+        if sequence is None:
             return ""
-        minutes = int(floor(
-            (current_state['last_run'] - utctime).total_seconds() / 60))
-        rem = current_state['sequence'] - minutes
-        return cls.path_for_sequence(rem)
+        return cls.changeset_path_for_sequence(sequence)
 
     @classmethod
     def get_current_state(cls):
         """Get the current state from the OSM server, including the current
-        delta sequence number, and the last run time."""
-        # I dislike PyYAML, that is why
-        current_state_file_url =\
-            "http://planet.openstreetmap.org/replication/changesets/state.yaml"
-        state_file = requests.get(current_state_file_url).text
-        current_state = {}
-        for line in state_file.split('\n'):
-            elems = line.split(':')
-            if len(elems) > 1:
-                current_state[elems[0].strip()] = ":".join(elems[1:]).strip()
-        if not 'last_run' and 'sequence' in current_state:
-            return {}
-        current_state['sequence'] = int(current_state['sequence'])
-        current_state['last_run'] = parse(current_state['last_run'])
-        return OrderedDict(current_state)
+        delta sequence number, and the last run time. Answers come from
+        the process wide state_cache."""
+        return cls.state_cache.get(
+            cls.base_url + "replication/changesets/state.yaml")
+
+
+for _result, _name in (("hit", "hits"), ("miss", "misses"),
+                       ("not_modified", "not_modified")):
+    metrics.gauge(
+        "state_cache_lookups",
+        "Replication state lookups answered from the cache within its "
+        "ttl (hit), by a 304 (not_modified) or by a new download (miss).",
+        func=lambda name=_name: Planet.state_cache.stats()[name],
+        result=_result)
@@ -0,0 +1,194 @@
+"""Parallel loading of multi-stream bz2 changeset dumps.
+
+The planet changeset dumps are written by parallel bzip2 compressors,
+which means the file is a concatenation of independent bz2 streams that
+each start on a byte boundary. That lets every worker decompress its own
+run of streams. The XML is cut at arbitrary points between streams, so a
+worker owns exactly those changesets whose opening tag starts inside its
+run of streams, reading on into the following streams only to finish
+the last one."""
+import bz2
+import multiprocessing
+import time
+import config
+import database
+import helpers
+import metrics
+import users
+from streams import GeneratorReader
+
+BZ2_STREAM_MAGIC = '1AY&SY'
+CHANGESET_TAG = '<changeset'
+END_TAG = '</osm>'
+READ_SIZE = 1024 * 1024
+
+
+def find_bz2_streams(path):
+    """get the byte offsets of every bz2 stream in a file"""
+    offsets = []
+    position = 0
+    overlap = ''
+    with open(path, 'rb') as fd:
+        while True:
+            chunk = fd.read(16 * READ_SIZE)
+            if not chunk:
+                break
+            data = overlap + chunk
+            base = position - len(overlap)
+            index = data.find('BZh')
+            while index != -1:
+                header = data[index:index + 10]
+                if len(header) < 10:
+                    break
+                if header[3] in '123456789' and \
+                        header[4:] == BZ2_STREAM_MAGIC:
+                    if not offsets or offsets[-1] < base + index:
+                        offsets.append(base + index)
+                index = data.find('BZh', index + 1)
+            overlap = data[-9:]
+            position += len(chunk)
+    return offsets, position
+
+
+def split_streams(offsets, size, ranges):
+    """split the streams into contiguous runs of roughly equal
+    compressed size, returning (first, last) stream index pairs"""
+    target = float(size) / ranges
+    runs = []
+    first = 0
+    for index in range(1, len(offsets)):
+        if offsets[index] >= target * (len(runs) + 1):
+            runs.append((first, index))
+            first = index
+    runs.append((first, len(offsets)))
+    return runs
+
+
+def _decompressed_streams(path, offsets, size, first, last):
+    """decompress streams from first onwards, yielding
+    (chunk, owned) where owned is True for streams before last"""
+    bounds = offsets + [size]
+    with open(path, 'rb') as fd:
+        for index in range(first, len(offsets)):
+            decompressor = bz2.BZ2Decompressor()
+            fd.seek(bounds[index])
+            remaining = bounds[index + 1] - bounds[index]
+            while remaining > 0:
+                data = fd.read(min(READ_SIZE, remaining))
+                if not data:
+                    break
+                remaining -= len(data)
+                previous = metrics.enter("decompress")
+                chunk = decompressor.decompress(data)
+                metrics.enter(previous)
+                if chunk:
+                    yield chunk, index < last
+
+
+def owned_xml(chunks):
+    """Cut the XML for the changesets owned by one run of streams out of
+    its decompressed chunks and wrap it in an <osm> element, which is
+    empty when no changeset starts in the run, such as a last stream
+    holding only the closing </osm>"""
+    keep = max(len(CHANGESET_TAG), len(END_TAG)) - 1
+    buf = ''
+    buf_start = 0
+    owned_bytes = 0
+    owned_end = None
+    emitting = False
+    for chunk, owned in chunks:
+        buf += chunk
+        if owned:
+            owned_bytes += len(chunk)
+        elif owned_end is None:
+            owned_end = owned_bytes
+        if not emitting:
+            index = buf.find(CHANGESET_TAG)
+            if index == -1 or (owned_end is not None and
+                               buf_start + index >= owned_end):
+                if owned_end is not None and \
+                        buf_start + len(buf) - keep >= owned_end:
+                    break
+                buf_start += max(0, len(buf) - keep)
+                buf = buf[-keep:]
+                continue
+            emitting = True
+            buf_start += index
+            buf = buf[index:]
+            yield '<osm>'
+        cuts = [buf.find(END_TAG)]
+        if owned_end is not None:
+            cuts.append(buf.find(
+                CHANGESET_TAG, max(0, owned_end - buf_start)))
+        cuts = [cut for cut in cuts if cut != -1]
+        if cuts:
+            yield buf[:min(cuts)]
+            yield END_TAG
+            return
+        if len(buf) > keep:
+            yield buf[:-keep]
+            buf_start += len(buf) - keep
+            buf = buf[-keep:]
+    if emitting:
+        yield buf
+    else:
+        # nothing starts in this run of streams
+        yield '<osm>'
+    yield END_TAG
+
+
+def _load_run(job):
+    """load the changesets owned by one run of streams over
+    its own connection and COPY stream"""
+    from changesetstore import ChangesetStore
+    path, offsets, size, first, last = job
+    chunks = _decompressed_streams(path, offsets, size, first, last)
+    changeset_xml = GeneratorReader(owned_xml(chunks))
+    connection = database.get_connection()
+    try:
+        cursor = connection.cursor()
+        processed = ChangesetStore.copy_changesets(
+            cursor,
+            (helpers.as_tuple(changeset) for changeset
+             in helpers.iter_changesets(changeset_xml)),
+            summarize_users=False, rollup_at_end=True)
+        connection.commit()
+    finally:
+        connection.close()
+    return processed
+
+
+def load_parallel(changesetfile, workers):
+    """Load a multi-stream bz2 changeset dump with a pool of worker
+    processes. The user summaries are recomputed once all workers are
+    done. Returns the number of changesets loaded, or None if the file
+    is a single bz2 stream and cannot be split."""
+    offsets, size = find_bz2_streams(changesetfile)
+    if len(offsets) < 2:
+        return None
+    ranges = min(len(offsets), workers * config.LOAD_RUNS_PER_WORKER)
+    runs = split_streams(offsets, size, ranges)
+    jobs = [(changesetfile, offsets, size, first, last)
+            for first, last in runs]
+    pool = multiprocessing.Pool(workers)
+    processed = 0
+    started = time.time()
+    try:
+        for count in pool.imap_unordered(_load_run, jobs):
+            processed += count
+    finally:
+        pool.close()
+        pool.join()
+    connection = database.get_connection()
+    try:
+        users.rebuild(connection.cursor())
+        connection.commit()
+    finally:
+        connection.close()
+    elapsed = time.time() - started
+    print "\n{processed} changesets from {runs} stream runs, {rate:.0f}/s"\
+        .format(
+            processed=processed,
+            runs=len(runs),
+            rate=processed / elapsed if elapsed else 0)
+    return processed
@@ -0,0 +1,169 @@
+"""Keep the changesets table up to date with the minutely changeset
+replication diffs from planet.osm.org."""
+import time
+import xml.etree.ElementTree as ET
+import zlib
+from datetime import datetime
+import psycopg2
+import requests
+import config
+import database
+import helpers
+import metrics
+from changesetstore import ChangesetStore
+from osm import Planet
+from sequenceindex import SequenceIndex
+from timeutil import UTC
+
+
+DIFFS_APPLIED = metrics.counter(
+    "diffs_applied_total", "Minutely diffs applied.")
+
+DIFF_APPLY = metrics.histogram(
+    "diff_apply_seconds", "Seconds to apply one minutely diff.")
+
+_applied = {"sequence": 0, "last_run": None}
+
+_listeners = []
+
+
+def _lag():
+    if _applied["last_run"] is None:
+        return 0
+    return (datetime.now(UTC) - _applied["last_run"]).total_seconds()
+
+
+metrics.gauge(
+    "replication_lag_seconds",
+    "Seconds between now and the last_run of the last applied diff.",
+    func=_lag)
+
+metrics.gauge(
+    "replication_sequence", "Sequence number of the last applied diff.",
+    func=lambda: _applied["sequence"])
+
+
+def add_listener(listener):
+    """Call listener(sequence, changesets) with the insert-ready tuples
+    of every diff applied in this process, once it is committed."""
+    _listeners.append(listener)
+
+
+def remove_listener(listener):
+    _listeners.remove(listener)
+
+
+def starting_sequence(connection, current_state):
+    """Get the first sequence to apply when no diff has been applied
+    yet: the one following the last diff published before the newest
+    changeset in the table, or the current one if the table is empty."""
+    latest = database.latest_created_at(connection.cursor())
+    if latest is None:
+        return current_state['sequence']
+    return SequenceIndex(connection).sequence_for(latest) + 1
+
+
+def apply_changesets(connection, sequence, changesets, last_run=None):
+    """Upsert the insert-ready tuples from one minutely diff and record
+    it as applied, in a single transaction."""
+    cursor = connection.cursor()
+    try:
+        with DIFF_APPLY.time():
+            ChangesetStore.upsert_changesets(cursor, changesets)
+            ChangesetStore.set_replication_state(cursor, sequence, last_run)
+            if last_run is not None:
+                SequenceIndex.record(cursor, sequence, last_run)
+            connection.commit()
+    except:
+        connection.rollback()
+        raise
+    DIFFS_APPLIED.inc()
+    _applied["sequence"] = sequence
+    if last_run is not None:
+        _applied["last_run"] = last_run
+    for listener in list(_listeners):
+        try:
+            listener(sequence, changesets)
+        except Exception as e:
+            helpers.handle_error(e, bail=False)
+
+
+def apply_sequence(connection, sequence, last_run=None):
+    """Fetch one minutely diff, and its state if last_run is not
+    known, and apply it. Returns the number of changesets in the
+    diff."""
+    if last_run is None:
+        last_run = Planet.get_state_for_sequence(sequence)['last_run']
+    changesets = [changeset.as_tuple() for changeset
+                  in Planet.iter_changesets_for_minutely(sequence)]
+    apply_changesets(connection, sequence, changesets, last_run)
+    return len(changesets)
+
+
+def catch_up(connection, current_state,
+             concurrency=config.BACKFILL_CONCURRENCY):
+    """Apply every diff after the last applied one up to and including
+    the current state, in order. Longer gaps are fetched concurrently
+    by the backfill module. Returns the number of diffs applied."""
+    import backfill
+    cursor = connection.cursor()
+    state = ChangesetStore.get_replication_state(cursor)
+    if state is None:
+        first = starting_sequence(connection, current_state)
+    else:
+        first = state[0] + 1
+    connection.commit()
+    current = current_state['sequence']
+    applied = 0
+    if current - first > concurrency:
+        applied += backfill.backfill(connection, first, current - 1,
+                                     concurrency)
+        first = current
+    for sequence in range(first, current + 1):
+        last_run = None
+        if sequence == current:
+            last_run = current_state['last_run']
+        processed = apply_sequence(connection, sequence, last_run)
+        applied += 1
+        print "applied {sequence}: {processed} changesets".format(
+            sequence=sequence,
+            processed=processed)
+    if applied:
+        lag = datetime.now(UTC) - current_state['last_run']
+        print "at {sequence}, {lag:.0f}s behind".format(
+            sequence=current,
+            lag=lag.total_seconds())
+    return applied
+
+
+def catch_up_once(concurrency=config.BACKFILL_CONCURRENCY):
+    """Bring the database up to the current replication state once."""
+    current_state = Planet.get_current_state()
+    if not current_state:
+        return 0
+    with database.pooled_connection() as connection:
+        return catch_up(connection, current_state, concurrency)
+
+
+def follow(poll_interval=config.REPLICATION_POLL_INTERVAL,
+           concurrency=config.BACKFILL_CONCURRENCY):
+    """Poll the replication state forever, applying new diffs as they
+    appear. Errors are reported and retried on the next poll; the
+    applied sequence is only ever advanced together with its diff, so a
+    restart resumes exactly where the last run stopped. Every poll
+    borrows a checked connection from the pool, which rolls back
+    whatever a failed poll left behind, so the follower survives both
+    database restarts and diffs the database rejects."""
+    try:
+        while True:
+            try:
+                current_state = Planet.get_current_state()
+                if current_state:
+                    with database.pooled_connection() as connection:
+                        catch_up(connection, current_state, concurrency)
+            except (requests.RequestException, IOError, ET.ParseError,
+                    zlib.error, psycopg2.Error) as e:
+                helpers.handle_error(e, bail=False)
+            time.sleep(poll_interval)
+    except KeyboardInterrupt:
+        print "\nstopped following."
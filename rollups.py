@@ -0,0 +1,154 @@
+"""Daily rollups of changesets and edits per editor and per hashtag.
+
+The rollups are kept up to date incrementally: the bulk loader adds
+every changeset it COPYs, and the follower adds the difference between
+the old and the new version of every changeset its merges touch. The
+reports then read a handful of rollup rows instead of scanning the tags
+of every changeset."""
+import re
+import config
+from timeutil import as_utc
+
+schema = """
+    CREATE TABLE IF NOT EXISTS editor_daily (
+        day date NOT NULL,
+        editor text NOT NULL,
+        changesets integer NOT NULL,
+        edits bigint NOT NULL,
+        PRIMARY KEY (day, editor));
+    CREATE TABLE IF NOT EXISTS hashtag_daily (
+        hashtag text NOT NULL,
+        day date NOT NULL,
+        changesets integer NOT NULL,
+        edits bigint NOT NULL,
+        PRIMARY KEY (hashtag, day))"""
+
+EDITOR_VERSION = re.compile(r'[\s/]+v?\d.*$')
+HASHTAG = re.compile(r'(?<![\w&])#([^\W\d_][\w-]*)', re.UNICODE)
+
+
+def normalize_editor(created_by):
+    """get the name of the editor from a created_by tag, without its
+    version and platform details: JOSM/1.5 (18303 en) becomes JOSM and
+    iD 2.20.1 becomes iD"""
+    if not created_by:
+        return u"unknown"
+    return EDITOR_VERSION.sub(u"", created_by.strip())[:100] or u"unknown"
+
+
+def hashtags(tags):
+    """get the lowercased hashtags of a changeset, from its comment and
+    from the hashtags tag newer editors set"""
+    found = set(
+        tag.lower() for tag in HASHTAG.findall(tags.get("comment", "")))
+    for tag in tags.get("hashtags", "").split(";"):
+        tag = tag.strip().lstrip("#")
+        if tag:
+            found.add(tag.lower())
+    return found
+
+
+class Rollup(object):
+    """Accumulates rollup deltas in memory until they are written in
+    one statement per table."""
+
+    def __init__(self):
+        self.editors = {}
+        self.hashtags = {}
+
+    def add(self, created_at, num_changes, tags, sign=1):
+        """count one changeset in, or out with sign=-1"""
+        if created_at is None:
+            return
+        day = as_utc(created_at).date()
+        tags = tags or {}
+        delta = (sign, sign * (num_changes or 0))
+        key = (day, normalize_editor(tags.get("created_by")))
+        self.editors[key] = _plus(self.editors.get(key), delta)
+        for tag in hashtags(tags):
+            key = (tag, day)
+            self.hashtags[key] = _plus(self.hashtags.get(key), delta)
+
+    def add_values(self, values):
+        """count an insert-ready tuple in"""
+        self.add(values[3], values[5], values[10])
+
+    def write(self, cursor):
+        """Add the accumulated deltas to the rollup tables and start
+        over. Keys are written in sorted order, so two transactions that
+        write one Rollup each lock rollup rows in the same order. That
+        does not hold across several writes in one transaction, which
+        may interleave with another transaction's in opposite orders, so
+        concurrent loaders write a single Rollup per transaction (see
+        ChangesetStore.copy_changesets)."""
+        _write(cursor, "editor_daily", ("day", "editor"), self.editors)
+        _write(cursor, "hashtag_daily", ("hashtag", "day"), self.hashtags)
+        self.editors = {}
+        self.hashtags = {}
+
+
+def _plus(counts, delta):
+    if counts is None:
+        return delta
+    return counts[0] + delta[0], counts[1] + delta[1]
+
+
+def _write(cursor, table, key_columns, deltas):
+    rows = [key + counts for key, counts in sorted(deltas.iteritems())
+            if counts != (0, 0)]
+    for start in range(0, len(rows), config.ROLLUP_BATCH_SIZE):
+        cursor.execute(
+            """INSERT INTO {table} AS r ({keys}, changesets, edits)
+               VALUES {values}
+               ON CONFLICT ({keys}) DO UPDATE SET
+                   changesets = r.changesets + EXCLUDED.changesets,
+                   edits = r.edits + EXCLUDED.edits""".format(
+                table=table,
+                keys=", ".join(key_columns),
+                values=", ".join(
+                    cursor.mogrify("(%s, %s, %s, %s)", row) for row
+                    in rows[start:start + config.ROLLUP_BATCH_SIZE])))
+
+
+def rebuild(connection):
+    """Recompute the rollups from the changesets table, for data that
+    was loaded before the rollups existed."""
+    cursor = connection.cursor()
+    cursor.execute("TRUNCATE editor_daily, hashtag_daily")
+    rows = connection.cursor("rollup_rebuild")
+    rows.itersize = 10000
+    rows.execute(
+        "SELECT created_at, num_changes, tags FROM {table}".format(
+            table=config.TABLENAME))
+    rollup = Rollup()
+    for created_at, num_changes, tags in rows:
+        rollup.add(created_at, num_changes, tags)
+    rows.close()
+    rollup.write(cursor)
+    connection.commit()
+
+
+def editor_report(cursor, since, until, limit=None):
+    """get (editor, changesets, edits) for changesets created on the
+    days from since up to but not including until, busiest first"""
+    query = """
+        SELECT editor, sum(changesets), sum(edits) FROM editor_daily
+        WHERE day >= %s AND day < %s
+        GROUP BY editor HAVING sum(changesets) > 0
+        ORDER BY sum(edits) DESC"""
+    if limit:
+        query += " LIMIT {limit:d}".format(limit=limit)
+    cursor.execute(query, (since, until))
+    return cursor.fetchall()
+
+
+def hashtag_report(cursor, hashtag, since, until):
+    """get (day, changesets, edits) for one hashtag on the days from
+    since up to but not including until"""
+    cursor.execute(
+        """SELECT day, changesets, edits FROM hashtag_daily
+           WHERE hashtag = %s AND day >= %s AND day < %s
+               AND changesets > 0
+           ORDER BY day""",
+        (hashtag.lstrip("#").lower(), since, until))
+    return cursor.fetchall()
@@ -0,0 +1,230 @@
+"""Score changesets against suspicious-changeset rules as they arrive.
+
+Rules are compiled from config.SCORING_RULES, a list of (name, score,
+conditions) triples where every condition is a (feature, operator,
+value) triple that must hold for the rule to fire, e.g.
+("new_user_mass_edit", 40, [("user_age_days", "<", 1),
+("num_changes", ">", 1000)]). A batch is turned into one NumPy array per
+feature and every condition into one ufunc call over the whole batch,
+so the cost of scoring grows with the number of rules rather than with
+rules times changesets.
+
+Batches come from two places. Every diff the follower applies has the
+features num_changes, bbox_area (in square degrees), created_by, editor
+(created_by without its version, see rollups.normalize_editor),
+user_age_days (since the first changeset of the user) and
+user_changesets. Every batch of action counts the enrichment writes has
+creates, modifies and deletes, which are not known any earlier. Rules on
+features a batch does not have are skipped for it. Every rule that fires
+is recorded in the alerts table."""
+import threading
+from collections import namedtuple
+import numpy as np
+import alerts
+import config
+import database
+import metrics
+from rollups import normalize_editor
+
+OPERATORS = {
+    ">": np.greater,
+    ">=": np.greater_equal,
+    "<": np.less,
+    "<=": np.less_equal,
+    "==": np.equal,
+    "!=": np.not_equal,
+    "in": lambda column, values: np.in1d(column, list(values))}
+
+ALERTS_RAISED = metrics.counter(
+    "alerts_total",
+    "Alerts recorded, counting every rule once per changeset.")
+
+SCORING_BATCHES = metrics.histogram(
+    "scoring_batch_seconds", "Seconds to score one batch of changesets.",
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1))
+
+Rule = namedtuple("Rule", ("name", "score", "conditions"))
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_engine():
+    """get the process wide engine, with config.SCORING_RULES"""
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = ScoringEngine()
+    return _engine
+
+
+def compile_rules(rules):
+    """turn (name, score, conditions) triples into Rules with the
+    operators resolved, raising ValueError for unknown ones"""
+    compiled = []
+    for name, score, conditions in rules:
+        resolved = []
+        for feature, operator, value in conditions:
+            if operator not in OPERATORS:
+                raise ValueError("rule {0}: unknown operator {1!r}".format(
+                    name, operator))
+            resolved.append((feature, OPERATORS[operator], value))
+        compiled.append(Rule(name, score, tuple(resolved)))
+    return compiled
+
+
+class UserState(object):
+    """The first_seen time, changeset count and highest changeset id of
+    every user seen, loaded from the users table the first time a user
+    is seen and kept up to date from the batches after that. Starts over
+    when it grows past max_users."""
+
+    def __init__(self, max_users=config.SCORING_MAX_USERS):
+        self.max_users = max_users
+        self.users = {}
+
+    def update(self, cursor, changesets):
+        """Count a batch in. The batch is expected to be in the users
+        table already, so users loaded now are not counted twice.
+        Without a cursor, users not seen before are taken to be new."""
+        uids = set(values[1] for values in changesets if values[1])
+        missing = uids.difference(self.users)
+        if len(self.users) + len(missing) > self.max_users:
+            self.users = {}
+            missing = uids
+        loaded = set()
+        if missing and cursor is not None:
+            cursor.execute(
+                """SELECT uid, first_seen, changesets FROM users
+                   WHERE uid = ANY(%s)""",
+                (list(missing),))
+            for uid, first_seen, count in cursor:
+                self.users[uid] = [first_seen, count, 0]
+                loaded.add(uid)
+        for values in changesets:
+            uid = values[1]
+            if not uid:
+                continue
+            entry = self.users.get(uid)
+            if entry is None:
+                entry = self.users[uid] = [values[3], 0, 0]
+            if values[0] > entry[2]:
+                entry[2] = values[0]
+                if uid not in loaded:
+                    entry[1] += 1
+            if values[3] is not None and (
+                    entry[0] is None or values[3] < entry[0]):
+                entry[0] = values[3]
+
+    def get(self, uid):
+        return self.users.get(uid)
+
+
+class ScoringEngine(object):
+
+    def __init__(self, rules=config.SCORING_RULES):
+        self.rules = compile_rules(rules)
+        self.state = UserState()
+        self.lock = threading.Lock()
+
+    def evaluate(self, features):
+        """get a rules by rows boolean matrix of the rules that fire"""
+        size = len(features["id"])
+        fired = np.zeros((len(self.rules), size), dtype=np.bool_)
+        with np.errstate(invalid="ignore"):
+            for index, rule in enumerate(self.rules):
+                if any(feature not in features
+                       for feature, _, _ in rule.conditions):
+                    continue
+                mask = np.ones(size, dtype=np.bool_)
+                for feature, operator, value in rule.conditions:
+                    mask &= operator(features[feature], value)
+                fired[index] = mask
+        return fired
+
+    def alerts(self, features, sequence=None):
+        """get the (changeset_id, rule, score, sequence) alerts for a
+        batch of features"""
+        rules, rows = np.nonzero(self.evaluate(features))
+        ids = features["id"]
+        return [(int(ids[row]), self.rules[rule].name,
+                 self.rules[rule].score, sequence)
+                for rule, row in zip(rules, rows)]
+
+    def changeset_features(self, cursor, changesets):
+        """get the feature arrays of a batch of insert-ready tuples"""
+        with self.lock:
+            self.state.update(cursor, changesets)
+            users = [self.state.get(values[1]) for values in changesets]
+        created_by = [(values[10] or {}).get("created_by")
+                      for values in changesets]
+        return {
+            "id": np.array(
+                [values[0] for values in changesets], dtype=np.int64),
+            "num_changes": np.array(
+                [values[5] or 0 for values in changesets], dtype=np.int64),
+            "bbox_area": np.array(
+                [(values[7] - values[6]) * (values[9] - values[8])
+                 for values in changesets], dtype=np.float64),
+            "created_by": np.array(created_by, dtype=object),
+            "editor": np.array(
+                [normalize_editor(value) for value in created_by],
+                dtype=object),
+            "user_age_days": np.array(
+                [(values[3] - user[0]).total_seconds() / 86400.0
+                 if user and values[3] and user[0] else np.nan
+                 for values, user in zip(changesets, users)],
+                dtype=np.float64),
+            "user_changesets": np.array(
+                [user[1] if user else 0 for user in users],
+                dtype=np.int64)}
+
+    @staticmethod
+    def count_features(rows):
+        """get the feature arrays of a batch of changeset_actions rows"""
+        counts = np.array(rows, dtype=np.int64)
+        return {
+            "id": counts[:, 0],
+            "creates": counts[:, 1:4].sum(axis=1),
+            "modifies": counts[:, 4:7].sum(axis=1),
+            "deletes": counts[:, 7:10].sum(axis=1)}
+
+    def score_changesets(self, cursor, sequence, changesets):
+        """score a batch of insert-ready tuples from a minutely diff and
+        record the alerts; returns them"""
+        changesets = [values for values in changesets if values]
+        if not changesets:
+            return []
+        with SCORING_BATCHES.time():
+            found = self.alerts(
+                self.changeset_features(cursor, changesets), sequence)
+            recorded = alerts.write(cursor, found)
+        ALERTS_RAISED.inc(recorded)
+        return found
+
+    def score_counts(self, cursor, rows):
+        """score a batch of changeset_actions rows (see
+        enrichment.as_counts) and record the alerts; returns them"""
+        if not rows:
+            return []
+        with SCORING_BATCHES.time():
+            found = self.alerts(self.count_features(rows))
+            recorded = alerts.write(cursor, found)
+        ALERTS_RAISED.inc(recorded)
+        return found
+
+    def on_diff(self, sequence, changesets):
+        """replication listener scoring every applied diff"""
+        with database.pooled_connection() as connection:
+            self.score_changesets(connection.cursor(), sequence, changesets)
+            connection.commit()
+
+    def attach(self):
+        """score every diff the follower applies in this process from
+        now on"""
+        import replication
+        replication.add_listener(self.on_diff)
+
+    def detach(self):
+        import replication
+        replication.remove_listener(self.on_diff)
@@ -0,0 +1,105 @@
+"""Exact mapping between replication sequence numbers and time.
+
+Every applied diff records the last_run of its state file, and the
+remote state files are only probed to narrow down what the local index
+cannot answer. Lookups find the bracketing sequences in the index with
+two btree probes, then close the remaining gap with an interpolation
+search over the remote state files that falls back to bisection, which
+needs O(log n) requests in the worst case and usually a handful."""
+import config
+import database
+from osm import Planet
+
+
+class SequenceIndex(object):
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS replication_sequences (
+            sequence integer PRIMARY KEY,
+            last_run timestamp with time zone NOT NULL);
+        CREATE INDEX IF NOT EXISTS replication_sequences_last_run_idx
+            ON replication_sequences (last_run)"""
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.probes = 0
+
+    @staticmethod
+    def record(cursor, sequence, last_run):
+        """remember when a sequence was published"""
+        database.execute_prepared(
+            cursor,
+            "record_sequence",
+            """INSERT INTO replication_sequences (sequence, last_run)
+               VALUES ($1, $2)
+               ON CONFLICT (sequence) DO UPDATE SET
+                   last_run = EXCLUDED.last_run""",
+            (sequence, last_run))
+
+    def bracket(self, utctime):
+        """Get the indexed (sequence, last_run) pairs closest before (at
+        or earlier than utctime) and after it, either may be None."""
+        cursor = self.connection.cursor()
+        cursor.execute(
+            """SELECT sequence, last_run FROM replication_sequences
+               WHERE last_run <= %s ORDER BY last_run DESC LIMIT 1""",
+            (utctime,))
+        before = cursor.fetchone()
+        cursor.execute(
+            """SELECT sequence, last_run FROM replication_sequences
+               WHERE last_run > %s ORDER BY last_run LIMIT 1""",
+            (utctime,))
+        after = cursor.fetchone()
+        return before, after
+
+    def _record_state(self, cursor, state, name):
+        """record a parsed state file and get its (sequence, last_run),
+        raising IOError if it was empty or truncated"""
+        if not state:
+            raise IOError("incomplete replication state: {name}".format(
+                name=name))
+        self.record(cursor, state['sequence'], state['last_run'])
+        return state['sequence'], state['last_run']
+
+    def _state(self, cursor, sequence):
+        self.probes += 1
+        return self._record_state(
+            cursor, Planet.get_state_for_sequence(sequence),
+            Planet.state_path_for_sequence(sequence))
+
+    def sequence_for(self, utctime):
+        """Get the last sequence published at or before utctime, so that
+        everything changed after utctime is in the diffs following it.
+        Returns 0 if utctime predates every sequence, and raises IOError
+        if a state file needed could not be read."""
+        cursor = self.connection.cursor()
+        before, after = self.bracket(utctime)
+        if after is None:
+            after = self._record_state(
+                cursor, Planet.get_current_state(), "state.yaml")
+            if after[1] <= utctime:
+                self.connection.commit()
+                return after[0]
+        if before is None:
+            before = 0, None
+        bisect = before[1] is None
+        while after[0] - before[0] > 1:
+            gap = after[0] - before[0]
+            if bisect:
+                guess = (before[0] + after[0]) // 2
+            else:
+                fraction = (utctime - before[1]).total_seconds() /\
+                    max(1, (after[1] - before[1]).total_seconds())
+                guess = min(max(
+                    before[0] + int(gap * fraction), before[0] + 1),
+                    after[0] - 1)
+            probe = self._state(cursor, guess)
+            if probe[1] <= utctime:
+                before = probe
+            else:
+                after = probe
+            # fall back to bisection whenever interpolation did not at
+            # least halve the gap, which keeps the worst case logarithmic
+            bisect = before[1] is None or after[0] - before[0] > gap // 2
+        self.connection.commit()
+        return before[0]
@@ -0,0 +1,134 @@
+"""Small file-like adapters for parsing XML as it is downloaded or
+decompressed, without going through temporary files."""
+import zlib
+from collections import deque
+import config
+import metrics
+
+HTTP_REQUESTS = metrics.histogram(
+    "http_request_seconds",
+    "Seconds until the response headers of a download arrived.")
+
+HTTP_BYTES = metrics.counter(
+    "http_bytes_total", "Bytes of response bodies downloaded.")
+
+
+class GeneratorReader(object):
+    """minimal file object over a generator of strings, for iterparse.
+    The chunks are kept as they arrive and read from an offset into the
+    first one, so each byte is copied once however the chunk and read
+    sizes compare."""
+
+    def __init__(self, generator):
+        self.generator = generator
+        self.chunks = deque()
+        self.offset = 0
+        self.buffered = 0
+
+    def read(self, size=-1):
+        while size < 0 or self.buffered < size:
+            try:
+                chunk = next(self.generator)
+            except StopIteration:
+                break
+            if chunk:
+                self.chunks.append(chunk)
+                self.buffered += len(chunk)
+        if size < 0 or size > self.buffered:
+            size = self.buffered
+        parts = []
+        needed = size
+        while needed:
+            chunk = self.chunks[0]
+            available = len(chunk) - self.offset
+            if available > needed:
+                parts.append(chunk[self.offset:self.offset + needed])
+                self.offset += needed
+                break
+            parts.append(chunk[self.offset:] if self.offset else chunk)
+            self.chunks.popleft()
+            self.offset = 0
+            needed -= available
+        self.buffered -= size
+        return ''.join(parts)
+
+
+class StageReader(object):
+    """file object wrapper that charges reads to a metrics stage"""
+
+    def __init__(self, fileobj, stage):
+        self.fileobj = fileobj
+        self.stage = stage
+
+    def read(self, size=-1):
+        previous = metrics.enter(self.stage)
+        try:
+            return self.fileobj.read(size)
+        finally:
+            metrics.enter(previous)
+
+    def close(self):
+        self.fileobj.close()
+
+
+def gunzip_chunks(chunks):
+    """decompress a gzip stream arriving in chunks"""
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        previous = metrics.enter("decompress")
+        data = decompressor.decompress(chunk)
+        metrics.enter(previous)
+        if data:
+            yield data
+    data = decompressor.flush()
+    if data:
+        yield data
+
+
+def fetched_chunks(chunks):
+    """pass on the chunks of a download, charging the wait for them to
+    the fetch stage"""
+    chunks = iter(chunks)
+    while True:
+        previous = metrics.enter("fetch")
+        try:
+            chunk = next(chunks)
+        except StopIteration:
+            return
+        finally:
+            metrics.enter(previous)
+        HTTP_BYTES.inc(len(chunk))
+        yield chunk
+
+
+def open_url(session, url, cache=None, chunk_size=64 * 1024):
+    """Get a file object over the body of a download, streamed as it is
+    read from the network. With a fetchcache.FetchCache it is served
+    from disk when cached, and otherwise written to the cache as it
+    streams through."""
+    if cache is not None:
+        cached = cache.open(url)
+        if cached is not None:
+            return cached
+    previous = metrics.enter("fetch")
+    try:
+        with HTTP_REQUESTS.time():
+            response = session.get(
+                url, stream=True, timeout=config.HTTP_TIMEOUT)
+        if not response.ok:
+            response.close()
+            response.raise_for_status()
+    finally:
+        metrics.enter(previous)
+    chunks = fetched_chunks(response.iter_content(chunk_size))
+    if cache is not None:
+        chunks = cache.store(url, chunks)
+    return GeneratorReader(chunks)
+
+
+def open_gzip_url(session, url, cache=None, chunk_size=64 * 1024):
+    """Get a file object that decompresses a gzipped download as it
+    is read from the network, or from the cache."""
+    body = open_url(session, url, cache, chunk_size)
+    return GeneratorReader(gunzip_chunks(
+        iter(lambda: body.read(chunk_size), '')))
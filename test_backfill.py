@@ -0,0 +1,105 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from datetime import datetime, timedelta
+import backfill
+import benchmark
+import config
+import replication
+from osm import Planet
+from testserver import FixtureServer
+from timeutil import UTC
+
+FIRST = 1001
+
+LAST = 1030
+
+PER_DIFF = 3
+
+
+def last_run(sequence):
+    return datetime(2020, 1, 1, tzinfo=UTC) + timedelta(minutes=sequence)
+
+
+class BackfillTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        changesets = benchmark.synthetic_changesets(
+            (LAST - FIRST + 1) * PER_DIFF, first_id=1)
+        self.expected = {}
+        self.server = FixtureServer(self.root).start()
+        self.saved = Planet.base_url, config.PLANET_BASE_URL
+        Planet.base_url = config.PLANET_BASE_URL = self.server.base_url
+        for sequence in range(FIRST, LAST + 1):
+            offset = (sequence - FIRST) * PER_DIFF
+            diff = changesets[offset:offset + PER_DIFF]
+            self.expected[sequence] = [values[0] for values in diff]
+            path = Planet.path_for_sequence(sequence)[
+                len(self.server.base_url):]
+            directory = os.path.join(self.root, os.path.dirname(path))
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            with open(os.path.join(self.root, path + ".osm.gz"), "wb") as f:
+                f.write(benchmark.minutely_gz(diff))
+            with open(os.path.join(self.root, path + ".state.txt"), "w") as f:
+                f.write("---\nlast_run: {last_run}\nsequence: {sequence}\n"
+                        .format(
+                            last_run=last_run(sequence).strftime(
+                                "%Y-%m-%d %H:%M:%S.000000000 +00:00"),
+                            sequence=sequence))
+        self.applied = []
+        self.ahead = []
+        self.apply_changesets = replication.apply_changesets
+        replication.apply_changesets = self.record
+
+    def tearDown(self):
+        replication.apply_changesets = self.apply_changesets
+        Planet.base_url, config.PLANET_BASE_URL = self.saved
+        self.server.stop()
+        shutil.rmtree(self.root)
+
+    def diffs_requested(self):
+        with self.server.lock:
+            return len([path for path in self.server.requests
+                        if path.endswith(".osm.gz")])
+
+    def record(self, connection, sequence, changesets, last_run=None):
+        """stand in for applying a diff, slowly enough for the workers
+        to run as far ahead as they may"""
+        self.ahead.append(self.diffs_requested() - len(self.applied) - 1)
+        self.applied.append((sequence, last_run,
+                             [values[0] for values in changesets]))
+        time.sleep(0.01)
+
+    def test_applies_in_order(self):
+        applied = backfill.backfill(None, FIRST, LAST, concurrency=4)
+        self.assertEqual(applied, LAST - FIRST + 1)
+        self.assertEqual(
+            self.applied,
+            [(sequence, last_run(sequence), self.expected[sequence])
+             for sequence in range(FIRST, LAST + 1)])
+
+    def test_window(self):
+        concurrency = 2
+        backfill.backfill(None, FIRST, LAST, concurrency=concurrency)
+        self.assertEqual(len(self.applied), LAST - FIRST + 1)
+        self.assertLessEqual(max(self.ahead), concurrency * 4)
+        self.assertGreater(max(self.ahead), concurrency)
+
+    def test_retries_failed_download(self):
+        path = Planet.changeset_path_for_sequence(FIRST + 5)[
+            len(self.server.base_url) - 1:]
+        with open(os.path.join(self.root, path[1:]), "rb") as f:
+            body = f.read()
+        self.server.respond(path, (503, "busy"), (200, body))
+        backfill.backfill(None, FIRST, LAST, concurrency=4)
+        self.assertEqual(self.server.requests.count(path), 2)
+        self.assertEqual([sequence for sequence, _, _ in self.applied],
+                         range(FIRST, LAST + 1))
+
+
+if __name__ == "__main__":
+    unittest.main()
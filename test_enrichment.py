@@ -0,0 +1,140 @@
+import shutil
+import tempfile
+import time
+import unittest
+import config
+import enrichment
+from osm import API
+from testserver import FixtureServer
+
+OSMCHANGE = """<osmChange version="0.6">
+<create>
+  <node id="1" version="1" changeset="{id}" lat="52.1" lon="13.4"/>
+  <node id="2" version="1" changeset="{id}" lat="52.2" lon="13.5"/>
+  <way id="3" version="1" changeset="{id}"><nd ref="1"/><nd ref="2"/></way>
+</create>
+<modify>
+  <relation id="4" version="2" changeset="{id}">
+    <member type="way" ref="3" role="outer"/>
+  </relation>
+</modify>
+<delete>
+  <node id="5" version="3" changeset="{id}"/>
+</delete>
+</osmChange>"""
+
+
+def counts(changeset_id):
+    """the changeset_actions row of OSMCHANGE"""
+    return (changeset_id, 2, 1, 0, 0, 0, 1, 1, 0, 0)
+
+
+class Connection(object):
+
+    def __init__(self):
+        self.commits = 0
+
+    def cursor(self):
+        return None
+
+    def commit(self):
+        self.commits += 1
+
+
+class EnrichTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.server = FixtureServer(self.root).start()
+        self.saved = API.base_url, config.SCORING_ENABLED
+        API.base_url = self.server.base_url + "api/0.6/"
+        config.SCORING_ENABLED = False
+        self.written = []
+        self.write_counts = enrichment.write_counts
+        enrichment.write_counts = lambda cursor, rows: \
+            self.written.extend(rows)
+
+    def tearDown(self):
+        enrichment.write_counts = self.write_counts
+        API.base_url, config.SCORING_ENABLED = self.saved
+        self.server.stop()
+        shutil.rmtree(self.root)
+
+    def path(self, changeset_id):
+        return "/api/0.6/changeset/{id}/download".format(id=changeset_id)
+
+    def serve(self, changeset_id, *failures):
+        """answer with the failures first, then with OSMCHANGE"""
+        self.server.respond(
+            self.path(changeset_id),
+            *failures + ((200, OSMCHANGE.format(id=changeset_id)),))
+
+    def test_counts(self):
+        for changeset_id in range(1, 21):
+            self.serve(changeset_id)
+        connection = Connection()
+        result = enrichment.enrich(
+            connection, range(1, 21), workers=4, rate=0, batch_size=8)
+        self.assertEqual(result, (20, 0, 0))
+        self.assertEqual(sorted(self.written),
+                         [counts(changeset_id)
+                          for changeset_id in range(1, 21)])
+        self.assertEqual(connection.commits, 3)
+
+    def test_retries(self):
+        self.serve(1)
+        self.serve(2, (429, "slow down"))
+        self.serve(3, (503, "unavailable"), (502, "bad gateway"))
+        self.serve(4, (500, "error"))
+        result = enrichment.enrich(
+            Connection(), [1, 2, 3, 4], workers=4, rate=0)
+        self.assertEqual(result, (4, 0, 0))
+        self.assertEqual(sorted(self.written), map(counts, [1, 2, 3, 4]))
+        requests = self.server.requests
+        self.assertEqual(
+            [requests.count(self.path(changeset_id))
+             for changeset_id in [1, 2, 3, 4]],
+            [1, 2, 3, 2])
+
+    def test_missing_and_failed(self):
+        self.serve(1)
+        self.server.respond(self.path(2), (404, "not found"))
+        self.server.respond(self.path(3), (410, "gone"))
+        self.server.respond(self.path(4), (400, "bad request"))
+        result = enrichment.enrich(
+            Connection(), [1, 2, 3, 4], workers=2, rate=0)
+        self.assertEqual(result, (1, 2, 1))
+        self.assertEqual(self.written, [counts(1)])
+        self.assertEqual(self.server.requests.count(self.path(4)), 1)
+
+    def test_gives_up(self):
+        self.server.respond(self.path(1), (503, "unavailable"))
+        with self.assertRaises(IOError):
+            enrichment.fetch_details(
+                enrichment.get_session(), enrichment.RateLimiter(0), 1,
+                retries=1)
+        self.assertEqual(self.server.requests.count(self.path(1)), 2)
+
+
+class RateLimiterTest(unittest.TestCase):
+
+    def test_rate(self):
+        limiter = enrichment.RateLimiter(50)
+        started = time.time()
+        for _ in range(11):
+            limiter.wait()
+        self.assertGreaterEqual(time.time() - started, 0.19)
+
+    def test_unlimited(self):
+        limiter = enrichment.RateLimiter(0)
+        started = time.time()
+        for _ in range(1000):
+            limiter.wait()
+        self.assertLess(time.time() - started, 0.1)
+
+    def test_negative(self):
+        self.assertRaises(ValueError, enrichment.RateLimiter, -1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,236 @@
+import json
+import socket
+import threading
+import time
+import unittest
+import benchmark
+import config
+import events
+
+FILTERS = [
+    {},
+    {"bbox": (4, 45, 20, 55)},
+    {"bbox": (-180, -90, 180, 90)},
+    {"bbox": (-90, 25, -70, 40)},
+    {"bbox": (13.4, 52.4, 13.6, 52.6)},
+    {"uids": [70460, 82286]},
+    {"tags": {"created_by": "Potlatch 0.11b"}},
+    {"tags": {"comment": None}},
+    {"tags": {"comment": None, "created_by": "JOSM/1.5 (1566 de)"}},
+    {"bbox": (0, 40, 20, 60), "uids": [70460],
+     "tags": {"created_by": None}},
+    {"uids": [70460], "tags": {"comment": None}},
+    {"uids": [1], "tags": {"source": None}}]
+
+
+def brute_force(filters, values):
+    """match a changeset against filters without any index"""
+    if "bbox" in filters:
+        min_lon, min_lat, max_lon, max_lat = filters["bbox"]
+        if not any(values[6:10]):
+            return False
+        if values[7] < min_lon or values[6] > max_lon or \
+                values[9] < min_lat or values[8] > max_lat:
+            return False
+    if "uids" in filters and values[1] not in filters["uids"]:
+        return False
+    for key, value in filters.get("tags", {}).iteritems():
+        if key not in values[10]:
+            return False
+        if value is not None and values[10][key] != value:
+            return False
+    return True
+
+
+def drain(subscription):
+    found = []
+    while True:
+        event = subscription.get(timeout=0)
+        if event is None:
+            return found
+        found.append(event)
+
+
+class FilterTest(unittest.TestCase):
+
+    def test_matches_brute_force(self):
+        bus = events.EventBus()
+        subscriptions = [bus.subscribe(maxsize=0, **filters)
+                         for filters in FILTERS]
+        changesets = benchmark.synthetic_changesets(1000, seed=3)
+        for sequence, start in enumerate(range(0, len(changesets), 50)):
+            bus.publish(sequence, changesets[start:start + 50])
+        for filters, subscription in zip(FILTERS, subscriptions):
+            found = [(event["sequence"], event["id"])
+                     for event in drain(subscription)]
+            expected = [(index // 50, values[0])
+                        for index, values in enumerate(changesets)
+                        if brute_force(filters, values)]
+            self.assertEqual(found, expected, filters)
+        self.assertTrue(all(
+            len(bus.candidates(values)) < len(FILTERS)
+            for values in changesets[:20]))
+
+    def test_unsubscribe(self):
+        bus = events.EventBus()
+        for filters in FILTERS:
+            bus.subscribe(**filters).close()
+        self.assertEqual(bus.subscriptions, set())
+        self.assertEqual(bus.grid.cells, {})
+        self.assertEqual(bus.grid.wide, set())
+        self.assertEqual(bus.by_uid, {})
+        self.assertEqual(bus.by_tag, {})
+        self.assertEqual(bus.unindexed, set())
+        self.assertEqual(
+            bus.publish(1, benchmark.synthetic_changesets(10)), 0)
+
+    def test_event(self):
+        values = benchmark.synthetic_changesets(1)[0]
+        event = events.changeset_event(5, values)
+        self.assertEqual(event["bbox"], [values[6], values[8], values[7],
+                                         values[9]])
+        self.assertEqual(event["created_at"], values[3].isoformat())
+        no_bbox = values[:6] + (0.0,) * 4 + values[10:]
+        self.assertIsNone(events.changeset_event(5, no_bbox)["bbox"])
+
+    def test_parse_filters(self):
+        self.assertEqual(
+            events.parse_filters(
+                "bbox=4.7,52.3,5.0,52.4&uid=1,2&uid=3"
+                "&tag=created_by=JOSM&tag=comment&policy=block"),
+            {"bbox": [4.7, 52.3, 5.0, 52.4], "uids": [1, 2, 3],
+             "tags": {"created_by": "JOSM", "comment": None},
+             "policy": "block"})
+        self.assertEqual(events.parse_filters(""), {})
+        for query in ("bbox=1,2,3", "bbox=a,b,c,d", "uid=x",
+                      "policy=wait"):
+            self.assertRaises(ValueError, events.parse_filters, query)
+
+
+class OverflowTest(unittest.TestCase):
+
+    def setUp(self):
+        self.timeout = config.EVENTS_BLOCK_TIMEOUT
+        config.EVENTS_BLOCK_TIMEOUT = 0.2
+        self.bus = events.EventBus()
+        self.changesets = benchmark.synthetic_changesets(10)
+
+    def tearDown(self):
+        config.EVENTS_BLOCK_TIMEOUT = self.timeout
+
+    def test_drop_oldest(self):
+        subscription = self.bus.subscribe(maxsize=3, policy="drop")
+        dropped = events.EVENTS_DROPPED.value
+        self.assertEqual(self.bus.publish(1, self.changesets[:5]), 5)
+        self.assertEqual([event["id"] for event in drain(subscription)],
+                         [values[0] for values in self.changesets[2:5]])
+        self.assertEqual(subscription.dropped, 2)
+        self.assertEqual(events.EVENTS_DROPPED.value - dropped, 2)
+
+    def test_block_times_out(self):
+        subscription = self.bus.subscribe(maxsize=2, policy="block")
+        started = time.time()
+        self.assertEqual(self.bus.publish(1, self.changesets[:3]), 2)
+        self.assertGreaterEqual(time.time() - started, 0.2)
+        self.assertEqual([event["id"] for event in drain(subscription)],
+                         [values[0] for values in self.changesets[:2]])
+        self.assertEqual(subscription.dropped, 1)
+
+    def test_block_waits_for_reader(self):
+        subscription = self.bus.subscribe(maxsize=1, policy="block")
+        read = []
+
+        def reader():
+            for _ in self.changesets:
+                time.sleep(0.01)
+                read.append(subscription.get(timeout=1)["id"])
+
+        thread = threading.Thread(target=reader)
+        thread.start()
+        self.assertEqual(
+            self.bus.publish(1, self.changesets), len(self.changesets))
+        thread.join()
+        self.assertEqual(read, [values[0] for values in self.changesets])
+        self.assertEqual(subscription.dropped, 0)
+
+    def test_callback(self):
+        received = []
+        done = threading.Event()
+
+        def callback(event):
+            received.append(event["id"])
+            if len(received) == len(self.changesets):
+                done.set()
+
+        self.bus.subscribe(callback=callback)
+        self.bus.publish(1, self.changesets)
+        self.assertTrue(done.wait(1))
+        self.assertEqual(received,
+                         [values[0] for values in self.changesets])
+
+
+class ServerSentEventsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.bus = events.EventBus()
+        self.server = events.serve(self.bus, 0)
+        self.port = self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def request(self, path):
+        connection = socket.create_connection(("127.0.0.1", self.port))
+        connection.sendall("GET {path} HTTP/1.0\r\n\r\n".format(path=path))
+        return connection
+
+    def read_until(self, connection, end, data="", count=1):
+        while data.count(end) < count:
+            chunk = connection.recv(4096)
+            if not chunk:
+                break
+            data += chunk
+        return data
+
+    def test_stream(self):
+        connection = self.request("/events?uid=70460")
+        try:
+            for _ in range(100):
+                if self.bus.subscriptions:
+                    break
+                time.sleep(0.01)
+            changesets = benchmark.synthetic_changesets(30)
+            self.assertEqual(self.bus.publish(7, changesets), 3)
+            data = self.read_until(connection, "\r\n\r\n")
+            head, _, body = data.partition("\r\n\r\n")
+            self.assertTrue(head.startswith("HTTP/1.0 200"))
+            self.assertIn("Content-Type: text/event-stream", head)
+            body = self.read_until(connection, "\n\n", body, count=3)
+            frames = body.split("\n\n")[:3]
+        finally:
+            connection.close()
+        expected = [values for values in changesets if values[1] == 70460]
+        self.assertEqual(len(frames), len(expected))
+        for frame, values in zip(frames, expected):
+            lines = frame.split("\n")
+            self.assertEqual(lines[:2], ["id: 7", "event: changeset"])
+            self.assertTrue(lines[2].startswith("data: "))
+            self.assertEqual(json.loads(lines[2][6:]),
+                             json.loads(json.dumps(
+                                 events.changeset_event(7, values))))
+
+    def test_bad_requests(self):
+        for path, status in (("/events?bbox=1,2", "400"),
+                             ("/other", "404")):
+            connection = self.request(path)
+            try:
+                data = connection.makefile().read()
+            finally:
+                connection.close()
+            self.assertTrue(data.startswith("HTTP/1.0 " + status), data)
+        self.assertEqual(self.bus.subscriptions, set())
+
+
+if __name__ == "__main__":
+    unittest.main()
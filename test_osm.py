@@ -0,0 +1,101 @@
+import os
+import shutil
+import tempfile
+import unittest
+from cStringIO import StringIO
+import benchmark
+import config
+import fetchcache
+import helpers
+import metrics
+import osm
+import testdata
+from osm import API
+from testserver import FixtureServer
+
+OSMCHANGE = """<osmChange version="0.6">
+<create><node id="1" version="1" changeset="{id}" lat="52.1" lon="13.4"/>
+</create>
+</osmChange>"""
+
+NODE = """<osm version="0.6">
+<node id="1" version="3" changeset="7" lat="52.1" lon="13.4"/>
+</osm>"""
+
+
+class IterChangesetsTest(unittest.TestCase):
+
+    def test_records_and_dicts_agree(self):
+        document = benchmark.changeset_xml()
+        records = [changeset.as_tuple() for changeset
+                   in osm.iter_changesets(StringIO(document))]
+        dicts = [helpers.as_tuple(changeset) for changeset
+                 in helpers.iter_changesets(StringIO(document))]
+        self.assertEqual(records, dicts)
+        self.assertEqual(records, testdata.sample1)
+
+
+class CacheTest(unittest.TestCase):
+    """only downloads that can never change go through the fetch cache"""
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.server = FixtureServer(self.root).start()
+        self.saved = (API.base_url, config.OSM_API_BASE_URL,
+                      config.FETCH_CACHE_DIR, fetchcache._cache)
+        API.base_url = config.OSM_API_BASE_URL = \
+            self.server.base_url + "api/0.6/"
+        config.FETCH_CACHE_DIR = os.path.join(self.root, "cache")
+        fetchcache._cache = None
+        self.server.respond(
+            "/api/0.6/changeset/1",
+            (200, benchmark.changeset_xml(testdata.sample1[:1])))
+        for changeset_id in (1, 2):
+            self.server.respond(
+                "/api/0.6/changeset/{0}/download".format(changeset_id),
+                (200, OSMCHANGE.format(id=changeset_id)))
+        self.server.respond("/api/0.6/node/1", (200, NODE))
+
+    def tearDown(self):
+        (API.base_url, config.OSM_API_BASE_URL,
+         config.FETCH_CACHE_DIR, fetchcache._cache) = self.saved
+        self.server.stop()
+        shutil.rmtree(self.root)
+
+    def requested(self, *fetches):
+        for fetch in fetches:
+            for _ in range(2):
+                list(fetch())
+        return self.server.requests
+
+    def test_mutable_fetched_again(self):
+        self.assertEqual(
+            self.requested(lambda: API.iter_changeset(1),
+                           lambda: API.iter_element("node", 1),
+                           lambda: API.iter_osmchange(2)),
+            ["/api/0.6/changeset/1"] * 2 + ["/api/0.6/node/1"] * 2 +
+            ["/api/0.6/changeset/2/download"] * 2)
+        helpers.get_changeset_details_from_osm(2)
+        self.assertEqual(len(self.server.requests), 7)
+
+    def test_closed_osmchange_cached(self):
+        self.assertEqual(
+            self.requested(lambda: API.iter_osmchange(1, closed=True)),
+            ["/api/0.6/changeset/1/download"])
+        self.assertEqual(
+            helpers.get_changeset_details_from_osm(1, closed=True)[
+                "create"]["node"], 1)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_metrics(self):
+        self.requested(lambda: API.iter_osmchange(1, closed=True))
+        lines = metrics.render().splitlines()
+        for line in ('fetch_cache_lookups{result="hit"} 1.0',
+                     'fetch_cache_lookups{result="miss"} 1.0',
+                     'fetch_cache_evictions 0.0',
+                     'state_cache_lookups{result="not_modified"} 0.0'):
+            self.assertIn(line, lines)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,61 @@
+import bz2
+import os
+import shutil
+import tempfile
+import unittest
+import benchmark
+import helpers
+import parallelload
+import testdata
+from streams import GeneratorReader
+
+
+class OwnedXmlTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.path = os.path.join(self.root, "changesets.osm.bz2")
+        document = benchmark.changeset_xml()
+        footer = document.rindex(parallelload.END_TAG)
+        # cut the changesets mid-element, and give the footer a stream
+        # of its own the way the planet dumps end
+        middle = document.index("<tag", footer // 2)
+        self.parts = [document[:middle], document[middle:footer],
+                      document[footer:]]
+        with open(self.path, "wb") as f:
+            for part in self.parts:
+                f.write(bz2.compress(part))
+        self.offsets, self.size = parallelload.find_bz2_streams(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def owned_ids(self, first, last):
+        chunks = parallelload._decompressed_streams(
+            self.path, self.offsets, self.size, first, last)
+        return [int(changeset["id"]) for changeset in helpers.iter_changesets(
+            GeneratorReader(parallelload.owned_xml(chunks)))]
+
+    def test_streams(self):
+        self.assertEqual(len(self.offsets), len(self.parts))
+        self.assertEqual(self.offsets[0], 0)
+
+    def test_every_changeset_owned_once(self):
+        expected = [values[0] for values in testdata.sample1]
+        for runs in ([(0, 1), (1, 2), (2, 3)], [(0, 2), (2, 3)],
+                     [(0, 1), (1, 3)], [(0, 3)]):
+            ids = []
+            for first, last in runs:
+                ids.extend(self.owned_ids(first, last))
+            self.assertEqual(ids, expected)
+
+    def test_footer_only_run(self):
+        self.assertEqual(self.owned_ids(2, 3), [])
+        chunks = parallelload._decompressed_streams(
+            self.path, self.offsets, self.size, 2, 3)
+        self.assertEqual(''.join(parallelload.owned_xml(chunks)),
+                         '<osm></osm>')
+
+
+if __name__ == "__main__":
+    unittest.main()
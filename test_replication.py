@@ -0,0 +1,56 @@
+import unittest
+from contextlib import contextmanager
+import psycopg2
+import database
+import helpers
+import replication
+from osm import Planet
+
+
+class FollowTest(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = (replication.catch_up, replication.time.sleep,
+                      database.pooled_connection, helpers.handle_error,
+                      Planet.get_current_state)
+        self.polls = []
+        self.errors = []
+        self.failures = [psycopg2.IntegrityError("duplicate key"),
+                         psycopg2.DataError("invalid input"),
+                         psycopg2.OperationalError("server closed")]
+        replication.catch_up = self.catch_up
+        replication.time.sleep = self.sleep
+        database.pooled_connection = self.pooled_connection
+        helpers.handle_error = lambda e, bail=True: self.errors.append(e)
+        Planet.get_current_state = staticmethod(lambda: {"sequence": 1})
+
+    def tearDown(self):
+        (replication.catch_up, replication.time.sleep,
+         database.pooled_connection, helpers.handle_error,
+         Planet.get_current_state) = self.saved
+
+    @contextmanager
+    def pooled_connection(self):
+        yield None
+
+    def catch_up(self, connection, current_state, concurrency):
+        self.polls.append(current_state["sequence"])
+        if self.failures:
+            raise self.failures.pop(0)
+        return 1
+
+    def sleep(self, seconds):
+        if len(self.polls) == 5:
+            raise KeyboardInterrupt
+
+    def test_database_errors_retried(self):
+        replication.follow(poll_interval=0)
+        self.assertEqual(len(self.polls), 5)
+        self.assertEqual(
+            [type(e) for e in self.errors],
+            [psycopg2.IntegrityError, psycopg2.DataError,
+             psycopg2.OperationalError])
+
+
+if __name__ == "__main__":
+    unittest.main()
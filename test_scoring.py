@@ -0,0 +1,114 @@
+import math
+import operator
+import time
+import unittest
+from datetime import timedelta
+import benchmark
+import config
+import scoring
+
+RULES = [
+    ("huge_bbox", 30, [("bbox_area", ">", 100.0)]),
+    ("tiny_bbox", 5, [("bbox_area", "<=", 0.0001)]),
+    ("mass_edit", 10, [("num_changes", ">=", 100)]),
+    ("single_edit", 1, [("num_changes", "==", 1)]),
+    ("new_user_mass_edit", 40, [
+        ("user_age_days", "<", 1), ("num_changes", ">", 10)]),
+    ("known_user", 2, [("user_age_days", ">=", 1)]),
+    ("first_changeset", 3, [("user_changesets", "<=", 1)]),
+    ("josm", 20, [("editor", "in", ["JOSM"])]),
+    ("not_potlatch", 1, [("created_by", "!=", "Potlatch 0.11b")]),
+    ("mass_delete", 50, [("deletes", ">", 500)])]
+
+OPERATORS = {
+    ">": operator.gt,
+    ">=": operator.ge,
+    "<": operator.lt,
+    "<=": operator.le,
+    "==": operator.eq,
+    "!=": operator.ne,
+    "in": lambda value, values: value in values}
+
+
+def changesets():
+    """synthetic changesets, with anonymous ones and ones without a
+    creation time mixed in, and the same users coming back"""
+    batch = benchmark.synthetic_changesets(2000, seed=1, days=3)
+    for index in range(0, len(batch), 37):
+        batch[index] = batch[index][:1] + (0, u"anonymous") + batch[index][3:]
+    for index in range(5, len(batch), 101):
+        batch[index] = batch[index][:3] + (None,) + batch[index][4:]
+    return batch
+
+
+def brute_force(rules, features, sequence=None):
+    """evaluate every rule on every row, one value at a time"""
+    found = []
+    for name, score, conditions in rules:
+        if any(feature not in features for feature, _, _ in conditions):
+            continue
+        for row in range(len(features["id"])):
+            if all(OPERATORS[op](features[feature][row], value)
+                   for feature, op, value in conditions):
+                found.append(
+                    (int(features["id"][row]), name, score, sequence))
+    return found
+
+
+class ScoringTest(unittest.TestCase):
+
+    def test_matches_brute_force(self):
+        engine = scoring.ScoringEngine(RULES)
+        batch = changesets()
+        fired = 0
+        for start in range(0, len(batch), 50):
+            features = engine.changeset_features(
+                None, batch[start:start + 50])
+            found = engine.alerts(features, 7)
+            self.assertEqual(sorted(found),
+                             sorted(brute_force(RULES, features, 7)))
+            fired += len(found)
+        self.assertGreater(fired, 0)
+
+    def test_counts_match_brute_force(self):
+        engine = scoring.ScoringEngine(RULES)
+        rows = [(changeset_id,) + tuple(
+            (changeset_id * (column + 3)) % 700 for column in range(9))
+            for changeset_id in range(1, 501)]
+        found = engine.alerts(engine.count_features(rows))
+        features = dict(
+            id=[row[0] for row in rows],
+            creates=[sum(row[1:4]) for row in rows],
+            modifies=[sum(row[4:7]) for row in rows],
+            deletes=[sum(row[7:10]) for row in rows])
+        expected = brute_force(RULES, features)
+        self.assertEqual(sorted(found), sorted(expected))
+        self.assertTrue(expected)
+
+    def test_user_features(self):
+        engine = scoring.ScoringEngine(RULES)
+        first, second, other = benchmark.synthetic_changesets(3)
+        second = second[:1] + first[1:3] + (
+            first[3] + timedelta(hours=36),) + second[4:]
+        other = other[:3] + (None,) + other[4:]
+        features = engine.changeset_features(None, [first, second, other])
+        self.assertEqual(list(features["user_changesets"][:2]), [2, 2])
+        self.assertEqual(list(features["user_age_days"][:2]), [0.0, 1.5])
+        self.assertTrue(math.isnan(features["user_age_days"][2]))
+
+    def test_batch_latency(self):
+        """a minutely diff worth of changesets scores in a few ms"""
+        engine = scoring.ScoringEngine(config.SCORING_RULES + RULES)
+        batch = changesets()
+        timings = []
+        for start in range(0, len(batch), 50):
+            started = time.time()
+            engine.alerts(engine.changeset_features(
+                None, batch[start:start + 50]))
+            timings.append(time.time() - started)
+        timings.sort()
+        self.assertLess(timings[len(timings) // 2], 0.005)
+
+
+if __name__ == "__main__":
+    unittest.main()
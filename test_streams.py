@@ -0,0 +1,88 @@
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+from cStringIO import StringIO
+import fetchcache
+import streams
+from osm import get_session
+from testserver import FixtureServer
+
+BODY = ''.join(chr(index % 251) for index in range(300000))
+
+
+def gzipped(data):
+    buf = StringIO()
+    compressed = gzip.GzipFile(fileobj=buf, mode='wb')
+    compressed.write(data)
+    compressed.close()
+    return buf.getvalue()
+
+
+def chunked(data, size):
+    for start in range(0, len(data), size):
+        yield data[start:start + size]
+
+
+class GeneratorReaderTest(unittest.TestCase):
+
+    def test_reads(self):
+        data = BODY[:20000]
+        for chunk_size in (1, 7, 1000, 8192, len(data) + 1):
+            for read_size in (1, 13, 4096, 100000):
+                reader = streams.GeneratorReader(chunked(data, chunk_size))
+                parts = list(iter(lambda: reader.read(read_size), ''))
+                self.assertEqual(''.join(parts), data)
+                self.assertTrue(
+                    all(len(part) == read_size for part in parts[:-1]))
+
+    def test_read_all(self):
+        reader = streams.GeneratorReader(chunked(BODY, 1000))
+        self.assertEqual(reader.read(10), BODY[:10])
+        self.assertEqual(reader.read(), BODY[10:])
+        self.assertEqual(reader.read(), '')
+
+
+class OpenUrlTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.server = FixtureServer(self.root).start()
+        self.cache = fetchcache.FetchCache(
+            os.path.join(self.root, "cache"), 10 * len(BODY))
+        self.session = get_session()
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.root)
+
+    def read(self, path, size=-1):
+        url = self.server.base_url + path
+        return streams.open_url(self.session, url, self.cache, 4096).read(size)
+
+    def test_cached_while_streaming(self):
+        self.server.respond("/plain", (200, BODY))
+        self.server.respond("/diff.osm.gz", (200, gzipped(BODY)))
+        self.assertEqual(self.read("plain"), BODY)
+        self.assertEqual(self.read("plain"), BODY)
+        self.assertEqual(gzip.GzipFile(
+            fileobj=StringIO(self.read("diff.osm.gz"))).read(), BODY)
+        self.assertEqual(gzip.GzipFile(
+            fileobj=StringIO(self.read("diff.osm.gz"))).read(), BODY)
+        self.assertEqual(self.server.requests, ["/plain", "/diff.osm.gz"])
+        self.assertEqual(self.cache.stats()["hits"], 2)
+        self.assertEqual(len(self.cache.entries), 2)
+
+    def test_partial_read_not_cached(self):
+        self.server.respond("/plain", (200, BODY))
+        self.assertEqual(self.read("plain", 100), BODY[:100])
+        self.assertEqual(self.read("plain"), BODY)
+        self.assertEqual(self.server.requests, ["/plain", "/plain"])
+        self.assertEqual(
+            [name for _, _, names in os.walk(self.cache.directory)
+             for name in names if name.startswith('.incoming')], [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,78 @@
+"""Local HTTP fixtures for the tests.
+
+FixtureServer serves the files under a directory with SimpleHTTPServer,
+the way planet.osm.org serves the replication files, and can be told to
+answer given paths with canned responses instead, one after the other,
+to stand in for the API and for failing downloads. Every request path is
+logged in order."""
+import SimpleHTTPServer
+import SocketServer
+import BaseHTTPServer
+import os
+import posixpath
+import threading
+import urllib
+import urlparse
+
+
+class FixtureHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+
+    def translate_path(self, path):
+        path = posixpath.normpath(urllib.unquote(urlparse.urlparse(path).path))
+        return os.path.join(
+            self.server.root, *[part for part in path.split('/') if part])
+
+    def do_GET(self):
+        path = urlparse.urlparse(self.path).path
+        response = self.server.log(path)
+        if response is None:
+            SimpleHTTPServer.SimpleHTTPRequestHandler.do_GET(self)
+            return
+        status, body = response
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FixtureServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, root):
+        BaseHTTPServer.HTTPServer.__init__(
+            self, ("127.0.0.1", 0), FixtureHandler)
+        self.root = root
+        self.lock = threading.Lock()
+        self.requests = []
+        self.responses = {}
+        self.base_url = "http://127.0.0.1:{port}/".format(
+            port=self.server_address[1])
+
+    def respond(self, path, *responses):
+        """answer path with the (status, body) responses in turn, and
+        with the last one from then on"""
+        with self.lock:
+            self.responses[path] = list(responses)
+
+    def log(self, path):
+        """log a request and get the canned response for it, if any"""
+        with self.lock:
+            self.requests.append(path)
+            responses = self.responses.get(path)
+            if not responses:
+                return None
+            return responses.pop(0) if len(responses) > 1 else responses[0]
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,28 @@
+from datetime import datetime
+from dateutil.tz import tzutc
+
+UTC = tzutc()
+
+
+def parse_timestamp(value):
+    """Parse an OSM timestamp. The fixed YYYY-MM-DDTHH:MM:SSZ format
+    used throughout the API and the dumps is sliced apart directly;
+    anything else falls back to dateutil."""
+    if len(value) == 20 and value[10] == 'T' and value[19] == 'Z' and \
+            value[4] == value[7] == '-' and value[13] == value[16] == ':':
+        try:
+            return datetime(
+                int(value[0:4]), int(value[5:7]), int(value[8:10]),
+                int(value[11:13]), int(value[14:16]), int(value[17:19]),
+                tzinfo=UTC)
+        except ValueError:
+            pass
+    from dateutil.parser import parse
+    return parse(value)
+
+
+def as_utc(value):
+    """get a datetime in UTC, taking a naive one to be in UTC already"""
+    if value.tzinfo is None:
+        return value.replace(tzinfo=UTC)
+    return value.astimezone(UTC)
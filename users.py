@@ -0,0 +1,161 @@
+"""Per-user activity summaries and user history queries.
+
+The users table holds when every mapper was first and last seen, how
+many changesets and edits they made and the box around all their
+changesets. It is kept up to date incrementally by the follower, and
+recomputed in one pass after bulk loads. User histories are read newest
+first from the (uid, created_at DESC) index with keyset pagination, so
+every page costs the same no matter how deep into the history it is."""
+import config
+
+schema = """
+    CREATE TABLE IF NOT EXISTS users (
+        uid integer PRIMARY KEY,
+        username text,
+        first_seen timestamp with time zone NOT NULL,
+        last_seen timestamp with time zone NOT NULL,
+        changesets integer NOT NULL,
+        edits bigint NOT NULL,
+        bbox box);
+    CREATE INDEX IF NOT EXISTS users_first_seen_idx ON users (first_seen)"""
+
+HISTORY_COLUMNS = (
+    "id", "uid", "username", "created_at", "closed_at", "num_changes",
+    "min_lon", "max_lon", "min_lat", "max_lat", "tags")
+
+
+class UserActivity(object):
+    """Accumulates per-user summary deltas in memory until they are
+    written in one statement."""
+
+    def __init__(self):
+        self.users = {}
+
+    def add_values(self, values, old=None):
+        """Count an insert-ready tuple in. old is the (created_at,
+        num_changes) of the version it replaces, if any: a changeset that
+        was seen before only adds the edits it grew by. Anonymous
+        changesets are not counted."""
+        uid = values[1]
+        if not uid:
+            return
+        created_at = values[3]
+        seen_before = old is not None and old[0] is not None
+        edits = (values[5] or 0) - (seen_before and old[1] or 0)
+        entry = self.users.get(uid)
+        if entry is None:
+            entry = self.users[uid] = [
+                values[2], created_at, created_at, 0, 0, None]
+        elif created_at >= entry[2]:
+            entry[0] = values[2]
+        entry[1] = min(entry[1], created_at)
+        entry[2] = max(entry[2], created_at)
+        entry[3] += 0 if seen_before else 1
+        entry[4] += edits
+        bounds = values[6:10]
+        if any(bounds):
+            if entry[5] is None:
+                entry[5] = list(bounds)
+            else:
+                entry[5] = [
+                    min(entry[5][0], bounds[0]), max(entry[5][1], bounds[1]),
+                    min(entry[5][2], bounds[2]), max(entry[5][3], bounds[3])]
+
+    def write(self, cursor):
+        """merge the accumulated deltas into the users table, in uid
+        order, and start over"""
+        rows = []
+        for uid, entry in sorted(self.users.iteritems()):
+            bbox = entry[5] and "({0!r},{2!r}),({1!r},{3!r})".format(
+                *entry[5])
+            rows.append((uid,) + tuple(entry[:5]) + (bbox,))
+        for start in range(0, len(rows), config.ROLLUP_BATCH_SIZE):
+            cursor.execute(
+                """INSERT INTO users AS u (uid, username, first_seen,
+                       last_seen, changesets, edits, bbox)
+                   VALUES {values}
+                   ON CONFLICT (uid) DO UPDATE SET
+                       username = CASE
+                           WHEN EXCLUDED.last_seen >= u.last_seen
+                           THEN EXCLUDED.username ELSE u.username END,
+                       first_seen = least(u.first_seen, EXCLUDED.first_seen),
+                       last_seen = greatest(u.last_seen, EXCLUDED.last_seen),
+                       changesets = u.changesets + EXCLUDED.changesets,
+                       edits = u.edits + EXCLUDED.edits,
+                       bbox = CASE
+                           WHEN u.bbox IS NULL THEN EXCLUDED.bbox
+                           WHEN EXCLUDED.bbox IS NULL THEN u.bbox
+                           ELSE bound_box(u.bbox, EXCLUDED.bbox) END""".format(
+                    values=", ".join(
+                        cursor.mogrify(
+                            "(%s, %s, %s, %s, %s, %s, %s::box)", row)
+                        for row in
+                        rows[start:start + config.ROLLUP_BATCH_SIZE])))
+        self.users = {}
+
+
+def rebuild(cursor):
+    """Recompute the users table from the changesets table in one
+    statement. Used after bulk loads, where parallel loaders updating the
+    same users row by row would serialize on each other."""
+    cursor.execute("TRUNCATE users")
+    cursor.execute(
+        """INSERT INTO users (uid, username, first_seen, last_seen,
+               changesets, edits, bbox)
+           SELECT uid,
+               (array_agg(username ORDER BY created_at DESC))[1],
+               min(created_at), max(created_at), count(*),
+               coalesce(sum(num_changes), 0),
+               box(point(min(min_lon) FILTER (WHERE bbox IS NOT NULL),
+                         min(min_lat) FILTER (WHERE bbox IS NOT NULL)),
+                   point(max(max_lon) FILTER (WHERE bbox IS NOT NULL),
+                         max(max_lat) FILTER (WHERE bbox IS NOT NULL)))
+           FROM {table} WHERE uid <> 0 GROUP BY uid""".format(
+            table=config.TABLENAME))
+
+
+def get_user(cursor, uid):
+    """get the (uid, username, first_seen, last_seen, changesets, edits,
+    bbox) summary of a user, or None if they were never seen"""
+    cursor.execute(
+        """SELECT uid, username, first_seen, last_seen, changesets, edits,
+               bbox
+           FROM users WHERE uid = %s""",
+        (uid,))
+    return cursor.fetchone()
+
+
+def user_changesets(cursor, uid, after=None, limit=50):
+    """Get one page of the changesets of a user, newest first, as
+    Changeset records, together with the key to pass as after to get the
+    next page, which is None on the last page. Pages are found with a
+    keyset condition on (created_at, id) rather than an OFFSET."""
+    from osm import Changeset
+    conditions = ["uid = %s"]
+    params = [uid]
+    if after is not None:
+        conditions.append("(created_at, id) < (%s, %s)")
+        params.extend(after)
+    cursor.execute(
+        """SELECT {columns} FROM {table} WHERE {conditions}
+           ORDER BY created_at DESC, id DESC LIMIT %s""".format(
+            columns=", ".join(HISTORY_COLUMNS),
+            table=config.TABLENAME,
+            conditions=" AND ".join(conditions)),
+        params + [limit])
+    changesets = [Changeset.from_row(row) for row in cursor]
+    if len(changesets) < limit:
+        return changesets, None
+    return changesets, (changesets[-1].created_at, changesets[-1].id)
+
+
+def new_users(cursor, since, until, limit=None):
+    """get the (uid, username, first_seen, changesets, edits) of the
+    users first seen in [since, until), in order of appearance"""
+    query = """
+        SELECT uid, username, first_seen, changesets, edits FROM users
+        WHERE first_seen >= %s AND first_seen < %s ORDER BY first_seen"""
+    if limit:
+        query += " LIMIT {limit:d}".format(limit=limit)
+    cursor.execute(query, (since, until))
+    return cursor.fetchall()